@@ -0,0 +1,113 @@
+"""
+Keeps the budget table small: removes the abandoned drafts and moves the old
+finished entries to budget_archive, where the reports still find them
+"""
+import os
+
+from datetime import datetime, timedelta
+
+from finbot import db, Budget, BudgetArchive, conversation_store, get_conversation_status, \
+                   persist_conversation_statuses
+from unitofwork import UnitOfWork
+
+# Configurations
+archive_days = int(os.environ.get('FINBOT_ARCHIVE_DAYS', 365))
+stale_draft_hours = int(os.environ.get('FINBOT_STALE_DRAFT_HOURS', 24))
+
+draft_statuses = ['draft', 'revision']
+
+# Conversation statuses that need a draft, they go back to waiting without one
+draft_conversations = ['begin_add_data', 'draft_add_data', 'confirm_add_data']
+
+
+class ArchiveReport(object):
+    """
+    Counters of an archive run
+    """
+    def __init__(self):
+        self.purged = 0
+        self.reset = 0
+        self.archived = 0
+        self.users = 0
+        self.batches = 0
+
+    def __repr__(self):
+        return '<ArchiveReport purged={} reset={} archived={} users={} batches={}>'.format(
+            self.purged, self.reset, self.archived, self.users, self.batches)
+
+
+def purge_stale_drafts(hours=None, report=None):
+    """
+    Deletes the drafts and revisions not finished within the hours, the
+    conversations waiting for them go back to waiting
+    """
+    report = report or ArchiveReport()
+    cutoff = datetime.now() - timedelta(hours=stale_draft_hours if hours is None else hours)
+    stale = db.and_(Budget.status.in_(draft_statuses),
+                    db.or_(Budget.created_at < cutoff, Budget.created_at == None))
+
+    with UnitOfWork(db.session):
+        user_ids = [user_id for (user_id,) in db.session.query(Budget.user_id).filter(stale).distinct()]
+        report.purged += Budget.query.filter(stale).delete(synchronize_session=False)
+
+        # Users that started a newer draft meanwhile keep their conversation
+        remaining = db.session.query(Budget.user_id).distinct() \
+                              .filter(Budget.user_id.in_(user_ids), Budget.status.in_(draft_statuses))
+        with_drafts = set(user_id for (user_id,) in remaining) if user_ids else set()
+        reset = [user_id for user_id in user_ids
+                 if user_id not in with_drafts and get_conversation_status(user_id) in draft_conversations]
+        if reset:
+            persist_conversation_statuses(dict((user_id, 'waiting') for user_id in reset))
+        report.reset += len(reset)
+
+    for user_id in reset:
+        conversation_store.forget(user_id)
+    return report
+
+
+def archive_entries(days=None, batch_size=1000, report=None):
+    """
+    Moves the finished entries dated before the horizon to budget_archive,
+    user by user and in date order, so the archived rows of an user and month
+    stay together. Each batch is copied and deleted in its own transaction.
+    """
+    report = report or ArchiveReport()
+    cutoff = datetime.now() - timedelta(days=archive_days if days is None else days)
+    names = [column.name for column in Budget.__table__.columns]
+
+    # SQLite gives the next entry the highest id of the table plus one, the
+    # newest finished entry stays so the ids of the archived ones are not reused
+    newest = db.session.query(db.func.max(Budget.id)).filter(Budget.status == 'done').scalar()
+    old = db.and_(Budget.status == 'done', Budget.date_time < cutoff, Budget.id < newest)
+
+    user_ids = [user_id for (user_id,) in db.session.query(Budget.user_id).distinct()
+                .filter(old).order_by(Budget.user_id)]
+    db.session.commit()
+
+    for user_id in user_ids:
+        report.users += 1
+        while True:
+            with UnitOfWork(db.session):
+                ids = [entry_id for (entry_id,) in db.session.query(Budget.id)
+                       .filter(Budget.user_id == user_id, old)
+                       .order_by(Budget.date_time, Budget.id).limit(batch_size)]
+                if not ids:
+                    break
+
+                moved = db.select([Budget.__table__.c[name] for name in names] +
+                                  [db.literal(datetime.now(), db.DateTime)]) \
+                          .where(Budget.id.in_(ids))
+                db.session.execute(BudgetArchive.__table__.insert().from_select(names + ['archived_at'], moved))
+                Budget.query.filter(Budget.id.in_(ids)).delete(synchronize_session=False)
+
+            report.archived += len(ids)
+            report.batches += 1
+    return report
+
+
+def run(days=None, draft_hours=None, batch_size=1000):
+    """
+    Purges the stale drafts, then archives the old entries
+    """
+    report = purge_stale_drafts(draft_hours)
+    return archive_entries(days, batch_size, report)
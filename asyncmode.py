@@ -0,0 +1,440 @@
+"""
+Serves the webhook from an asyncio event loop, with aiohttp
+
+    python asyncmode.py [--host 0.0.0.0] [--port 8000]
+
+The loop receives the webhook posts, fetches the profiles of the new users
+and sends the replies, so a single process keeps thousands of conversations
+in flight while they wait on the Graph API. Each event still runs the
+handle_event of finbot, the same conversation statuses, on a small pool of
+database threads since SQLAlchemy blocks. The export stays on the gunicorn app.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+import traceback
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import aiohttp
+    from aiohttp import web
+except ImportError:
+    # Only needed by this mode, the gunicorn app runs without it
+    aiohttp = None
+    web = None
+
+import finbot
+import messages
+import metrics
+import migrations
+from delivery import json_headers
+from dispatcher import BatchReport, EventDispatcher
+
+# Configurations
+db_threads = int(os.environ.get('FINBOT_ASYNC_DB_THREADS', 8))
+async_senders = int(os.environ.get('FINBOT_ASYNC_SENDERS', 64))
+graph_connections = int(os.environ.get('FINBOT_ASYNC_GRAPH_CONNECTIONS', 100))
+
+
+def in_app_context(function, args):
+    with finbot.app_context():
+        return function(*args)
+
+
+class AsyncDelivery(object):
+    """
+    Posts the replies from the event loop, in place of the delivery threads.
+
+    Each recipient is always routed to the same shard, drained by a single
+    coroutine, so the messages to a user keep their order. The counters go
+    to the stats of the DeliveryQueue it replaces.
+    """
+    def __init__(self, session, url, stats, shards=64, max_retries=3, backoff=0.5):
+        self.session = session
+        self.url = url
+        self.stats = stats
+        self.shards = max(1, shards)
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self.loop = None
+        self._queues = []
+        self._tasks = []
+
+    def start(self, loop):
+        self.loop = loop
+        self._queues = [asyncio.Queue() for _ in range(self.shards)]
+        self._tasks = [loop.create_task(self._work(shard)) for shard in self._queues]
+
+    def forward(self, recipient, payload):
+        """
+        Hands a payload to the loop, called from the database threads
+        """
+        shard = self._queues[zlib.crc32(str(recipient).encode()) % len(self._queues)]
+        self.loop.call_soon_threadsafe(shard.put_nowait, (payload, time.time()))
+
+    def depth(self):
+        return sum(shard.qsize() for shard in self._queues)
+
+    async def _work(self, shard):
+        while True:
+            payload, enqueued_at = await shard.get()
+            try:
+                await self._deliver(payload, enqueued_at)
+            finally:
+                shard.task_done()
+
+    async def _post(self, payload):
+        if isinstance(payload, bytes):
+            response = self.session.post(self.url, data=payload, headers=json_headers)
+        else:
+            response = self.session.post(self.url, json=payload)
+        async with response as r:
+            await r.read()
+            return r.status
+
+    async def _deliver(self, payload, enqueued_at):
+        """
+        Sends a payload, retrying with exponential backoff
+        """
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.stats.incr('retried')
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            start = time.perf_counter()
+            try:
+                status_code = await self._post(payload)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                metrics.observe_graph('messages', 'error', time.perf_counter() - start)
+                print(traceback.format_exc())
+                continue
+            except Exception:
+                print(traceback.format_exc())
+                break
+            metrics.observe_graph('messages', status_code, time.perf_counter() - start)
+
+            # Client errors are not going to succeed on a retry
+            if status_code < 500 and status_code != 429:
+                self.stats.incr('sent' if status_code < 400 else 'failed')
+                self.stats.observe_latency(time.time() - enqueued_at)
+                return
+
+        self.stats.incr('failed')
+        self.stats.observe_latency(time.time() - enqueued_at)
+
+    async def drain(self, timeout):
+        """
+        Waits up to timeout seconds for the payloads enqueued so far
+        """
+        try:
+            await asyncio.wait_for(asyncio.gather(*[shard.join() for shard in self._queues]), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+
+
+class ProfileBatcher(object):
+    """
+    Event loop counterpart of the ProfileCoalescer: the new users asked within
+    window seconds, up to max_batch, are fetched with a single batch request
+    by fetch(senders) and created by save(senders, profiles), both coroutines
+    """
+    def __init__(self, fetch, save, window=0.05, max_batch=50):
+        self.fetch = fetch
+        self.save = save
+        self.window = window
+        self.max_batch = max_batch
+
+        self._keys = []
+        self._pending = {}
+        self._timer = None
+
+        self.batches = 0
+        self.keys = 0
+        self.largest = 0
+        self.failures = 0
+
+    async def get(self, sender):
+        """
+        Returns the new user of a sender, created along with the ones asked meanwhile
+        """
+        future = self._pending.get(sender)
+        if future is None:
+            loop = asyncio.get_event_loop()
+            future = self._pending[sender] = loop.create_future()
+            self._keys.append(sender)
+            if len(self._keys) >= self.max_batch:
+                self._flush()
+            elif self._timer is None:
+                self._timer = loop.call_later(self.window, self._flush)
+        # A cancelled request does not cancel the batch of the others
+        return await asyncio.shield(future)
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        keys, self._keys = self._keys, []
+        if keys:
+            asyncio.ensure_future(self._load(keys))
+
+    async def _load(self, keys):
+        self.batches += 1
+        self.keys += len(keys)
+        self.largest = max(self.largest, len(keys))
+        users = {}
+        try:
+            profiles = await self.fetch(keys)
+            users = await self.save(keys, profiles) or {}
+        except Exception:
+            self.failures += 1
+            print(traceback.format_exc())
+        finally:
+            for key in keys:
+                future = self._pending.pop(key)
+                if not future.done():
+                    future.set_result(users.get(key))
+
+    def stats(self):
+        return {'batches': self.batches, 'keys': self.keys, 'largest': self.largest, 'failures': self.failures}
+
+
+class AsyncBot(object):
+    """
+    Webhook handlers of the async mode, events of different senders run at
+    the same time and the events of a sender one after another
+    """
+    def __init__(self, threads=db_threads, senders=async_senders, connections=graph_connections):
+        self.threads = threads
+        self.senders = senders
+        self.connections = connections
+
+        self.executor = None
+        self.session = None
+        self.delivery = None
+        self.profiles = ProfileBatcher(self.fetch_profiles, self.save_users, window=finbot.profile_batch_window)
+
+        self.batches = 0
+        self.events = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.in_flight_max = 0
+
+    async def start(self, app=None):
+        """
+        Creates the HTTP session and takes over the replies of messages
+        """
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.connections),
+                                             timeout=aiohttp.ClientTimeout(total=messages.delivery.timeout))
+        self.delivery = AsyncDelivery(self.session, messages.delivery.url, messages.delivery.stats,
+                                      shards=self.senders, max_retries=messages.delivery.max_retries,
+                                      backoff=messages.delivery.backoff)
+        self.delivery.start(asyncio.get_event_loop())
+        messages.delivery.forward = self.delivery.forward
+        if finbot.scheduler_enabled:
+            finbot.recurring_scheduler.start()
+
+    async def close(self, app=None):
+        messages.delivery.forward = None
+        await self.delivery.drain(5)
+        self.delivery.close()
+        await self.session.close()
+        self.executor.shutdown(wait=False)
+
+    def run_db(self, function, *args):
+        """
+        Runs a blocking function inside the app context, on a database thread
+        """
+        return asyncio.get_event_loop().run_in_executor(self.executor, in_app_context, function, args)
+
+    async def fetch_profiles(self, senders):
+        """
+        Returns {sender: profile} of several users with a single batch request
+        """
+        start = time.perf_counter()
+        try:
+            async with self.session.post('{}/'.format(messages.graph_url), data=messages.profile_batch(senders),
+                                         timeout=aiohttp.ClientTimeout(total=finbot.profile_timeout)) as r:
+                responses = await r.json(content_type=None)
+                metrics.observe_graph('profile_batch', r.status, time.perf_counter() - start)
+                if r.status != 200:
+                    return {}
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            metrics.observe_graph('profile_batch', 'error', time.perf_counter() - start)
+            print(traceback.format_exc())
+            return {}
+        except ValueError:
+            print(traceback.format_exc())
+            return {}
+        return messages.read_profile_batch(senders, responses)
+
+    async def save_users(self, senders, profiles):
+        return await self.run_db(finbot.insert_users, senders, profiles)
+
+    async def ensure_user(self, sender):
+        """
+        Caches the user of a sender, so no database thread waits on the Graph API for it
+        """
+        if finbot.user_cache.peek(sender) is not None:
+            return
+        user = await self.run_db(finbot.find_user, sender)
+        if user is None:
+            user = await self.profiles.get(sender)
+        if user is not None:
+            finbot.user_cache.set(sender, user)
+
+    async def handle_event(self, event):
+        if 'message' not in event and 'postback' not in event:
+            # Delivery and read receipts have nothing to answer
+            return
+        await self.ensure_user(event['sender']['id'])
+        await self.run_db(finbot.handle_event, event)
+
+    async def run_sender(self, events):
+        """
+        Handles the events of a sender in order, returns the failures and the time spent
+        """
+        start = time.time()
+        failed = 0
+        for event in events:
+            try:
+                await self.handle_event(event)
+            except Exception:
+                failed += 1
+                print(traceback.format_exc())  # something went wrong
+        return failed, time.time() - start
+
+    async def dispatch(self, data):
+        """
+        Handles every event of a webhook payload and returns a BatchReport
+        """
+        start = time.time()
+        report = BatchReport()
+        report.entries, groups = EventDispatcher.group_by_sender(data)
+        report.senders = len(groups)
+        report.events = sum(len(events) for events in groups.values())
+
+        self.in_flight += report.events
+        self.in_flight_max = max(self.in_flight_max, self.in_flight)
+        try:
+            results = await asyncio.gather(*[self.run_sender(events) for events in groups.values()])
+        finally:
+            self.in_flight -= report.events
+
+        for sender, (failed, elapsed) in zip(groups, results):
+            report.failed += failed
+            report.sender_elapsed[sender] = elapsed
+        report.elapsed = time.time() - start
+
+        self.batches += 1
+        self.events += report.events
+        self.failed += report.failed
+        return report
+
+    async def webhook(self, request):
+        if request.method == 'GET':  # For the initial verification
+            if request.query.get('hub.verify_token') == os.environ.get('FB_VERIFY_TOKEN'):
+                return web.Response(text=request.query.get('hub.challenge', ''))
+            return web.Response(text='Wrong Verify Token')
+
+        try:
+            body = await request.read()
+            with metrics.stage_seconds.time(stage='parse'):
+                data = json.loads(body.decode())
+            with metrics.stage_seconds.time(stage='dispatch'):
+                report = await self.dispatch(data)
+            finbot.app.logger.debug(report)
+        except Exception:
+            print(traceback.format_exc())  # something went wrong
+        return web.Response(text='Nothing')
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'events': self.events,
+            'failed': self.failed,
+            'in_flight': self.in_flight,
+            'in_flight_max': self.in_flight_max,
+            'delivery_depth': self.delivery.depth() if self.delivery else 0,
+        }
+
+
+async def observe_request(request, handler):
+    """
+    Request histogram of the async mode, the same one of the gunicorn app
+    """
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as error:
+        status = error.status
+        raise
+    finally:
+        resource = request.match_info.route.resource
+        endpoint = resource.canonical if resource is not None else 'unknown'
+        metrics.requests_seconds.observe(time.perf_counter() - start, endpoint=endpoint,
+                                         method=request.method, status=status)
+
+
+async def index(request):
+    return web.Response(text='Finbot')
+
+
+async def metrics_page(request):
+    """
+    Prometheus metrics, protected by FINBOT_METRICS_TOKEN when it is set
+    """
+    if finbot.metrics_token and \
+            request.headers.get('Authorization', '') != 'Bearer {}'.format(finbot.metrics_token):
+        return web.Response(text='Forbidden', status=403)
+    return web.Response(body=metrics.registry.render().encode('utf-8'),
+                        headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+
+def create_app(bot=None):
+    """
+    Returns the aiohttp application of the webhook
+    """
+    if web is None:
+        raise RuntimeError('The async mode needs aiohttp, pip install aiohttp')
+
+    bot = bot or AsyncBot()
+    app = web.Application(middlewares=[web.middleware(observe_request)])
+    app.router.add_route('GET', '/', index)
+    app.router.add_route('GET', '/webhook', bot.webhook)
+    app.router.add_route('POST', '/webhook', bot.webhook)
+    app.router.add_route('GET', '/metrics', metrics_page)
+    app.on_startup.append(bot.start)
+    app.on_cleanup.append(bot.close)
+    metrics.registry.register_stats('finbot_async', 'Async mode', bot.stats)
+    metrics.registry.register_stats('finbot_async_profiles', 'Coalesced profile requests of the async mode',
+                                    bot.profiles.stats)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves the webhook from an asyncio event loop')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 8000)))
+    args = parser.parse_args()
+    if web is None:
+        parser.error('the async mode needs aiohttp, pip install aiohttp')
+
+    # Creates the missing tables and updates the existing ones
+    migrations.upgrade(finbot.db.engine, finbot.db.metadata)
+    web.run_app(create_app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
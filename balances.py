@@ -0,0 +1,55 @@
+"""
+Daily prefix sums of the entries of an user, the balance at any date is the
+one of the last day with entries up to it
+"""
+from bisect import bisect_right
+
+
+def signed_value(entry_type, value):
+    """
+    Deposits add to the balance, withdrawals subtract from it
+    """
+    return -(value or 0.0) if entry_type == 'withdrawal' else (value or 0.0)
+
+
+def running_totals(rows):
+    """
+    Turns (user_id, day, delta) rows, sorted by user and day, into
+    (user_id, day, delta, balance) rows
+    """
+    current_user = None
+    balance = 0.0
+    for user_id, day, delta in rows:
+        if user_id != current_user:
+            current_user = user_id
+            balance = 0.0
+        balance += delta
+        yield user_id, day, delta, balance
+
+
+class BalanceIndex(object):
+    """
+    Sorted days of an user with the balance at the end of each one
+    """
+    def __init__(self, rows):
+        self.days = []
+        self.balances = []
+        for day, balance in rows:
+            self.days.append(day)
+            self.balances.append(balance)
+
+    def at(self, day):
+        """
+        Balance at the end of a day
+        """
+        position = bisect_right(self.days, day)
+        return self.balances[position - 1] if position else 0.0
+
+    def delta(self, start, end):
+        """
+        Sum of the entries after the start day, up to the end day
+        """
+        return self.at(end) - self.at(start)
+
+    def __len__(self):
+        return len(self.days)
@@ -0,0 +1,86 @@
+"""
+Compares the keyword automaton with the previous loop over every keyword.
+
+    python benchmarks/bench_intents.py [--intents 200] [--synonyms 5] [--messages 20000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from intents import KeywordAutomaton  # noqa: E402
+from messages import chat_keywords  # noqa: E402
+
+words = ['quanto', 'gastei', 'com', 'mercado', 'saldo', 'resumo', 'desfazer', 'conta', 'luz', 'categoria',
+         'mês', 'semana', 'ontem', 'hoje', 'almoço', 'jantar', 'uber', 'farmácia', 'salário', 'aluguel']
+
+
+def legacy_match(keywords, message):
+    """
+    The previous define_response_by_keyword
+    """
+    for key in keywords:
+        for value in keywords[key]:
+            if value in message.lower():
+                return key
+
+
+def generate(intents, synonyms, messages, seed=42):
+    """
+    Returns synthetic keywords of many intents and messages that use them
+    """
+    rng = random.Random(seed)
+    keywords = dict((intent, list(phrases)) for intent, phrases in chat_keywords.items())
+    for index in range(intents):
+        keywords['intent_{}'.format(index)] = ['{} {} {}'.format(rng.choice(words), rng.choice(words), index)
+                                               for _ in range(synonyms)]
+
+    phrases = [phrase for values in keywords.values() for phrase in values]
+    corpus = []
+    for _ in range(messages):
+        text = ' '.join(rng.choice(words) for _ in range(rng.randint(3, 12)))
+        if rng.random() < 0.5:
+            text += ' ' + rng.choice(phrases)
+        corpus.append(text.capitalize())
+    return keywords, corpus
+
+
+def measure(function, corpus, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for message in corpus:
+            function(message)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--intents', type=int, default=200)
+    parser.add_argument('--synonyms', type=int, default=5)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    keywords, corpus = generate(args.intents, args.synonyms, args.messages)
+    start = time.perf_counter()
+    automaton = KeywordAutomaton(keywords)
+    build = time.perf_counter() - start
+
+    legacy = measure(lambda message: legacy_match(keywords, message), corpus, args.repeat)
+    current = measure(automaton.match, corpus, args.repeat)
+    count = sum(len(phrases) for phrases in keywords.values())
+    print('{} keywords, {} messages, best of {}'.format(count, len(corpus), args.repeat))
+    print('build      {:.3f}s'.format(build))
+    print('legacy     {:.3f}s  {:.2f}us/message'.format(legacy, legacy / len(corpus) * 1e6))
+    print('automaton  {:.3f}s  {:.2f}us/message'.format(current, current / len(corpus) * 1e6))
+    print('speedup    {:.2f}x'.format(legacy / current))
+
+
+if __name__ == '__main__':
+    main()
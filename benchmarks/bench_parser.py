@@ -0,0 +1,116 @@
+"""
+Compares the entry parser with the previous regex and str.replace parsing.
+
+    python benchmarks/bench_parser.py [--messages 100000] [--repeat 3]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from datediscover import months  # noqa: E402
+from entryparser import parse_entry  # noqa: E402
+from messages import chat_responses  # noqa: E402
+
+descriptions = ['Almoço', 'Café da manhã', 'Jantar', 'Conta de luz', 'Mensalidade da academia',
+                'Supermercado', 'Uber para o trabalho', 'Farmácia', 'Cinema com amigos', 'Salário']
+values = ['20 reais', '20,90', 'R$ 20,50', 'R$ 99', '1.234,56', '7.5', 'R$ 1500']
+dates = ['dia 10', '10 de dezembro', '10/12', '25/10', '5 de março de 2016', '1/2/16', '']
+
+
+def legacy_get_month(raw):
+    for index, month in enumerate(months, start=1):
+        if month in raw.lower():
+            return index
+    return None
+
+
+def legacy_get_date(raw, today):
+    numbers = re.findall(r'\d*\d+', raw)
+    month = legacy_get_month(raw)
+    year = day = None
+    if len(numbers) > 0:
+        day = int(numbers[0])
+    if len(numbers) > 1:
+        if not month:
+            month = int(numbers[1])
+        else:
+            year = int(numbers[1])
+    if len(numbers) > 2:
+        year = int(numbers[2])
+    return today.replace(year=year or today.year, month=month or today.month, day=day or today.day)
+
+
+def legacy_parse(text, today):
+    """
+    The parsing done by verify_new_entry, handle_value and get_date before
+    """
+    for value in re.findall(r'\d+(?:\,\d{2})?', text):
+        text = text.replace(value, value.replace(',', '.'))
+    parts = [part.strip() for part in text.split(',')]
+    if len(parts) < 2:
+        return None
+    try:
+        value = float(re.findall(r'[-+]?\d*\.\d+|\d+', parts[1])[0])
+    except IndexError:
+        return None
+    entry_date = legacy_get_date(parts[2], today) if len(parts) > 2 else None
+    return parts[0], value, entry_date
+
+
+def corpus(size, seed=42):
+    """
+    Realistic messages, including the examples sent to the users
+    """
+    rng = random.Random(seed)
+    messages = list(chat_responses['wrong_formatted_entry_exemple'])
+    while len(messages) < size:
+        parts = [rng.choice(descriptions), rng.choice(values)]
+        entry_date = rng.choice(dates)
+        if entry_date:
+            parts.append(entry_date)
+        messages.append(', '.join(parts))
+    return messages
+
+
+def measure(function, messages, today, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for message in messages:
+            function(message, today)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    today = date(2016, 11, 20)
+    messages = corpus(args.messages)
+
+    # Both parsers agree on the examples sent to the users
+    for example in chat_responses['wrong_formatted_entry_exemple']:
+        entry = parse_entry(example, today)
+        assert (entry.description, entry.value, entry.date) == legacy_parse(example, today), example
+
+    legacy = measure(legacy_parse, messages, today, args.repeat)
+    current = measure(parse_entry, messages, today, args.repeat)
+    print('{} messages, best of {}'.format(len(messages), args.repeat))
+    print('legacy  {:.3f}s  {:.2f}us/message'.format(legacy, legacy / len(messages) * 1e6))
+    print('parser  {:.3f}s  {:.2f}us/message'.format(current, current / len(messages) * 1e6))
+    print('speedup {:.2f}x'.format(legacy / current))
+
+
+if __name__ == '__main__':
+    main()
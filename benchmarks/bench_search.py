@@ -0,0 +1,115 @@
+"""
+Compares the full-text index of the descriptions with the LIKE scan over the
+entries of the user, on a ledger of synthetic finished entries.
+
+    python benchmarks/bench_search.py [--rows 1000000] [--users 10] [--queries 200]
+
+The ledger is written to a temporary SQLite file, building a million rows and
+their index takes a little while.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+words = ['Almoço', 'Jantar', 'Café', 'Mercado', 'Padaria', 'Uber', 'Táxi', 'Farmácia', 'Aluguel', 'Conta',
+         'luz', 'água', 'internet', 'Cinema', 'Academia', 'Presente', 'Salário', 'Shopping', 'Posto',
+         'gasolina', 'Estacionamento', 'Restaurante', 'japonês', 'pizza', 'Lanche', 'Sorvete', 'Livraria',
+         'Pet', 'shop', 'Feira', 'Açougue', 'Hortifruti', 'Dentista', 'Médico', 'Escola', 'Curso', 'Viagem',
+         'Hotel', 'Passagem', 'Seguro']
+queries = ['almoço', 'uber', 'conta de luz', 'farmácia', 'pizza', 'restaurante japonês', 'hotel',
+           'açougue', 'passagem', 'pet shop']
+
+
+def generate(path, rows, users, seed=42):
+    """
+    Writes rows finished entries of the users straight with sqlite3, the ORM
+    would take minutes
+    """
+    rng = random.Random(seed)
+    connection = sqlite3.connect(path)
+    connection.executemany('INSERT INTO user (id, facebook_id, first_name) VALUES (?, ?, ?)',
+                           [(user_id, 10 ** 12 + user_id, 'Usuário {}'.format(user_id))
+                            for user_id in range(1, users + 1)])
+    batch = []
+    for index in range(rows):
+        description = ' '.join(rng.choice(words) for _ in range(rng.randint(1, 3)))
+        entry_type = 'deposit' if rng.random() < 0.1 else 'withdrawal'
+        date_time = '2016-{:02d}-{:02d} 00:00:00.000000'.format(rng.randint(1, 12), rng.randint(1, 28))
+        batch.append((index % users + 1, description, round(rng.uniform(1, 500), 2), date_time, entry_type))
+        if len(batch) == 10000:
+            connection.executemany("INSERT INTO budget (user_id, description, value, date_time, entry_type, status) "
+                                   "VALUES (?, ?, ?, ?, ?, 'done')", batch)
+            batch = []
+    if batch:
+        connection.executemany("INSERT INTO budget (user_id, description, value, date_time, entry_type, status) "
+                               "VALUES (?, ?, ?, ?, ?, 'done')", batch)
+    connection.commit()
+    connection.close()
+
+
+def measure(search, conn, user_ids, repeat, use_index):
+    """
+    Returns the best time of the queries and the matches found
+    """
+    best = None
+    found = 0
+    for _ in range(repeat):
+        found = 0
+        start = time.perf_counter()
+        for number, user_id in enumerate(user_ids):
+            found += search.search(conn, user_id, queries[number % len(queries)], use_index=use_index).count
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'search.db')
+    os.environ['DATABASE_URL'] = 'sqlite:///{}'.format(path)
+
+    import finbot
+    import search
+
+    warnings.simplefilter('ignore')
+    with finbot.app.app_context():
+        finbot.migrations.upgrade(finbot.db.engine, finbot.db.metadata)
+
+    start = time.perf_counter()
+    generate(path, args.rows, args.users)
+    generated = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with finbot.db.engine.begin() as conn:
+        search.rebuild(conn)
+    indexed = time.perf_counter() - start
+
+    user_ids = [number % args.users + 1 for number in range(args.queries)]
+    with finbot.db.engine.connect() as conn:
+        conn.execute(finbot.db.text('ANALYZE'))
+        like, like_found = measure(search, conn, user_ids, args.repeat, False)
+        fts, fts_found = measure(search, conn, user_ids, args.repeat, True)
+
+    print('{} entries of {} users, {} queries, best of {}'.format(args.rows, args.users, args.queries, args.repeat))
+    print('generate   {:.1f}s'.format(generated))
+    print('index      {:.1f}s'.format(indexed))
+    print('like       {:.3f}s  {:.2f}ms/query  {} matches'.format(like, like / args.queries * 1e3, like_found))
+    print('fts        {:.3f}s  {:.2f}ms/query  {} matches'.format(fts, fts / args.queries * 1e3, fts_found))
+    print('speedup    {:.2f}x'.format(like / fts))
+
+
+if __name__ == '__main__':
+    main()
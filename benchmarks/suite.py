@@ -0,0 +1,244 @@
+"""
+Microbenchmarks of the hot paths of the bot, with regression thresholds.
+
+Runs offline against an in-memory SQLite database, with the replies and the
+Graph API profile calls stubbed. Results are compared with a JSON baseline
+and the run fails when a case is slower than the baseline by more than the
+threshold.
+
+    python benchmarks/suite.py --save                # records the baseline
+    python benchmarks/suite.py [--threshold 25]      # compares with it
+    python benchmarks/suite.py --filter webhook      # only matching cases
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import warnings
+
+from datetime import date, datetime
+
+os.environ['FINBOT_DELIVERY_SYNC'] = '1'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import finbot  # noqa: E402
+import messages  # noqa: E402
+from finbot import app, db, Budget, Category, User  # noqa: E402
+
+default_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+categories = ', '.join('Categoria {}'.format(index) for index in range(30))
+
+
+class Case(object):
+    """
+    A benchmark case, setup prepares each call and is not measured
+    """
+    def __init__(self, name, run, setup=None, number=500):
+        self.name = name
+        self.run = run
+        self.setup = setup
+        self.number = number
+
+    def measure(self, repeat):
+        """
+        Returns the best time by call, in seconds
+        """
+        best = None
+        for _ in range(repeat):
+            total = 0.0
+            for index in range(self.number):
+                argument = self.setup(index) if self.setup else None
+                start = time.perf_counter()
+                self.run(argument)
+                total += time.perf_counter() - start
+            best = total / self.number if best is None else min(best, total / self.number)
+        return best
+
+
+def stub_externals():
+    """
+    Replaces the Graph API calls, the payloads are still encoded
+    """
+    messages.delivery.synchronous = True
+    messages.delivery.transport = lambda payload: (isinstance(payload, bytes) or len(json.dumps(payload))) and 200
+    profile = {'first_name': 'Bench', 'last_name': 'Mark', 'profile_pic': '', 'locale': 'pt_BR',
+               'timezone': -3, 'gender': 'male'}
+    finbot.get_user_profile = lambda sender: profile
+    finbot.get_user_profiles = lambda senders, timeout=None: dict((sender, profile) for sender in senders)
+
+
+def create_user(facebook_id, with_categories=True):
+    user = User()
+    user.facebook_id = facebook_id
+    db.session.add(user)
+    db.session.commit()
+    if with_categories:
+        finbot.save_categories(user.id, categories)
+    finbot.change_conversation_status(user.id, finbot.get_conversation_status(user.id))
+    return user.id
+
+
+def clear_entries(user_id):
+    finbot.get_entry_query(user_id, 'draft').delete(synchronize_session=False)
+    finbot.get_entry_query(user_id, 'revision').delete(synchronize_session=False)
+    db.session.commit()
+
+
+def create_entry(user_id, status):
+    """
+    Creates the draft or revision entry the conversation is waiting for
+    """
+    clear_entries(user_id)
+    entry = Budget()
+    entry.user_id = user_id
+    entry.entry_type = 'withdrawal'
+    entry.category_id = Category.query.filter_by(user_id=user_id).first().id
+    entry.description = 'Almoço'
+    entry.value = 20.0
+    entry.date_time = datetime.now()
+    entry.status = status
+    db.session.add(entry)
+    db.session.commit()
+
+
+messages_sent = iter(range(1, 10 ** 9))
+
+
+def webhook_event(sender, text=None, quick_reply=None, postback=None):
+    """
+    Returns a webhook body, every event has its own message id and timestamp
+    """
+    number = next(messages_sent)
+    event = {'sender': {'id': sender}, 'recipient': {'id': '0'}, 'timestamp': number}
+    if postback:
+        event['postback'] = {'payload': postback}
+    else:
+        event['message'] = {'mid': 'mid.{}'.format(number), 'text': text or quick_reply}
+        if quick_reply:
+            event['message']['quick_reply'] = {'payload': quick_reply}
+    return json.dumps({'object': 'page', 'entry': [{'id': '0', 'messaging': [event]}]})
+
+
+def webhook_cases(client):
+    """
+    One case by conversation status, each call starts from that status
+    """
+    sender = 900
+    user_id = create_user(sender)
+
+    def post(body):
+        client.post('/webhook', data=body)
+
+    def in_status(status, entry_status=None, **event):
+        def setup(index):
+            if entry_status:
+                create_entry(user_id, entry_status)
+            else:
+                clear_entries(user_id)
+            finbot.change_conversation_status(user_id, status)
+            return webhook_event(sender, **event)
+        return setup
+
+    new_users = iter(range(10 ** 6, 10 ** 7))
+    repeated = webhook_event(sender, quick_reply='list_categories')
+    return [
+        Case('webhook init', post, lambda index: webhook_event(next(new_users), 'Oi'), number=200),
+        Case('webhook begin_add_category', post,
+             in_status('begin_add_category', text='Casa, Lazer, Mercado'), number=200),
+        Case('webhook waiting', post, in_status('waiting', quick_reply='list_categories'), number=200),
+        Case('webhook waiting withdrawal', post, in_status('waiting', quick_reply='withdrawal'), number=200),
+        Case('webhook waiting search', post, in_status('waiting', text='Quanto gastei com jantar?'), number=200),
+        Case('webhook begin_add_data', post,
+             in_status('begin_add_data', 'draft', quick_reply='Categoria 1'), number=200),
+        Case('webhook draft_add_data', post,
+             in_status('draft_add_data', 'draft', text='Jantar, R$ 20,50, 10/12'), number=200),
+        Case('webhook confirm_add_data', post,
+             in_status('confirm_add_data', 'revision', postback='finalize'), number=200),
+        Case('webhook repeated event', post, lambda index: repeated, number=2000),
+    ]
+
+
+def cases(client):
+    user_id = create_user(800)
+    category_names = [c.name for c in Category.query.filter_by(user_id=user_id)]
+    new_users = iter(range(10 ** 7, 10 ** 8))
+    today = date.today()
+
+    def verify_new_entry(argument):
+        finbot.verify_new_entry(user_id, '800', 'Café da manhã, 20,90, 10 de dezembro', 'confirm_add_data')
+
+    return [
+        Case('handle_value', lambda argument: finbot.handle_value('R$ 20.50'), number=20000),
+        Case('get_date', lambda argument: finbot.get_date('10 de dezembro'), number=20000),
+        Case('verify_new_entry', verify_new_entry, lambda index: create_entry(user_id, 'revision')),
+        Case('get_quick_replies default', lambda argument: messages.get_quick_replies(), number=20000),
+        Case('category_replies cached', lambda argument: finbot.category_replies.get(user_id), number=20000),
+        Case('get_category_replies', lambda argument: finbot.get_category_replies(user_id), number=2000),
+        Case('get_quick_replies categories',
+             lambda argument: messages.get_quick_replies('begin_add_data', categories=category_names),
+             number=20000),
+        Case('send_quick_replies categories',
+             lambda argument: messages.send_quick_replies('800', 'Escolha', 'begin_add_data',
+                                                          categories=category_names),
+             number=5000),
+        Case('send_buttons', lambda argument: messages.send_buttons('800', 'Está correto?'), number=5000),
+        Case('balance_at cached', lambda argument: finbot.balance_at(user_id, today), number=20000),
+        Case('save_categories existing', lambda argument: finbot.save_categories(user_id, categories)),
+        Case('save_categories new user', lambda user: finbot.save_categories(user, categories),
+             lambda index: create_user(next(new_users), with_categories=False), number=100),
+    ] + webhook_cases(client)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--baseline', default=default_baseline, help='JSON file with the baseline')
+    parser.add_argument('--save', action='store_true', help='stores the results as the baseline')
+    parser.add_argument('--threshold', type=float, default=25.0, help='accepted slowdown, in percent')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--filter', default='', help='only the cases with this text in the name')
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    stub_externals()
+
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = {}
+    regressions = []
+    with app.app_context():
+        db.create_all()
+        client = app.test_client()
+        for case in cases(client):
+            if args.filter not in case.name:
+                continue
+            elapsed = case.measure(args.repeat)
+            results[case.name] = elapsed
+
+            previous = baseline.get(case.name)
+            change = ''
+            if previous:
+                percent = (elapsed - previous) / previous * 100
+                change = '{:+.1f}%'.format(percent)
+                if percent > args.threshold:
+                    regressions.append(case.name)
+                    change += ' REGRESSION'
+            print('{:32} {:10.2f}us  {}'.format(case.name, elapsed * 1e6, change))
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+        print('Baseline saved on {}'.format(args.baseline))
+
+    if regressions and not args.save:
+        print('{} cases slower than the baseline by more than {}%'.format(len(regressions), args.threshold))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import atexit
+import os
+import threading
+import time
+import traceback
+
+
+class LocalStateBackend(object):
+    """
+    In-process store of the conversation states.
+
+    A shared store (like Redis) must implement the same get/set/delete methods
+    to keep the states consistent among several gunicorn workers.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at is not None and expires_at <= time.time():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class ConversationStore(object):
+    """
+    Keeps the status of the conversations in memory, backed by the database.
+
+    The loader returns the persisted status of an user and the persister saves
+    a dict of {user_id: status}. On 'write-through' mode every change is saved
+    right away, on 'write-behind' mode the changes are saved in batches by a
+    background thread every flush_interval seconds. A ttl of 0 disables the
+    in-memory copy, None keeps it forever.
+    """
+    WRITE_THROUGH = 'write-through'
+    WRITE_BEHIND = 'write-behind'
+
+    def __init__(self, loader, persister, backend=None, ttl=None, mode=WRITE_THROUGH, flush_interval=1.0):
+        if mode not in (self.WRITE_THROUGH, self.WRITE_BEHIND):
+            raise ValueError('Unknown persistence mode: {}'.format(mode))
+
+        self.loader = loader
+        self.persister = persister
+        self.backend = backend or LocalStateBackend()
+        self.ttl = ttl
+        self.mode = mode
+        self.flush_interval = flush_interval
+
+        self._lock = threading.Lock()
+        self._dirty = {}
+        self._flusher = None
+        self._pid = None
+
+        self.loads = 0
+        self.flushes = 0
+
+    def _remember(self, user_id, status):
+        if self.ttl != 0:
+            self.backend.set(user_id, status, self.ttl)
+
+    def get(self, user_id):
+        """
+        Returns the status of the conversation with an user
+        """
+        with self._lock:
+            status = self._dirty.get(user_id)
+        if status is None:
+            status = self.backend.get(user_id)
+        if status is None:
+            status = self.loader(user_id)
+            self.loads += 1
+            self._remember(user_id, status)
+        return status
+
+    def set(self, user_id, status):
+        """
+        Changes the status of the conversation with an user
+        """
+        if self.mode == self.WRITE_THROUGH:
+            self.persister({user_id: status})
+            self._remember(user_id, status)
+            return
+
+        with self._lock:
+            self._dirty[user_id] = status
+        self._remember(user_id, status)
+        self._start()
+
+    def forget(self, user_id):
+        """
+        Drops the in-memory status, next read comes from the database
+        """
+        self.backend.delete(user_id)
+
+    def _start(self):
+        """
+        Starts the flusher thread, also after the process was forked by gunicorn
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._flusher = threading.Thread(target=self._run, name='finbot-conversations')
+            self._flusher.daemon = True
+            self._flusher.start()
+            atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """
+        Saves the pending changes in a single batch
+        """
+        with self._lock:
+            batch, self._dirty = self._dirty, {}
+        if not batch:
+            return
+
+        try:
+            self.persister(batch)
+            self.flushes += 1
+        except Exception:
+            print(traceback.format_exc())
+            # Keeps the changes for the next flush, unless newer ones arrived
+            with self._lock:
+                for user_id, status in batch.items():
+                    self._dirty.setdefault(user_id, status)
+
+    def pending(self):
+        with self._lock:
+            return len(self._dirty)
@@ -2,6 +2,8 @@ import re
 
 from datetime import date
 
+from normalize import strip_accents
+
 months = [
     'janeiro',
     'fevereiro',
@@ -17,20 +19,33 @@ months = [
     'dezembro'
 ]
 
+# Month by its name, with and without accents
+month_lookup = {}
+for index, month in enumerate(months, start=1):
+    month_lookup[month] = index
+    month_lookup[strip_accents(month)] = index
+
+numbers_pattern = re.compile(r'\d+')
+words_pattern = re.compile(r'\w+')
+
+
 def get_month(raw):
     """
     Return the month from a raw string
     """
-    for index, month in enumerate(months, start=1):
-        if month in raw.lower():
-            return index
+    for word in words_pattern.findall(raw.lower()):
+        month = month_lookup.get(word)
+        if month:
+            return month
     return None
 
-def get_date(raw):
+
+def get_date(raw, today=None):
     """
     Return date object from a raw string
     """
-    numbers = re.findall('\d*\d+', raw)
+    today = today or date.today()
+    numbers = numbers_pattern.findall(raw)
 
     month = None
     year = None
@@ -52,10 +67,13 @@ def get_date(raw):
         year = int(numbers[2])
 
     if not day:
-        day = date.today().day
+        day = today.day
     if not month:
-        month = date.today().month
+        month = today.month
     if not year:
-        year = date.today().year
+        year = today.year
+    elif year < 100:
+        # Two digits year, like 10/12/16
+        year += 2000
 
-    return date.today().replace(year=year, month=month, day=day)
+    return date(year, month, day)
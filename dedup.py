@@ -0,0 +1,76 @@
+"""
+Recognizes the webhook events Facebook delivers more than once
+"""
+import hashlib
+import threading
+import time
+
+from collections import OrderedDict
+
+
+def event_key(event):
+    """
+    Returns the identity of a messaging event: the message id, or the sender
+    and timestamp of a postback. None for the events without one.
+    """
+    sender = event.get('sender', {}).get('id')
+    if 'message' in event:
+        mid = event['message'].get('mid')
+        if mid:
+            return 'mid:{}'.format(mid)
+        kind = 'message'
+    elif 'postback' in event:
+        kind = 'postback'
+    else:
+        return None
+
+    timestamp = event.get('timestamp')
+    if sender is None or timestamp is None:
+        return None
+    return '{}:{}:{}'.format(kind, sender, timestamp)
+
+
+def hash_key(key):
+    """
+    Fixed size version of a key, as stored in the database
+    """
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class RecentKeys(object):
+    """
+    Bounded window of the keys seen lately, oldest ones leave first
+    """
+    def __init__(self, maxsize=10000, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self.added = 0
+        self.repeated = 0
+
+    def add(self, key):
+        """
+        Adds a key, returns False when it was already in the window
+        """
+        now = time.time()
+        with self._lock:
+            seen_at = self._data.get(key)
+            if seen_at is not None and now - seen_at < self.ttl:
+                self.repeated += 1
+                return False
+            self._data[key] = now
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            self.added += 1
+            return True
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'maxsize': self.maxsize,
+                    'added': self.added, 'repeated': self.repeated}
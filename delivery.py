@@ -0,0 +1,215 @@
+import atexit
+import os
+import queue
+import threading
+import time
+import traceback
+import zlib
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+json_headers = {'Content-Type': 'application/json'}
+
+
+class DeliveryStats(object):
+    """
+    Counters about the outbound deliveries
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.enqueued = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def observe_latency(self, seconds):
+        with self._lock:
+            self.latency_total += seconds
+            if seconds > self.latency_max:
+                self.latency_max = seconds
+
+    def as_dict(self):
+        with self._lock:
+            done = self.sent + self.failed
+            return {
+                'enqueued': self.enqueued,
+                'sent': self.sent,
+                'failed': self.failed,
+                'retried': self.retried,
+                'dropped': self.dropped,
+                'latency_avg': self.latency_total / done if done else 0.0,
+                'latency_max': self.latency_max,
+            }
+
+
+class DeliveryQueue(object):
+    """
+    Queue of outbound payloads drained by a pool of worker threads.
+
+    Each recipient is always routed to the same worker, so the messages to a
+    user keep the order they were enqueued. Every worker keeps its own
+    keep-alive session with the Graph API. Enqueuing never blocks, the
+    payloads beyond maxsize are dropped and counted.
+    """
+    def __init__(self, url, workers=4, maxsize=1000, max_retries=3, backoff=0.5,
+                 timeout=10, synchronous=False, transport=None):
+        self.url = url
+        self.workers = max(1, workers)
+        self.maxsize = maxsize
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.synchronous = synchronous
+        self.transport = transport or self._post
+        self.stats = DeliveryStats()
+        # forward(recipient, payload) takes the payloads instead of the workers,
+        # the async mode posts them from its event loop
+        self.forward = None
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._queues = []
+        self._shard_size = None
+        self._threads = []
+        self._pid = None
+
+    def session(self):
+        """
+        Returns the pooled session of the current thread
+        """
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._local.session = session
+        return session
+
+    def _post(self, payload):
+        """
+        Posts the payload, a dict or JSON already encoded, to the Graph API and
+        returns the status code
+        """
+        if isinstance(payload, bytes):
+            r = self.session().post(self.url, data=payload, timeout=self.timeout, headers=json_headers)
+        else:
+            r = self.session().post(self.url, json=payload, timeout=self.timeout)
+        return r.status_code
+
+    def _start(self):
+        """
+        Starts the workers, also after the process was forked by gunicorn
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._shard_size = max(1, self.maxsize // self.workers)
+            self._queues = [queue.Queue(self._shard_size) for _ in range(self.workers)]
+            self._threads = []
+            for shard in self._queues:
+                thread = threading.Thread(target=self._work, args=(shard,), name='finbot-delivery')
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            self._pid = os.getpid()
+
+    def _shard(self, recipient):
+        return self._queues[zlib.crc32(str(recipient).encode()) % len(self._queues)]
+
+    def depth(self):
+        """
+        Number of payloads waiting to be sent
+        """
+        return sum(shard.qsize() for shard in self._queues)
+
+    def enqueue(self, recipient, payload):
+        """
+        Schedules the payload to be delivered to the recipient
+        """
+        self.stats.incr('enqueued')
+        enqueued_at = time.time()
+
+        if self.forward is not None:
+            self.forward(recipient, payload)
+            return
+
+        if self.synchronous:
+            self._deliver(payload, enqueued_at)
+            return
+
+        self._start()
+        try:
+            self._shard(recipient).put_nowait((payload, enqueued_at))
+        except queue.Full:
+            # Waiting would hold the request and sending it here would pass the
+            # replies already queued for the recipient, so it is lost
+            self.stats.incr('dropped')
+
+    def _work(self, shard):
+        while True:
+            payload, enqueued_at = shard.get()
+            try:
+                self._deliver(payload, enqueued_at)
+            finally:
+                shard.task_done()
+
+    def _deliver(self, payload, enqueued_at):
+        """
+        Sends a payload, retrying with exponential backoff
+        """
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.stats.incr('retried')
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            start = time.perf_counter()
+            try:
+                status_code = self.transport(payload)
+            except requests.RequestException:
+                metrics.observe_graph('messages', 'error', time.perf_counter() - start)
+                print(traceback.format_exc())
+                continue
+            except Exception:
+                print(traceback.format_exc())
+                break
+            metrics.observe_graph('messages', status_code, time.perf_counter() - start)
+
+            # Client errors are not going to succeed on a retry
+            if status_code < 500 and status_code != 429:
+                if status_code < 400:
+                    self.stats.incr('sent')
+                else:
+                    self.stats.incr('failed')
+                self.stats.observe_latency(time.time() - enqueued_at)
+                return
+
+        self.stats.incr('failed')
+        self.stats.observe_latency(time.time() - enqueued_at)
+
+    def join(self, timeout=None):
+        """
+        Waits until all the enqueued payloads were delivered
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        for shard in list(self._queues):
+            while shard.unfinished_tasks:
+                if deadline is not None and time.time() >= deadline:
+                    return False
+                time.sleep(0.01)
+        return True
+
+    def register_shutdown(self, timeout=5):
+        """
+        Gives the workers some time to drain the queue when the process exits
+        """
+        atexit.register(self.join, timeout)
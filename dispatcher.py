@@ -0,0 +1,133 @@
+import os
+import threading
+import time
+import traceback
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BatchReport(object):
+    """
+    Timing of a webhook batch
+    """
+    def __init__(self):
+        self.entries = 0
+        self.events = 0
+        self.senders = 0
+        self.failed = 0
+        self.elapsed = 0.0
+        self.sender_elapsed = {}
+
+    def __repr__(self):
+        return '<BatchReport entries={} events={} senders={} failed={} elapsed={:.4f}s>'.format(
+            self.entries, self.events, self.senders, self.failed, self.elapsed)
+
+
+class EventDispatcher(object):
+    """
+    Handles every messaging event of a webhook POST.
+
+    Events are grouped by sender. Different senders run at the same time on a
+    pool of threads, while the events of one sender run one after another, in
+    the order Facebook sent them.
+    """
+    def __init__(self, handler, workers=4, context=None):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.context = context
+
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+        self.batches = 0
+        self.events = 0
+        self.failed = 0
+        self.elapsed_total = 0.0
+        self.elapsed_max = 0.0
+
+    def _pool(self):
+        """
+        Returns the thread pool, created again after gunicorn forks the process
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    @staticmethod
+    def group_by_sender(data):
+        """
+        Returns the events of every entry grouped by the sender id
+        """
+        groups = OrderedDict()
+        entries = data.get('entry', [])
+        for entry in entries:
+            for event in entry.get('messaging', []):
+                sender = event.get('sender', {}).get('id')
+                if sender is None:
+                    continue
+                groups.setdefault(sender, []).append(event)
+        return len(entries), groups
+
+    def _run_sender(self, events):
+        """
+        Handles the events of a sender in order, returns the failures and the time spent
+        """
+        start = time.time()
+        failed = 0
+        for event in events:
+            try:
+                if self.context is not None:
+                    with self.context():
+                        self.handler(event)
+                else:
+                    self.handler(event)
+            except Exception:
+                failed += 1
+                print(traceback.format_exc())  # something went wrong
+        return failed, time.time() - start
+
+    def dispatch(self, data):
+        """
+        Handles every event of a webhook payload and returns a BatchReport
+        """
+        start = time.time()
+        report = BatchReport()
+        report.entries, groups = self.group_by_sender(data)
+        report.senders = len(groups)
+        report.events = sum(len(events) for events in groups.values())
+
+        if len(groups) == 1:
+            # A single sender does not need to leave the request thread
+            results = [(sender, self._run_sender(events)) for sender, events in groups.items()]
+        else:
+            pool = self._pool()
+            futures = [(sender, pool.submit(self._run_sender, events)) for sender, events in groups.items()]
+            results = [(sender, future.result()) for sender, future in futures]
+
+        for sender, (failed, elapsed) in results:
+            report.failed += failed
+            report.sender_elapsed[sender] = elapsed
+        report.elapsed = time.time() - start
+
+        with self._lock:
+            self.batches += 1
+            self.events += report.events
+            self.failed += report.failed
+            self.elapsed_total += report.elapsed
+            self.elapsed_max = max(self.elapsed_max, report.elapsed)
+
+        return report
+
+    def stats(self):
+        with self._lock:
+            return {
+                'batches': self.batches,
+                'events': self.events,
+                'failed': self.failed,
+                'elapsed_avg': self.elapsed_total / self.batches if self.batches else 0.0,
+                'elapsed_max': self.elapsed_max,
+            }
@@ -0,0 +1,73 @@
+"""
+Parser of the entries sent by the users, like 'Jantar, R$ 20,50, 10/12'
+"""
+import re
+
+from collections import namedtuple
+from datetime import date
+from functools import lru_cache
+
+from datediscover import get_date
+
+# The error is None when the entry was parsed, otherwise the reason of the failure
+ParsedEntry = namedtuple('ParsedEntry', ['description', 'value', 'date', 'error'])
+
+# Amounts with decimal comma, like 20,90 or 1.234,56
+amount_pattern = re.compile(r'\d{1,3}(?:\.\d{3})+,\d{2}(?!\d)|\d+,\d{2}(?!\d)')
+value_pattern = re.compile(r'[-+]?(?:\d*\.\d+|\d+)')
+
+
+def decimal_point(match):
+    return match.group().replace('.', '').replace(',', '.')
+
+
+def split_fields(text):
+    """
+    Splits an entry on the commas that are not part of an amount, the amounts
+    get a decimal point instead
+    """
+    if ',' not in text:
+        return [text.strip()]
+    return [field.strip() for field in amount_pattern.sub(decimal_point, text).split(',')]
+
+
+def parse_value(raw):
+    """
+    Returns the first number of a string, None when there is none
+    """
+    match = value_pattern.search(raw)
+    return float(match.group()) if match else None
+
+
+@lru_cache(maxsize=4096)
+def parse_date(raw, today):
+    """
+    Dates are written in a few ways over and over, so they are cached
+    """
+    return get_date(raw, today)
+
+
+def parse_entry(text, today=None):
+    """
+    Parses 'description, value[, date]' into a ParsedEntry. The date is None
+    when the user did not send it.
+    """
+    if not text or not text.strip():
+        return ParsedEntry(None, None, None, 'empty')
+
+    fields = split_fields(text)
+    if len(fields) < 2:
+        return ParsedEntry(fields[0], None, None, 'missing_value')
+
+    value = parse_value(fields[1])
+    if value is None:
+        return ParsedEntry(fields[0], None, None, 'invalid_value')
+
+    entry_date = None
+    if len(fields) > 2 and fields[2]:
+        try:
+            entry_date = parse_date(fields[2], today or date.today())
+        except ValueError:
+            return ParsedEntry(fields[0], value, None, 'invalid_date')
+
+    return ParsedEntry(fields[0], value, entry_date, None)
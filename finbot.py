@@ -1,26 +1,71 @@
+import calendar
 import os
-import requests
 import json
+import csv
+import hashlib
+import io
 import traceback
 import random
 import re
+import time
 
-from datetime import datetime
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
 from sqlalchemy.dialects.mysql import BIGINT
-from flask import Flask, request
+from flask import Flask, Response, g, request, has_app_context, stream_with_context
 
 from messages import send_loading_message, send_message, send_quick_replies, get_response, \
-                     send_text_message, send_buttons
+                     send_text_message, send_buttons, get_user_profile, get_user_profiles, \
+                     split_keyword, encode_quick_replies
 from datediscover import get_date
+from entryparser import parse_entry, parse_value
+from dispatcher import EventDispatcher
+from usercache import CachedUser, UserCache
+from profiles import ProfileCoalescer
+from conversations import ConversationStore
+from unitofwork import UnitOfWork, current_unit
+from normalize import normalize_text
+from dedup import RecentKeys, event_key, hash_key
+from balances import BalanceIndex, running_totals, signed_value
+from scheduler import DueScheduler
+import messages
+import metrics
+import migrations
+import search
+import storage
+import unitofwork
 
 # Configurations
 token = os.environ.get('FB_ACCESS_TOKEN')
-db_file = os.path.realpath('finbot_database.db')
+dispatcher_workers = int(os.environ.get('FINBOT_DISPATCHER_WORKERS', 4))
+user_cache_size = int(os.environ.get('FINBOT_USER_CACHE_SIZE', 10000))
+user_cache_ttl = int(os.environ.get('FINBOT_USER_CACHE_TTL', 3600))
+category_cache_ttl = int(os.environ.get('FINBOT_CATEGORY_CACHE_TTL', 600))
+balance_cache_ttl = int(os.environ.get('FINBOT_BALANCE_CACHE_TTL', 600))
+profile_refresh_days = int(os.environ.get('FINBOT_PROFILE_REFRESH_DAYS', 30))
+profile_batch_window = float(os.environ.get('FINBOT_PROFILE_BATCH_WINDOW', 0.05))
+profile_timeout = float(os.environ.get('FINBOT_PROFILE_TIMEOUT', 3))
+profile_retry_minutes = int(os.environ.get('FINBOT_PROFILE_RETRY_MINUTES', 60))
+conversation_persistence = os.environ.get('FINBOT_CONVERSATION_PERSISTENCE', 'write-through')
+conversation_ttl = int(os.environ.get('FINBOT_CONVERSATION_TTL', 0))
+conversation_flush_interval = float(os.environ.get('FINBOT_CONVERSATION_FLUSH_INTERVAL', 1))
+confirm_list_size = 500  # Button templates accept up to 640 characters
+export_token = os.environ.get('FINBOT_EXPORT_TOKEN')
+export_chunk_size = int(os.environ.get('FINBOT_EXPORT_CHUNK_SIZE', 1000))
+metrics_token = os.environ.get('FINBOT_METRICS_TOKEN')
+dedup_window = int(os.environ.get('FINBOT_DEDUP_WINDOW', 10000))
+dedup_retention_hours = int(os.environ.get('FINBOT_DEDUP_RETENTION_HOURS', 48))
+search_limit = int(os.environ.get('FINBOT_SEARCH_LIMIT', 10))
+scheduler_enabled = os.environ.get('FINBOT_SCHEDULER') == '1'
+scheduler_refresh = int(os.environ.get('FINBOT_SCHEDULER_REFRESH', 300))
+recurring_hour = int(os.environ.get('FINBOT_RECURRING_HOUR', 9))
+recurring_catch_up = 12  # Missed months created at once, after a long downtime
 
 # App and modules creations
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///{}'.format(db_file)
+storage.configure(app)
 db = SQLAlchemy(app)
 
 
@@ -29,7 +74,7 @@ class User(db.Model):
     Model that keeps user information
     """
     id = db.Column(db.Integer, primary_key=True)
-    facebook_id = db.Column(BIGINT(unsigned=True), index=True)
+    facebook_id = db.Column(db.BigInteger().with_variant(BIGINT(unsigned=True), 'mysql'), index=True)
     first_name = db.Column(db.String(120))
     last_name = db.Column(db.String(120))
     profile_pic = db.Column(db.Text)
@@ -50,10 +95,15 @@ class Category(db.Model):
     """
     Model that store categories
     """
+    __table_args__ = (
+        db.Index('uq_category_user_name', 'user_id', 'normalized_name', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     parent_id = db.Column(db.Integer, db.ForeignKey('category.id'), index=True)
     name = db.Column(db.String(120))
+    normalized_name = db.Column(db.String(120))
     created_at = db.Column(db.DateTime)
     updated_at = db.Column(db.DateTime, default=datetime.now())
 
@@ -68,14 +118,28 @@ class Budget(db.Model):
     """
     Model that store the items and values
     """
+    __table_args__ = (
+        # Draft and revision lookups of the conversation flow
+        db.Index('ix_budget_user_status', 'user_id', 'status'),
+        # Reports over the finished entries
+        db.Index('ix_budget_user_done_date', 'user_id', 'date_time',
+                 sqlite_where=db.text("status = 'done'"),
+                 postgresql_where=db.text("status = 'done'")),
+        # Skips the rows already imported from a statement
+        db.Index('uq_budget_user_import_key', 'user_id', 'import_key', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'), index=True)
     description = db.Column(db.String(120))
+    # Lower case and without accents, searched by the databases without FTS5
+    normalized_description = db.Column(db.String(120))
     value = db.Column(db.Float)
     date_time = db.Column(db.DateTime)
     status = db.Column(db.String(120))
     entry_type = db.Column(db.String(120))
+    import_key = db.Column(db.String(40))
     created_at = db.Column(db.DateTime)
     updated_at = db.Column(db.DateTime, default=datetime.now())
 
@@ -87,6 +151,55 @@ class Budget(db.Model):
         return '{}'.format(self.description)
 
 
+class BudgetArchive(db.Model):
+    """
+    Model that keeps the finished entries older than the archive horizon, with
+    the ids and columns they had in Budget
+    """
+    __tablename__ = 'budget_archive'
+    __table_args__ = (
+        db.Index('ix_budget_archive_user_date', 'user_id', 'date_time'),
+        # The importer skips the rows already archived too
+        db.Index('ix_budget_archive_user_import_key', 'user_id', 'import_key'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'))
+    description = db.Column(db.String(120))
+    normalized_description = db.Column(db.String(120))
+    value = db.Column(db.Float)
+    date_time = db.Column(db.DateTime)
+    status = db.Column(db.String(120))
+    entry_type = db.Column(db.String(120))
+    import_key = db.Column(db.String(40))
+    created_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime)
+
+
+def entries_union():
+    """
+    Returns the hot and the archived entries as a single selectable
+    """
+    names = [column.name for column in Budget.__table__.columns]
+    return db.union_all(db.select([Budget.__table__.c[name] for name in names]),
+                        db.select([BudgetArchive.__table__.c[name] for name in names])).alias('entries')
+
+
+# Budget over the hot and the archived entries, the reports read from it
+AllEntries = db.aliased(Budget, entries_union(), name='entries')
+
+
+@event.listens_for(Budget.__table__, 'after_create')
+def create_search_index(target, connection, **kwargs):
+    """
+    The full-text index of the descriptions is not a model, it is created
+    along with the entries
+    """
+    search.create_index(connection)
+
+
 class Conversation(db.Model):
     """
     Model that stores the conversation context
@@ -101,35 +214,203 @@ class Conversation(db.Model):
         self.created_at = datetime.now()
 
 
-def get_or_create_user(sender):
+class MonthlySummary(db.Model):
+    """
+    Model that keeps the sums of the finished entries by category and month
+    """
+    __table_args__ = (
+        db.Index('uq_monthly_summary', 'user_id', 'month', 'category_id', 'entry_type', unique=True),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'))
+    month = db.Column(db.Date)
+    entry_type = db.Column(db.String(120))
+    total = db.Column(db.Float, default=0)
+    count = db.Column(db.Integer, default=0)
+    updated_at = db.Column(db.DateTime)
+
+
+class DailyBalance(db.Model):
+    """
+    Model that keeps the balance of an user at the end of each day with
+    finished entries, the prefix sums of the deposits and withdrawals
+    """
+    __table_args__ = (
+        db.Index('uq_daily_balance', 'user_id', 'day', unique=True),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    day = db.Column(db.Date)
+    delta = db.Column(db.Float, default=0)
+    balance = db.Column(db.Float, default=0)
+
+
+class RecurringEntry(db.Model):
+    """
+    Model of the entries repeated every month, like the bills
+    """
+    __table_args__ = (
+        # Due templates of every user, read by the scheduler
+        db.Index('ix_recurring_entry_active_due', 'active', 'next_due'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'))
+    description = db.Column(db.String(120))
+    value = db.Column(db.Float)
+    entry_type = db.Column(db.String(120))
+    day = db.Column(db.Integer)
+    next_due = db.Column(db.DateTime)
+    active = db.Column(db.Boolean, default=True)
+    created_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
+
+    def __init__(self):
+        self.created_at = datetime.now()
+        self.active = True
+
+
+class ProcessedEvent(db.Model):
+    """
+    Model that keeps the keys of the handled webhook events for a while
+    """
+    key = db.Column(db.String(40), primary_key=True)
+    created_at = db.Column(db.DateTime, index=True)
+
+
+def save_changes(on_rollback=None):
+    """
+    Commits the session, or only flushes it when inside a unit of work
+    """
+    unit = current_unit()
+    if unit is None:
+        db.session.commit()
+        return
+
+    db.session.flush()
+    if on_rollback:
+        unit.on_rollback(on_rollback)
+
+
+def cached_user(user):
+    """
+    Returns the cacheable fields of an user
+    """
+    return CachedUser(user.id, user.facebook_id, user.first_name, user.last_name,
+                      user.locale, user.timezone, user.gender, user.updated_at)
+
+
+def fill_user_profile(user, response):
+    """
+    Copy the profile fields from the Graph API response to the user
+    """
+    user.first_name = response.get("first_name")
+    user.last_name = response.get("last_name")
+    user.profile_pic = response.get("profile_pic")
+    user.locale = response.get("locale")
+    user.timezone = response.get("timezone")
+    user.gender = response.get("gender")
+    user.updated_at = datetime.now()
+
+
+def create_users(senders):
+    """
+    Creates the new users with a single profile request and a single insert.
+    When the profile does not come in time the user gets only the facebook id,
+    the profile is fetched again later by the refresher of the cache.
+    """
+    return insert_users(senders, get_user_profiles(senders, timeout=profile_timeout))
+
+
+def insert_users(senders, profiles):
+    """
+    Inserts the users missing among the senders with the profiles at hand,
+    returns {sender: cached user}
+    """
+    facebook_ids = [int(sender) for sender in senders]
+    table = User.__table__
+    now = datetime.now()
+
+    # Its own transaction, the new users do not depend on the events that asked for them
+    with db.engine.begin() as conn:
+        existing = set(facebook_id for (facebook_id,) in
+                       conn.execute(db.select([table.c.facebook_id]).where(table.c.facebook_id.in_(facebook_ids))))
+        rows = []
+        for sender, facebook_id in zip(senders, facebook_ids):
+            if facebook_id in existing:
+                continue
+            profile = profiles.get(sender) or {}
+            rows.append({'facebook_id': facebook_id, 'first_name': profile.get('first_name'),
+                         'last_name': profile.get('last_name'), 'profile_pic': profile.get('profile_pic'),
+                         'locale': profile.get('locale'), 'timezone': profile.get('timezone'),
+                         'gender': profile.get('gender'), 'created_at': now,
+                         'updated_at': now if profile else None})
+        if rows:
+            conn.execute(table.insert(), rows)
+        users = conn.execute(table.select().where(table.c.facebook_id.in_(facebook_ids))
+                                           .order_by(table.c.id)).fetchall()
+
+    created = {}
+    for user in users:
+        created.setdefault(str(user.facebook_id), cached_user(user))
+    return created
+
+
+# New users arriving together are created together
+profile_coalescer = ProfileCoalescer(create_users, window=profile_batch_window,
+                                     timeout=profile_batch_window + profile_timeout + 2)
+
+
+def find_user(sender):
     """
-    Receives the user data from Facebook
+    Returns the cached fields of the user of a facebook id, None when it is new
     """
     user = User.query.filter_by(facebook_id=sender).first()
+    return cached_user(user) if user else None
 
-    # If user does not exists, we create it
-    if not user:
-        r = requests.get('https://graph.facebook.com/v2.6/{}?access_token={}'.format(sender, token))
-        response = r.json()
 
-        if response:
-            user = User()
+def load_user(sender):
+    """
+    Returns the user of a facebook id, creating it on the first message
+    """
+    return find_user(sender) or profile_coalescer.get(sender)
+
+
+def refresh_user(sender):
+    """
+    Updates the profile of an user with the data from Facebook
+    """
+    with app.app_context():
+        response = get_user_profile(sender)
+        user = User.query.filter_by(facebook_id=sender).first()
+        if not response or not user:
+            return None
 
-            user.facebook_id = sender
-            user.first_name = response["first_name"]
-            user.last_name = response["last_name"]
-            user.profile_pic = response["profile_pic"]
-            user.locale = response["locale"]
-            user.timezone = response["timezone"]
-            user.gender = response["gender"]
+        fill_user_profile(user, response)
+        db.session.commit()
+        return cached_user(user)
 
-            db.session.add(user)
-            db.session.commit()
 
-    return user
+user_cache = UserCache(load_user,
+                       maxsize=user_cache_size,
+                       ttl=user_cache_ttl,
+                       refresher=refresh_user,
+                       refresh_after=timedelta(days=profile_refresh_days) if profile_refresh_days else None,
+                       retry_after=profile_retry_minutes * 60)
 
 
-def get_or_create_conversation(user_id):
+def get_or_create_user(sender):
+    """
+    Returns the cached user, creating it on the first message
+    """
+    return user_cache.get(sender)
+
+
+def load_conversation_status(user_id):
     """
     Return the status of the conversation with an user
     """
@@ -140,26 +421,215 @@ def get_or_create_conversation(user_id):
         conversation.status = 'init'
         conversation.user_id = user_id
         db.session.add(conversation)
-        db.session.commit()
+        save_changes(on_rollback=lambda: conversation_store.forget(user_id))
 
-    return conversation
+    return conversation.status
 
 
-def save_categories(user_id, categories):
+def persist_conversation_statuses(statuses):
+    """
+    Saves a batch of conversation statuses, with one statement by status
+    """
+    if not has_app_context():
+        # Called from the write-behind thread
+        with app.app_context():
+            return persist_conversation_statuses(statuses)
+
+    by_status = {}
+    for user_id, status in statuses.items():
+        by_status.setdefault(status, []).append(user_id)
+
+    for status, user_ids in by_status.items():
+        Conversation.query.filter(Conversation.user_id.in_(user_ids)) \
+                          .update({'status': status, 'updated_at': datetime.now()},
+                                  synchronize_session=False)
+    save_changes()
+
+
+conversation_store = ConversationStore(load_conversation_status,
+                                       persist_conversation_statuses,
+                                       ttl=conversation_ttl,
+                                       mode=conversation_persistence,
+                                       flush_interval=conversation_flush_interval)
+
+
+def get_conversation_status(user_id):
+    """
+    Return the status of the conversation with an user
+    """
+    return conversation_store.get(user_id)
+
+
+def insert_ignore(table):
+    """
+    Returns an INSERT that skips the rows violating an unique constraint
+    """
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert(table).on_conflict_do_nothing()
+    if dialect == 'mysql':
+        return table.insert().prefix_with('IGNORE')
+    return table.insert().prefix_with('OR IGNORE')
+
+
+def parse_category_names(categories):
     """
-    Save the new cagtegoies
+    Returns an ordered dict of {normalized name: name} from a comma separated text
     """
-    category_list = categories.split(',')
-    for category in category_list:
+    names = OrderedDict()
+    for category in categories.split(','):
         category = category.strip()  # trim
-        c = Category.query.filter_by(user_id=user_id, name=category).first()
-        if not c:
-            c = Category()
-            c.user_id = user_id
-            c.name = category
-            db.session.add(c)
+        if category:
+            names.setdefault(normalize_text(category), category)
+    return names
+
+
+def get_entry_query(user_id, status):
+    """
+    Returns the query of the entries of an user with a given status
+    """
+    return Budget.query.filter_by(user_id=user_id, status=status)
+
+
+def get_entry(user_id, status):
+    """
+    Returns the draft or revision entry of an user
+    """
+    return get_entry_query(user_id, status).order_by(Budget.id).first()
+
+
+def done_entries_query(user_id, start=None, end=None):
+    """
+    Returns the query of the finished entries of an user, within the dates,
+    archived ones included
+    """
+    query = db.session.query(AllEntries).filter(AllEntries.user_id == user_id, AllEntries.status == 'done')
+    if start is not None:
+        query = query.filter(AllEntries.date_time >= start)
+    if end is not None:
+        query = query.filter(AllEntries.date_time < end)
+    return query
+
+
+def category_version(user_id):
+    """
+    Number and last change of the categories of an user, it changes whatever
+    process changed them
+    """
+    return tuple(db.session.query(db.func.count(Category.id), db.func.max(Category.updated_at))
+                           .filter(Category.user_id == user_id).one())
+
+
+def load_category_replies(user_id):
+    """
+    Returns the version of the categories of an user and their encoded quick replies
+    """
+    version = category_version(user_id)
+    names = [name for (name,) in db.session.query(Category.name).filter(Category.user_id == user_id)
+                                                                 .order_by(Category.id)]
+    return version, encode_quick_replies('begin_add_data', categories=names)
 
-    db.session.commit()
+
+category_replies = UserCache(load_category_replies, maxsize=user_cache_size, ttl=category_cache_ttl)
+
+
+def get_category_replies(user_id):
+    """
+    Returns the encoded category quick replies of an user, the cached ones
+    only while the categories have the same version
+    """
+    version, encoded = category_replies.get(user_id)
+    if version != category_version(user_id):
+        # Changed by another worker
+        category_replies.invalidate(user_id)
+        version, encoded = category_replies.get(user_id)
+    return encoded
+
+
+def forget_categories(user_id):
+    """
+    Drops the cached quick replies after the categories of an user changed
+    """
+    category_replies.invalidate(user_id)
+    unit = current_unit()
+    if unit is not None:
+        # Another event could cache the old categories before the commit
+        unit.after_commit(lambda: category_replies.invalidate(user_id))
+
+
+def save_categories(user_id, categories):
+    """
+    Save the new categories, with a single lookup and a single insert
+    """
+    names = parse_category_names(categories)
+    if not names:
+        return
+
+    existing = db.session.query(Category.normalized_name) \
+                         .filter(Category.user_id == user_id,
+                                 Category.normalized_name.in_(list(names)))
+    existing = set(normalized for (normalized,) in existing)
+
+    now = datetime.now()
+    rows = [{'user_id': user_id, 'name': name, 'normalized_name': normalized,
+             'created_at': now, 'updated_at': now}
+            for normalized, name in names.items() if normalized not in existing]
+
+    if rows:
+        # The unique index skips categories created meanwhile by another request
+        db.session.execute(insert_ignore(Category.__table__), rows)
+        forget_categories(user_id)
+    save_changes()
+
+
+def merge_categories(user_id, categories, target):
+    """
+    Moves the entries of the given categories to the target one and removes
+    them. When the target does not exist yet, the first category is renamed.
+    Returns the target category.
+    """
+    names = parse_category_names(categories)
+    target_normalized = normalize_text(target)
+    sources = Category.query.filter(Category.user_id == user_id,
+                                    Category.normalized_name.in_(list(names) + [target_normalized])).all()
+    target_category = next((c for c in sources if c.normalized_name == target_normalized), None)
+    sources = [c for c in sources if c.normalized_name != target_normalized]
+
+    if target_category is None:
+        if not sources:
+            return None
+        # Renaming, no entry needs to be moved
+        target_category = sources.pop(0)
+        target_category.normalized_name = target_normalized
+    target_category.name = target.strip()
+    target_category.updated_at = datetime.now()
+
+    source_ids = [c.id for c in sources]
+    if source_ids:
+        Budget.query.filter(Budget.category_id.in_(source_ids)) \
+                    .update({'category_id': target_category.id}, synchronize_session=False)
+        BudgetArchive.query.filter(BudgetArchive.category_id.in_(source_ids)) \
+                           .update({'category_id': target_category.id}, synchronize_session=False)
+        RecurringEntry.query.filter(RecurringEntry.category_id.in_(source_ids)) \
+                            .update({'category_id': target_category.id, 'updated_at': datetime.now()},
+                                    synchronize_session=False)
+        Category.query.filter(Category.parent_id.in_(source_ids)) \
+                      .update({'parent_id': target_category.id}, synchronize_session=False)
+        Category.query.filter(Category.id.in_(source_ids)).delete(synchronize_session=False)
+        # The summaries of the merged categories are added together
+        rebuild_summaries(user_id)
+
+    forget_categories(user_id)
+    save_changes()
+    return target_category
+
+
+def rename_category(user_id, name, new_name):
+    """
+    Renames a category, merging it when the new name already exists
+    """
+    return merge_categories(user_id, name, new_name)
 
 
 def get_category_list(user_id):
@@ -173,13 +643,452 @@ def get_category_list(user_id):
     return response_text
 
 
+def month_of(value):
+    """
+    Returns the first day of the month of a date
+    """
+    return value.date().replace(day=1) if isinstance(value, datetime) else value.replace(day=1)
+
+
+def add_to_summaries(entries):
+    """
+    Adds finished entries to the monthly summaries, one statement by summary
+    """
+    sums = OrderedDict()
+    for entry in entries:
+        key = (entry.user_id, month_of(entry.date_time), entry.category_id, entry.entry_type)
+        total, count = sums.get(key, (0.0, 0))
+        sums[key] = (total + (entry.value or 0.0), count + 1)
+
+    now = datetime.now()
+    for (user_id, month, category_id, entry_type), (total, count) in sums.items():
+        summary = MonthlySummary.query.filter_by(user_id=user_id, month=month,
+                                                 category_id=category_id, entry_type=entry_type)
+        changes = {'total': MonthlySummary.total + total,
+                   'count': MonthlySummary.count + count,
+                   'updated_at': now}
+        if summary.update(changes, synchronize_session=False):
+            continue
+
+        inserted = db.session.execute(insert_ignore(MonthlySummary.__table__),
+                                      {'user_id': user_id, 'month': month, 'category_id': category_id,
+                                       'entry_type': entry_type, 'total': total, 'count': count,
+                                       'updated_at': now})
+        if not inserted.rowcount:
+            # Created meanwhile by another request
+            summary.update(changes, synchronize_session=False)
+
+
+def rebuild_summaries(user_id=None):
+    """
+    Computes the monthly summaries again from the finished entries, archived
+    ones included
+    """
+    year = db.extract('year', AllEntries.date_time)
+    month = db.extract('month', AllEntries.date_time)
+    query = db.session.query(AllEntries.user_id, AllEntries.category_id, AllEntries.entry_type, year, month,
+                             db.func.sum(AllEntries.value), db.func.count(AllEntries.id)) \
+                      .filter(AllEntries.status == 'done', AllEntries.date_time != None) \
+                      .group_by(AllEntries.user_id, AllEntries.category_id, AllEntries.entry_type, year, month)
+
+    summaries = MonthlySummary.query
+    if user_id is not None:
+        query = query.filter(AllEntries.user_id == user_id)
+        summaries = summaries.filter_by(user_id=user_id)
+    summaries.delete(synchronize_session=False)
+
+    now = datetime.now()
+    rows = [{'user_id': row[0], 'category_id': row[1], 'entry_type': row[2],
+             'month': date(int(row[3]), int(row[4]), 1), 'total': row[5] or 0.0, 'count': row[6],
+             'updated_at': now} for row in query]
+    if rows:
+        db.session.execute(MonthlySummary.__table__.insert(), rows)
+    save_changes()
+    return len(rows)
+
+
+def day_of(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+def add_to_balances(entries):
+    """
+    Adds finished entries to the daily balances. The day of an entry gets its
+    value and the balance of every later day of the user moves by it, so a
+    backdated entry is a single statement whatever its date.
+    """
+    deltas = OrderedDict()
+    for entry in entries:
+        if entry.date_time is None:
+            continue
+        key = (entry.user_id, day_of(entry.date_time))
+        deltas[key] = deltas.get(key, 0.0) + signed_value(entry.entry_type, entry.value)
+
+    for (user_id, day), delta in deltas.items():
+        same_day = DailyBalance.query.filter_by(user_id=user_id, day=day)
+        if not same_day.update({'delta': DailyBalance.delta + delta}, synchronize_session=False):
+            # First entry of the day, starts from the balance of the day before
+            previous = db.session.query(DailyBalance.balance) \
+                                 .filter(DailyBalance.user_id == user_id, DailyBalance.day < day) \
+                                 .order_by(DailyBalance.day.desc()).limit(1).scalar()
+            inserted = db.session.execute(insert_ignore(DailyBalance.__table__),
+                                          {'user_id': user_id, 'day': day, 'delta': delta,
+                                           'balance': previous or 0.0})
+            if not inserted.rowcount:
+                # Created meanwhile by another request
+                same_day.update({'delta': DailyBalance.delta + delta}, synchronize_session=False)
+
+        DailyBalance.query.filter(DailyBalance.user_id == user_id, DailyBalance.day >= day) \
+                          .update({'balance': DailyBalance.balance + delta}, synchronize_session=False)
+
+    for user_id in set(user_id for user_id, _ in deltas):
+        forget_balances(user_id)
+
+
+def expected_balances(user_id=None):
+    """
+    Returns the (user_id, day, delta, balance) rows computed from the
+    finished entries, archived ones included
+    """
+    year = db.extract('year', AllEntries.date_time)
+    month = db.extract('month', AllEntries.date_time)
+    day = db.extract('day', AllEntries.date_time)
+    signed = db.case([(AllEntries.entry_type == 'withdrawal', -AllEntries.value)], else_=AllEntries.value)
+    query = db.session.query(AllEntries.user_id, year, month, day, db.func.sum(signed)) \
+                      .filter(AllEntries.status == 'done', AllEntries.date_time != None) \
+                      .group_by(AllEntries.user_id, year, month, day) \
+                      .order_by(AllEntries.user_id, year, month, day)
+    if user_id is not None:
+        query = query.filter(AllEntries.user_id == user_id)
+    return list(running_totals((row[0], date(int(row[1]), int(row[2]), int(row[3])), row[4] or 0.0)
+                               for row in query))
+
+
+def rebuild_balances(user_id=None):
+    """
+    Computes the daily balances again from the finished entries
+    """
+    rows = [{'user_id': row[0], 'day': row[1], 'delta': row[2], 'balance': row[3]}
+            for row in expected_balances(user_id)]
+
+    balances = DailyBalance.query
+    if user_id is not None:
+        balances = balances.filter_by(user_id=user_id)
+    balances.delete(synchronize_session=False)
+    if rows:
+        db.session.execute(DailyBalance.__table__.insert(), rows)
+    save_changes()
+
+    if user_id is None:
+        balance_cache.clear()
+    else:
+        forget_balances(user_id)
+    return len(rows)
+
+
+def check_balances(user_id=None, tolerance=0.005):
+    """
+    Compares the daily balances with the ones computed from the finished
+    entries, returns the ids of the users that differ
+    """
+    expected = {}
+    for row in expected_balances(user_id):
+        expected.setdefault(row[0], []).append(row[1:])
+
+    stored = {}
+    query = db.session.query(DailyBalance.user_id, DailyBalance.day, DailyBalance.delta, DailyBalance.balance) \
+                      .order_by(DailyBalance.user_id, DailyBalance.day)
+    if user_id is not None:
+        query = query.filter(DailyBalance.user_id == user_id)
+    for row in query:
+        stored.setdefault(row[0], []).append((row[1], row[2] or 0.0, row[3] or 0.0))
+
+    def same(left, right):
+        return len(left) == len(right) and all(
+            a[0] == b[0] and abs(a[1] - b[1]) < tolerance and abs(a[2] - b[2]) < tolerance
+            for a, b in zip(left, right))
+
+    return sorted(user for user in set(expected) | set(stored)
+                  if not same(expected.get(user, []), stored.get(user, [])))
+
+
+def load_balances(user_id):
+    """
+    Returns the balance index of every day of an user
+    """
+    rows = db.session.query(DailyBalance.day, DailyBalance.balance) \
+                     .filter(DailyBalance.user_id == user_id).order_by(DailyBalance.day)
+    return BalanceIndex(rows)
+
+
+balance_cache = UserCache(load_balances, maxsize=user_cache_size, ttl=balance_cache_ttl)
+
+
+def forget_balances(user_id):
+    """
+    Drops the cached balances after the entries of an user changed
+    """
+    balance_cache.invalidate(user_id)
+    unit = current_unit()
+    if unit is not None:
+        # Another event could cache the old balances before the commit
+        unit.after_commit(lambda: balance_cache.invalidate(user_id))
+
+
+def balance_at(user_id, day):
+    """
+    Returns the balance of an user at the end of a day, a binary search on the
+    cached days or a single indexed lookup without the cache
+    """
+    day = day_of(day)
+    if balance_cache_ttl:
+        return balance_cache.get(user_id).at(day)
+    balance = db.session.query(DailyBalance.balance) \
+                        .filter(DailyBalance.user_id == user_id, DailyBalance.day <= day) \
+                        .order_by(DailyBalance.day.desc()).limit(1).scalar()
+    return balance or 0.0
+
+
+def balance_delta(user_id, start, end):
+    """
+    Returns the sum of the entries of an user after the start day, up to the
+    end day
+    """
+    return balance_at(user_id, end) - balance_at(user_id, start)
+
+
+def get_monthly_summary(user_id, month=None):
+    """
+    Returns the text with the totals by category of a month
+    """
+    month = month or date.today().replace(day=1)
+    summaries = db.session.query(MonthlySummary, Category.name) \
+                          .outerjoin(Category, Category.id == MonthlySummary.category_id) \
+                          .filter(MonthlySummary.user_id == user_id, MonthlySummary.month == month) \
+                          .order_by(Category.name)
+
+    response_text = 'Resumo de {}:\n'.format(month.strftime('%m/%Y'))
+    totals = {'deposit': 0.0, 'withdrawal': 0.0}
+    for summary, name in summaries:
+        entry_type = 'saídas' if summary.entry_type == 'withdrawal' else 'entradas'
+        response_text += '- {} ({}): R$ {:.2f} em {} registros\n'.format(name or 'Sem categoria', entry_type,
+                                                                         summary.total, summary.count)
+        totals[summary.entry_type] = totals.get(summary.entry_type, 0.0) + summary.total
+    response_text += 'Entradas: R$ {:.2f}\nSaídas: R$ {:.2f}'.format(totals['deposit'], totals['withdrawal'])
+    return response_text
+
+
+def get_search_results(user_id, query):
+    """
+    Returns the text with the best matches of a search and their totals
+    """
+    result = search.search(db.session, user_id, query, limit=search_limit)
+    terms = ' '.join(result.terms) or query
+    if not result.count:
+        return get_response('search_empty').format(terms)
+
+    response_text = get_response('search_results').format(result.count, terms,
+                                                           result.totals.get('withdrawal', 0.0),
+                                                           result.totals.get('deposit', 0.0))
+    for match in result.matches:
+        signal = '-' if match.entry_type == 'withdrawal' else '+'
+        response_text += '\n{} {}: {}R$ {:.2f}'.format(match.date_time.strftime('%d/%m/%Y'), match.description,
+                                                      signal, match.value or 0.0)
+    return response_text
+
+
+def add_months(value, months, day):
+    """
+    Returns the date months after value on the given day, or on the last day
+    of the shorter months
+    """
+    month = value.month - 1 + months
+    year = value.year + month // 12
+    month = month % 12 + 1
+    return date(year, month, min(day, calendar.monthrange(year, month)[1]))
+
+
+def due_at(day):
+    """
+    Time of the day when a recurring entry is created and the user reminded
+    """
+    return datetime.combine(day, datetime.min.time()).replace(hour=recurring_hour)
+
+
+def add_recurring_entries(entries):
+    """
+    Repeats finished entries every month, on the day of their dates
+    """
+    now = datetime.now()
+    templates = []
+    for entry in entries:
+        template = RecurringEntry()
+        template.user_id = entry.user_id
+        template.category_id = entry.category_id
+        template.description = entry.description
+        template.value = entry.value
+        template.entry_type = entry.entry_type
+        template.day = entry.date_time.day
+        # A backdated entry repeats from the next month still to come
+        months = 1
+        while due_at(add_months(entry.date_time.date(), months, template.day)) <= now:
+            months += 1
+        template.next_due = due_at(add_months(entry.date_time.date(), months, template.day))
+        template.updated_at = now
+        db.session.add(template)
+        templates.append(template)
+    save_changes()
+
+    scheduled = [(template.id, template.next_due) for template in templates]
+    unit = current_unit()
+    if unit is not None:
+        unit.after_commit(lambda: [recurring_scheduler.schedule(key, due) for key, due in scheduled])
+    else:
+        for key, due in scheduled:
+            recurring_scheduler.schedule(key, due)
+    return templates
+
+
+recurring_entries = metrics.registry.register(metrics.Counter(
+    'finbot_recurring_entries_total', 'Entries created from the recurring ones', labels=('result',)))
+
+
+def materialize_recurring(ids, now=None):
+    """
+    Creates the entries of the due recurring templates in a single
+    transaction and reminds their users.
+
+    A template is claimed by moving next_due forward only while it still has
+    the value read, so the workers running the scheduler at the same time
+    never create the same entry twice. Returns {id: next due} of the active
+    templates.
+    """
+    now = now or datetime.now()
+    schedule = {}
+    created = []
+    with UnitOfWork(db.session) as unit:
+        templates = RecurringEntry.query.filter(RecurringEntry.id.in_(ids), RecurringEntry.active == True).all()
+        for template in templates:
+            due = template.next_due
+            occurrences = []
+            while due <= now:
+                if len(occurrences) < recurring_catch_up:
+                    occurrences.append(due)
+                due = due_at(add_months(due.date(), 1, template.day))
+            schedule[template.id] = due
+            if not occurrences:
+                continue
+
+            claimed = RecurringEntry.query.filter_by(id=template.id, next_due=template.next_due) \
+                                          .update({'next_due': due, 'updated_at': now}, synchronize_session=False)
+            if not claimed:
+                # Created meanwhile by another worker, which moved it to the same due time
+                recurring_entries.inc(result='conflict')
+                continue
+
+            for occurrence in occurrences:
+                entry = Budget()
+                entry.user_id = template.user_id
+                entry.category_id = template.category_id
+                entry.description = template.description
+                entry.value = template.value
+                entry.entry_type = template.entry_type
+                entry.date_time = datetime.combine(occurrence.date(), datetime.min.time())
+                entry.status = 'done'
+                entry.updated_at = now
+                db.session.add(entry)
+                created.append(entry)
+
+        if created:
+            db.session.flush()
+            add_to_summaries(created)
+            add_to_balances(created)
+            search.index_entries(db.session, created)
+
+            senders = dict(db.session.query(User.id, User.facebook_id)
+                                     .filter(User.id.in_(set(entry.user_id for entry in created))))
+            reminders = [(senders.get(entry.user_id),
+                          get_response('recurring_reminder').format(entry.description, entry.value or 0.0,
+                                                                    entry.date_time.strftime('%d/%m/%Y')))
+                         for entry in created]
+            unit.after_commit(lambda: [send_text_message(sender, text) for sender, text in reminders if sender])
+
+    recurring_entries.inc(len(created), result='created')
+    return schedule
+
+
+def load_recurring_due():
+    """
+    Returns the (next due, id) of the active recurring templates
+    """
+    with app.app_context():
+        return db.session.query(RecurringEntry.next_due, RecurringEntry.id) \
+                         .filter(RecurringEntry.active == True).all()
+
+
+def run_recurring(ids):
+    with app.app_context():
+        return materialize_recurring(ids)
+
+
+# Wakes when the earliest template is due, runs in every worker with FINBOT_SCHEDULER=1
+# or alone with "manage.py scheduler"
+recurring_scheduler = DueScheduler(run_recurring, load_recurring_due, refresh_interval=scheduler_refresh)
+
+
+recurring_day = re.compile(r'^(?:dia )?(\d{1,2})$')
+
+
+def get_recurring_list(user_id):
+    """
+    Returns the text with the recurring entries of an user
+    """
+    templates = RecurringEntry.query.filter_by(user_id=user_id, active=True).order_by(RecurringEntry.day).all()
+    if not templates:
+        return get_response('recurring_empty')
+    response_text = 'Registros de todo mês:\n'
+    for template in templates:
+        response_text += '- Dia {}: {}, R$ {:.2f}\n'.format(template.day, template.description, template.value or 0.0)
+    return response_text + 'Para parar um, envie "cancelar recorrente" com o dia ou a descrição.'
+
+
+def cancel_recurring(user_id, query):
+    """
+    Stops the recurring entries of a day, like 'dia 5' or '5', or having every
+    word of the query in their descriptions, returns them
+    """
+    terms = search.search_terms(query)
+    if not terms:
+        return []
+    active = RecurringEntry.query.filter_by(user_id=user_id, active=True)
+    day = recurring_day.match(' '.join(terms))
+    if day:
+        templates = active.filter_by(day=int(day.group(1))).all()
+    else:
+        templates = [template for template in active
+                     if all(term in normalize_text(template.description or '') for term in terms)]
+    for template in templates:
+        template.active = False
+        template.updated_at = datetime.now()
+    save_changes()
+    for template in templates:
+        recurring_scheduler.cancel(template.id)
+    return templates
+
+
 def change_conversation_status(user_id, new_status):
     """
     Change the status of a conversation
     """
-    conversation = Conversation.query.filter_by(user_id=user_id).first()
-    conversation.status = new_status
-    db.session.commit()
+    unit = current_unit()
+    if unit is not None and conversation_store.mode == ConversationStore.WRITE_BEHIND:
+        # Only queues the change when the event succeeds
+        unit.after_commit(lambda: conversation_store.set(user_id, new_status))
+        return
+
+    conversation_store.set(user_id, new_status)
+    if unit is not None:
+        unit.on_rollback(lambda: conversation_store.forget(user_id))
 
 
 def verify_quick_message(user_id, sender, payload, conversation_status):
@@ -188,7 +1097,7 @@ def verify_quick_message(user_id, sender, payload, conversation_status):
     """
     if conversation_status == 'begin_add_data':
         if payload:
-            category = Category.query.filter_by(user_id=user_id, name=payload).first()
+            category = Category.query.filter_by(user_id=user_id, normalized_name=normalize_text(payload)).first()
             if payload == 'withdrawal':
                 entry_type = 'saída'
             else:
@@ -196,7 +1105,7 @@ def verify_quick_message(user_id, sender, payload, conversation_status):
             send_text_message(sender, get_response('begin_add_data').format(entry_type, category))
 
             # Inserts category to the draft new entry
-            new_entry = Budget.query.filter_by(user_id=user_id, status='draft').first()
+            new_entry = get_entry(user_id, 'draft')
             new_entry.category_id = category.id
 
             change_conversation_status(user_id, 'draft_add_data')
@@ -210,12 +1119,12 @@ def verify_quick_message(user_id, sender, payload, conversation_status):
             new_entry.user_id = user_id
             new_entry.entry_type = payload
             db.session.add(new_entry)
-            db.session.commit()
+            save_changes()
 
             send_quick_replies(sender,
                                "Escolha uma categoria...",
                                'begin_add_data',
-                               categories=[c.name for c in Category.query.filter_by(user_id=user_id)])
+                               encoded_options=get_category_replies(user_id))
             change_conversation_status(user_id, 'begin_add_data')
         if payload == 'add_category':
             send_text_message(sender, get_response('begin_add_category'))
@@ -224,50 +1133,55 @@ def verify_quick_message(user_id, sender, payload, conversation_status):
             response_text = get_category_list(user_id)
             send_text_message(sender, response_text)
             send_quick_replies(sender, get_response('waiting'))
+        if payload == 'monthly_summary':
+            send_text_message(sender, get_monthly_summary(user_id))
+            send_quick_replies(sender, get_response('waiting'))
+        if payload == 'search':
+            send_text_message(sender, get_response('begin_search'))
+            change_conversation_status(user_id, 'begin_search')
 
 
 def verify_new_entry(user_id, sender, text, conversation_status):
     """
-    Verify and handles the new entry as a draft
+    Verify and handles the new entries as a draft, one entry by line
     """
-    for value in re.findall('\d+(?:\,\d{2})?', text):
-        value_replaced = value.replace(',','.')
-        text = text.replace(value, value_replaced)
-
-    parts_raw = text.split(',')
+    lines = [line for line in (text or '').splitlines() if line.strip()]
+    entries = [parse_entry(line) for line in lines] or [parse_entry(text)]
 
     # Sends a message warning user that the entry is wrong formatted
-    if len(parts_raw) < 2:
-        send_text_message(sender, get_response('wrong_formatted_entry'))
-        send_text_message(sender, get_response('wrong_formatted_entry_exemple'))
-        return None
-
-    parts = [part.strip() for part in parts_raw]
-
-    description = parts[0]
-    try:
-        value = handle_value(parts[1])
-    except IndexError:
+    if any(entry.error for entry in entries):
         send_text_message(sender, get_response('wrong_formatted_entry'))
         send_text_message(sender, get_response('wrong_formatted_entry_exemple'))
         return None
 
-    if len(parts) > 2:
-        entry_date = handle_date(parts[2])
-    else:
-        entry_date = datetime.now()
+    now = datetime.now()
+    entry_dates = [datetime.combine(entry.date, datetime.min.time()) if entry.date else now
+                   for entry in entries]
 
     if conversation_status != 'confirm_add_data':
-        new_entry = Budget.query.filter_by(user_id=user_id, status='draft').first()
+        new_entry = get_entry(user_id, 'draft')
     else:
-        new_entry = Budget.query.filter_by(user_id=user_id, status='revision').first()
+        new_entry = get_entry(user_id, 'revision')
 
     if new_entry:
-        new_entry.description = description
-        new_entry.value = value
-        new_entry.date_time = entry_date
+        # The entries of a previous attempt are replaced
+        get_entry_query(user_id, 'revision').filter(Budget.id != new_entry.id) \
+                                            .delete(synchronize_session=False)
+
+        new_entry.description = entries[0].description
+        new_entry.value = entries[0].value
+        new_entry.date_time = entry_dates[0]
         new_entry.status = 'revision'
-        db.session.commit()
+        new_entry.updated_at = now
+
+        # The other lines share the category and type of the draft
+        rows = [{'user_id': user_id, 'category_id': new_entry.category_id, 'entry_type': new_entry.entry_type,
+                 'description': entry.description, 'value': entry.value, 'date_time': entry_date,
+                 'status': 'revision', 'created_at': now, 'updated_at': now}
+                for entry, entry_date in zip(entries[1:], entry_dates[1:])]
+        if rows:
+            db.session.execute(Budget.__table__.insert(), rows)
+        save_changes()
 
     if conversation_status != 'confirm_add_data':
         # Sends the confirmation buttons
@@ -287,129 +1201,423 @@ def handle_value(raw):
     """
     Extracts a float from a given string
     """
-    float_number = re.findall('[-+]?\d*\.\d+|\d+', raw)
-    return float(float_number[0])
+    value = parse_value(raw)
+    if value is None:
+        raise ValueError('No value in {!r}'.format(raw))
+    return value
 
 
 def sends_confirm_new_entry_buttons(user_id, sender):
     """
     Sends the confirmation buttons
     """
-    new_entry = Budget.query.filter_by(user_id=user_id, status='revision').first()
+    entries = get_entry_query(user_id, 'revision').order_by(Budget.id).all()
+    new_entry = entries[0]
     if new_entry.entry_type == 'withdrawal':
         entry_type = 'saída'
     else:
         entry_type = 'entrada'
-    send_buttons(sender, get_response('confirm_add_data').format(entry_type,
-                                                                 new_entry.value,
-                                                                 new_entry.date_time.strftime('%d/%m/%Y'),
-                                                                 new_entry.description))
 
+    if len(entries) == 1:
+        send_buttons(sender, get_response('confirm_add_data').format(entry_type,
+                                                                     new_entry.value,
+                                                                     new_entry.date_time.strftime('%d/%m/%Y'),
+                                                                     new_entry.description))
+        return
 
-@app.route('/')
-def index():
-    return 'Finbot'
+    # A single confirmation for all the entries, within the size of a button template
+    lines = []
+    size = 0
+    for index, entry in enumerate(entries):
+        line = '- {}: R$ {} em {}'.format(entry.description, entry.value, entry.date_time.strftime('%d/%m/%Y'))
+        size += len(line) + 1
+        if size > confirm_list_size:
+            lines.append('... e mais {}'.format(len(entries) - index))
+            break
+        lines.append(line)
 
-@app.route('/webhook', methods=['GET', 'POST'])
-def webhook():
-    if request.method == 'POST':
+    send_buttons(sender, get_response('confirm_add_batch').format(len(entries),
+                                                                  entry_type + 's',
+                                                                  sum(entry.value for entry in entries),
+                                                                  '\n'.join(lines)))
+
+
+recent_events = RecentKeys(maxsize=dedup_window, ttl=dedup_retention_hours * 3600)
+deduplicated_events = metrics.registry.register(metrics.Counter(
+    'finbot_events_deduplicated_total', 'Repeated webhook events that were skipped', labels=('source',)))
+
+
+def claim_event(key):
+    """
+    Records the event as handled in the current transaction, returns False when
+    another worker already did. A redelivery waits on the insert until the
+    transaction that claimed the key ends, and a rolled back or interrupted
+    event leaves the key unclaimed.
+    """
+    row = {'key': hash_key(key), 'created_at': datetime.now()}
+    return db.session.execute(insert_ignore(ProcessedEvent.__table__), row).rowcount == 1
+
+
+def purge_processed_events(hours=None):
+    """
+    Removes the keys older than the retention, Facebook stops retrying long before
+    """
+    cutoff = datetime.now() - timedelta(hours=hours if hours is not None else dedup_retention_hours)
+    removed = ProcessedEvent.query.filter(ProcessedEvent.created_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    return removed
+
+
+def handle_event(event):
+    """
+    Handles a messaging event inside a single transaction, once. The key of
+    the event is recorded in that transaction, so a redelivery of a failed
+    event tries it again.
+    """
+    if 'message' not in event and 'postback' not in event:
+        # Delivery and read receipts have nothing to answer
+        return
+
+    key = event_key(event)
+    if key is not None and not recent_events.add(key):
+        deduplicated_events.inc(source='memory')
+        return
+
+    with metrics.Span():
+        # The new users are saved in their own transactions, before the event
+        # takes the write lock of SQLite
         try:
-            data = json.loads(request.data.decode())
-            sender = data['entry'][0]['messaging'][0]['sender']['id']  # Sender ID
+            user = get_or_create_user(event['sender']['id'])
+        except Exception:
+            # Like a locked database, the redelivery must not look repeated
+            if key is not None:
+                recent_events.discard(key)
+            raise
+
+        if not user:
+            # Without the user the message cannot be handled, a redelivery may
+            if key is not None:
+                recent_events.discard(key)
+            return
+
+        with UnitOfWork(db.session) as unit:
+            if key is not None:
+                unit.on_rollback(lambda: recent_events.discard(key))
+                # Claimed with the changes of the event, a worker killed before
+                # the commit does not leave the key claimed
+                if not claim_event(key):
+                    deduplicated_events.inc(source='database')
+                    return
+            respond_event(event, user)
+
+
+def respond_event(event, user):
+    """
+    Responds a single messaging event of an user, following the conversation status
+    """
+    sender = event['sender']['id']  # Sender ID
+    text = None
 
-            if 'message' in data['entry'][0]['messaging'][0]:
-                text = data['entry'][0]['messaging'][0]['message']['text']  # Incoming Message Text
-                message_data = data['entry'][0]['messaging'][0]['message']
+    if 'message' in event:
+        text = event['message'].get('text')  # Incoming Message Text
+        message_data = event['message']
 
-                if 'quick_reply' in data['entry'][0]['messaging'][0]['message']:
-                    message_data = data['entry'][0]['messaging'][0]['message']['quick_reply']
+        if 'quick_reply' in event['message']:
+            message_data = event['message']['quick_reply']
+    else:
+        message_data = event['postback']
 
-            if 'postback' in data['entry'][0]['messaging'][0]:
-                message_data = data['entry'][0]['messaging'][0]['postback']
+    send_loading_message(sender)  # Typing on signal
 
-            user = get_or_create_user(sender)
-            send_loading_message(sender)  # Typing on signal
+    status = get_conversation_status(user.id)  # The conversation status
+    metrics.record_status(status)
 
-            conversation = get_or_create_conversation(user.id)  # The conversation status
+    if status == 'init':
+        # First time user is accessing this bot
+        send_text_message(sender, get_response('intro'))
+        send_text_message(sender, 'Ainda não temos categorias cadastradas. Vamos começar com elas?')
+        send_text_message(sender, get_response('begin_add_category'))
 
-            if conversation.status == 'init':
-                # First time user is accessing this bot
-                send_text_message(sender, get_response('intro'))
-                send_text_message(sender, 'Ainda não temos categorias cadastradas. Vamos começar com elas?')
-                send_text_message(sender, get_response('begin_add_category'))
+        change_conversation_status(user.id, 'begin_add_category')
 
-                conversation.status = 'begin_add_category'
-                db.session.commit()
+    elif status == 'waiting':
+        # Default actions when the bot is waiting for an action to begin
+        if 'payload' in message_data:
+            # If some action is already choosed, do something
+            payload = message_data['payload']
+            verify_quick_message(user.id, sender, payload, status)
+        else:
+            # Actions asked by keywords, "quanto gastei com almoço?" searches right away
+            intent, query = split_keyword(text or '')
+            if intent == 'search' and search.search_terms(query):
+                send_text_message(sender, get_search_results(user.id, query))
+                send_quick_replies(sender, get_response('waiting'))
+            elif intent == 'cancel_recurring' and search.search_terms(query):
+                cancelled = cancel_recurring(user.id, query)
+                response_text = get_response('recurring_cancelled').format(
+                    ', '.join(template.description for template in cancelled)) if cancelled else \
+                    get_response('recurring_not_found').format(query)
+                send_text_message(sender, response_text)
+                send_quick_replies(sender, get_response('waiting'))
+            elif intent in ['recurring', 'cancel_recurring']:
+                send_text_message(sender, get_recurring_list(user.id))
+                send_quick_replies(sender, get_response('waiting'))
+            elif intent in ['monthly_summary', 'search']:
+                verify_quick_message(user.id, sender, intent, status)
+            else:
+                # If no action is choosed yet
+                send_quick_replies(sender, get_response('waiting'))
 
-            elif conversation.status == 'waiting':
-                # Default actions when the bot is waiting for an action to begin
-                if 'payload' in message_data:
-                    # If some action is already choosed, do something
-                    payload = message_data['payload']
-                    verify_quick_message(user.id, sender, payload, conversation.status)
-                else:
-                    # If no action is choosed yet
-                    send_quick_replies(sender, get_response('waiting'))
+    elif status == 'begin_search':
+        # Searches the words sent after the search action
+        change_conversation_status(user.id, 'waiting')
+        if 'payload' in message_data:
+            verify_quick_message(user.id, sender, message_data['payload'], 'waiting')
+        else:
+            send_text_message(sender, get_search_results(user.id, text))
+            send_quick_replies(sender, get_response('waiting'))
 
-            elif conversation.status == 'begin_add_category':
-                # Save categories
-                save_categories(user.id, text)
+    elif status == 'begin_add_category':
+        # Save categories
+        save_categories(user.id, text)
 
-                conversation.status = 'waiting'
-                db.session.commit()
+        change_conversation_status(user.id, 'waiting')
 
-                # Ok message
-                send_text_message(sender, get_response('done_add'))
+        # Ok message
+        send_text_message(sender, get_response('done_add'))
 
-                # Sends the category list
-                send_text_message(sender, get_category_list(user.id))
+        # Sends the category list
+        send_text_message(sender, get_category_list(user.id))
 
-                # Sends initial quick replies again
+        # Sends initial quick replies again
+        send_quick_replies(sender, get_response('waiting'))
+
+    elif status == 'begin_add_data':
+        # When the add data action is beginned
+        if 'payload' in message_data:
+            payload = message_data['payload']
+            verify_quick_message(user.id, sender, payload, status)
+        else:
+            # Tries again, keeping context
+            wrong_entry = get_entry(user.id, 'draft')
+
+            verify_quick_message(user.id, sender, wrong_entry.entry_type, None)
+
+    elif status == 'draft_add_data':
+        # Verifies the data from the new entry, and respond something
+        verify_new_entry(user.id, sender, text, status)
+
+    elif status == 'confirm_add_data':
+        # Confirm data before finish the process
+        if 'payload' in message_data:
+            # If user choosed to confirm or to reenter the data
+            payload = message_data['payload']
+            new_entry = get_entry(user.id, 'revision')
+            if payload in ['finalize', 'finalize_monthly']:
+                # Confims that data is corret, change status to DONE, all the lines at once
+                entries = get_entry_query(user.id, 'revision').all()
+                get_entry_query(user.id, 'revision').update({'status': 'done', 'updated_at': datetime.now()},
+                                                            synchronize_session=False)
+                add_to_summaries(entries)
+                add_to_balances(entries)
+                search.index_entries(db.session, entries)
+                if payload == 'finalize_monthly':
+                    add_recurring_entries(entries)
+                    send_text_message(sender, get_response('recurring_added').format(entries[0].date_time.day))
+                send_text_message(sender, get_response('done_add'))
                 send_quick_replies(sender, get_response('waiting'))
 
-            elif conversation.status == 'begin_add_data':
-                # When the add data action is beginned
-                if 'payload' in message_data:
-                    payload = message_data['payload']
-                    verify_quick_message(user.id, sender, payload, conversation.status)
-                else:
-                    # Tries again, keeping context
-                    wrong_entry = Budget.query.filter_by(user_id=user.id).first()
-
-                    verify_quick_message(user.id, sender, wrong_entry.entry_type, None)
-
-            elif conversation.status == 'draft_add_data':
-                # Verifies the data from the new entry, and respond something
-                verify_new_entry(user.id, sender, text, conversation.status)
-
-            elif conversation.status == 'confirm_add_data':
-                # Confirm data before finish the process
-                if 'payload' in message_data:
-                    # If user choosed to confirm or to reenter the data
-                    payload = message_data['payload']
-                    new_entry = Budget.query.filter_by(user_id=user.id,
-                                                       status='revision').first()
-                    if payload == 'finalize':
-                        # Confims that data is corret, change status to DONE
-                        new_entry.status = 'done'
-                        send_text_message(sender, get_response('done_add'))
-                        send_quick_replies(sender, get_response('waiting'))
-
-                        # Back to initial state of conversation
-                        conversation.status = 'waiting'
-                    else:
-                        # The data is wrong, tries agina
-                        new_entry.status = 'draft'
-                        # Sends a message asking to reenter the data
-                        send_text_message(sender, get_response('sorry_wrong_add'))
-
-                        # Back to state draft part of add data
-                        conversation.status = 'draft_add_data'
-                    db.session.commit()
-                else:
-                    # Sends the confirmation buttons
-                    sends_confirm_new_entry_buttons(user.id, sender)
+                # Back to initial state of conversation
+                new_status = 'waiting'
+            else:
+                # The data is wrong, tries agina
+                new_entry.status = 'draft'
+                new_entry.updated_at = datetime.now()
+                get_entry_query(user.id, 'revision').filter(Budget.id != new_entry.id) \
+                                                    .delete(synchronize_session=False)
+                # Sends a message asking to reenter the data
+                send_text_message(sender, get_response('sorry_wrong_add'))
+
+                # Back to state draft part of add data
+                new_status = 'draft_add_data'
+            save_changes()
+            change_conversation_status(user.id, new_status)
+        else:
+            # Sends the confirmation buttons
+            sends_confirm_new_entry_buttons(user.id, sender)
+
+
+def app_context():
+    return app.app_context()
 
+
+# Events of different users are handled at the same time
+dispatcher = EventDispatcher(handle_event, workers=dispatcher_workers, context=app_context)
+
+metrics.registry.register_stats('finbot_delivery', 'Outbound deliveries', messages.delivery.stats.as_dict)
+metrics.registry.register_stats('finbot_delivery_queue', 'Outbound deliveries',
+                                lambda: {'depth': messages.delivery.depth()})
+metrics.registry.register_stats('finbot_user_cache', 'Profile cache', user_cache.stats)
+metrics.registry.register_stats('finbot_profile_batches', 'Coalesced profile requests', profile_coalescer.stats)
+metrics.registry.register_stats('finbot_category_cache', 'Category quick replies cache', category_replies.stats)
+metrics.registry.register_stats('finbot_balance_cache', 'Daily balances cache', balance_cache.stats)
+metrics.registry.register_stats('finbot_conversations', 'Conversation statuses',
+                                lambda: {'pending': conversation_store.pending()})
+metrics.registry.register_stats('finbot_unit_of_work', 'Transactions of the events', unitofwork.stats.as_dict)
+metrics.registry.register_stats('finbot_dispatcher', 'Webhook batches', dispatcher.stats)
+metrics.registry.register_stats('finbot_recurring_scheduler', 'Due recurring entries', recurring_scheduler.stats)
+metrics.registry.register_stats('finbot_recent_events', 'Window of the recent event keys', recent_events.stats)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    if scheduler_enabled:
+        # Once per worker process, after the fork
+        recurring_scheduler.start()
+
+
+@app.after_request
+def observe_request(response):
+    start = getattr(g, 'request_start', None)
+    if start is not None:
+        endpoint = request.url_rule.rule if request.url_rule else 'unknown'
+        metrics.requests_seconds.observe(time.perf_counter() - start, endpoint=endpoint,
+                                         method=request.method, status=response.status_code)
+    return response
+
+
+export_columns = ['id', 'date', 'description', 'value', 'entry_type', 'category', 'status']
+
+
+def export_query(user_id, args):
+    """
+    Returns the query of the entries to export, archived ones included,
+    filtered by the request arguments
+    """
+    query = db.session.query(AllEntries.id, AllEntries.date_time, AllEntries.description, AllEntries.value,
+                             AllEntries.entry_type, Category.name, AllEntries.status) \
+                      .outerjoin(Category, Category.id == AllEntries.category_id) \
+                      .filter(AllEntries.user_id == user_id)
+
+    statuses = args.get('status', 'done').split(',')
+    if 'all' not in statuses:
+        query = query.filter(AllEntries.status.in_(statuses))
+    if args.get('start'):
+        query = query.filter(AllEntries.date_time >= datetime.strptime(args['start'], '%Y-%m-%d'))
+    if args.get('end'):
+        query = query.filter(AllEntries.date_time < datetime.strptime(args['end'], '%Y-%m-%d') +
+                             timedelta(days=1))
+    if args.get('category'):
+        query = query.filter(Category.normalized_name == normalize_text(args['category']))
+    return query
+
+
+def export_etag(user_id, query, file_format):
+    """
+    Returns the ETag of an export, it changes when any exported entry or the
+    categories of the user change
+    """
+    subquery = query.add_columns(AllEntries.updated_at.label('updated_at')).subquery()
+    count, last_id, last_update = db.session.query(db.func.count(), db.func.max(subquery.c.id),
+                                                   db.func.max(subquery.c.updated_at)).one()
+    # Merges and renames change the exported category names, not the entries
+    categories = category_version(user_id)
+    state = '{}|{}|{}|{}|{}|{}|{}'.format(user_id, file_format, request.query_string, count, last_id, last_update,
+                                          categories)
+    return hashlib.sha1(state.encode('utf-8')).hexdigest()
+
+
+def export_rows(query, file_format, header=True):
+    """
+    Yields the exported entries by chunks, reading them from a server side cursor
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if file_format == 'csv' and header:
+        writer.writerow(export_columns)
+
+    rows = query.order_by(AllEntries.id).execution_options(stream_results=True).yield_per(export_chunk_size)
+    for count, row in enumerate(rows, start=1):
+        row = list(row)
+        row[1] = row[1].strftime('%Y-%m-%d') if row[1] else None
+        if file_format == 'csv':
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(dict(zip(export_columns, row)), ensure_ascii=False) + '\n')
+
+        if count % export_chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+@app.route('/export/<int:user_id>')
+def export(user_id):
+    """
+    Streams the entries of an user as CSV or newline delimited JSON.
+
+    Accepts the start, end, category and status (or 'all') filters. An
+    interrupted download resumes with 'Range: id=<first id>-' and 'If-Range'
+    with the ETag of the first response.
+    """
+    authorization = request.headers.get('Authorization', '')
+    if not export_token or authorization != 'Bearer {}'.format(export_token):
+        return Response('Forbidden', status=403)
+
+    file_format = request.args.get('format', 'csv')
+    if file_format not in ('csv', 'ndjson'):
+        return Response('Unknown format', status=400)
+
+    try:
+        query = export_query(user_id, request.args)
+    except ValueError:
+        return Response('Dates must be formatted as YYYY-MM-DD', status=400)
+
+    etag = export_etag(user_id, query, file_format)
+    if request.headers.get('If-None-Match') == etag:
+        return Response(status=304, headers={'ETag': etag})
+
+    status = 200
+    headers = {'ETag': etag, 'Accept-Ranges': 'id'}
+    match = re.match(r'^id=(\d+)-$', request.headers.get('Range', ''))
+    if match and request.headers.get('If-Range', etag) == etag:
+        # Resumes from the given entry, the entries before it are not read again
+        query = query.filter(AllEntries.id >= int(match.group(1)))
+        headers['Content-Range'] = 'id {}-*'.format(match.group(1))
+        status = 206
+
+    mimetype = 'text/csv' if file_format == 'csv' else 'application/x-ndjson'
+    headers['Content-Disposition'] = 'attachment; filename=finbot-{}.{}'.format(user_id, file_format)
+    return Response(stream_with_context(export_rows(query, file_format, header=status == 200)),
+                    status=status, headers=headers, mimetype=mimetype)
+
+
+@app.route('/metrics')
+def metrics_page():
+    """
+    Prometheus metrics, protected by FINBOT_METRICS_TOKEN when it is set
+    """
+    if metrics_token and request.headers.get('Authorization', '') != 'Bearer {}'.format(metrics_token):
+        return Response('Forbidden', status=403)
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/')
+def index():
+    return 'Finbot'
+
+@app.route('/webhook', methods=['GET', 'POST'])
+def webhook():
+    if request.method == 'POST':
+        try:
+            with metrics.stage_seconds.time(stage='parse'):
+                data = json.loads(request.data.decode())
+            with metrics.stage_seconds.time(stage='dispatch'):
+                report = dispatcher.dispatch(data)
+            app.logger.debug(report)
         except Exception as e:
             print(traceback.format_exc())  # something went wrong
     elif request.method == 'GET': # For the initial verification
@@ -419,7 +1627,6 @@ def webhook():
     return "Nothing"
 
 if __name__ == '__main__':
-    # Verify if database exists and create it
-    if not os.path.isfile(db_file):
-        db.create_all()
+    # Creates the missing tables and updates the existing ones
+    migrations.upgrade(db.engine, db.metadata)
     app.run()
@@ -0,0 +1,260 @@
+"""
+Streaming import of bank statements (CSV and OFX) as finished entries
+"""
+import csv
+import hashlib
+import re
+
+from collections import namedtuple
+from datetime import datetime
+
+from finbot import db, Budget, BudgetArchive, Category, handle_date, handle_value, save_categories, \
+                   add_to_summaries, add_to_balances, insert_ignore
+from normalize import normalize_text
+from unitofwork import UnitOfWork
+import search
+
+# Fields of an imported row, also what add_to_summaries and add_to_balances need
+ImportedEntry = namedtuple('ImportedEntry', ['user_id', 'category_id', 'description', 'value',
+                                             'date_time', 'entry_type', 'import_key'])
+
+csv_columns = {
+    'date': ['data', 'date', 'dia'],
+    'description': ['descricao', 'description', 'historico', 'memo', 'lancamento'],
+    'value': ['valor', 'value', 'amount', 'quantia'],
+    'category': ['categoria', 'category'],
+    'entry_type': ['tipo', 'type'],
+}
+
+deposit_types = ['entrada', 'deposit', 'credito', 'credit', 'c']
+iso_date = re.compile(r'^(\d{4})-?(\d{2})-?(\d{2})')
+# Dots separating the thousands of an amount without decimals, like 1.500
+dot_thousands = re.compile(r'(?<![\d.])\d{1,3}(?:\.\d{3})+(?![\d.])')
+ofx_tag = re.compile(r'<(/?)([A-Za-z0-9.]+)>([^<]*)')
+
+
+class ImportReport(object):
+    """
+    Counters of an import
+    """
+    def __init__(self):
+        self.read = 0
+        self.inserted = 0
+        self.duplicated = 0
+        self.invalid = 0
+        self.batches = 0
+
+    def __repr__(self):
+        return '<ImportReport read={} inserted={} duplicated={} invalid={} batches={}>'.format(
+            self.read, self.inserted, self.duplicated, self.invalid, self.batches)
+
+
+def parse_amount(raw):
+    """
+    Returns the signed value of an amount like '-1.234,56', 'R$ -20,00',
+    '1.500', '-1,234.56', '20.90' or '(15,00)'
+    """
+    raw = raw.strip()
+    if ',' in raw and raw.rfind('.') > raw.rfind(','):
+        # Commas separate the thousands, '1,234.56'
+        raw = raw.replace(',', '')
+    elif ',' in raw:
+        # Brazilian format, dots separate the thousands
+        raw = raw.replace('.', '').replace(',', '.')
+    else:
+        raw = dot_thousands.sub(lambda match: match.group().replace('.', ''), raw)
+    value = handle_value(raw)
+    negative = value < 0 or raw.endswith('-') or raw.startswith('(')
+    return -abs(value) if negative else abs(value)
+
+
+def parse_date(raw):
+    """
+    Returns the datetime of an ISO or OFX date, or of any format get_date knows
+    """
+    match = iso_date.match(raw.strip())
+    if match:
+        return datetime(*[int(part) for part in match.groups()])
+    return handle_date(raw)
+
+
+def import_key(row, occurrence):
+    """
+    Returns the dedup key of a row, the same row always has the same key
+    """
+    parts = [row.get('fitid') or '', row['date_time'].strftime('%Y%m%d'), '{:.2f}'.format(row['value']),
+             normalize_text(row['description']), str(occurrence)]
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+
+def read_csv(stream):
+    """
+    Yields the rows of a CSV statement as dicts of raw strings
+    """
+    sample = stream.read(4096)
+    stream.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+
+    reader = csv.reader(stream, dialect)
+    header = [normalize_text(name) for name in next(reader)]
+    positions = {}
+    for field, aliases in csv_columns.items():
+        for alias in aliases:
+            if alias in header:
+                positions[field] = header.index(alias)
+                break
+
+    missing = [field for field in ('date', 'description', 'value') if field not in positions]
+    if missing:
+        raise ValueError('Missing CSV columns: {}'.format(', '.join(missing)))
+
+    for line in reader:
+        if not any(line):
+            continue
+        yield dict((field, line[position] if position < len(line) else '')
+                   for field, position in positions.items())
+
+
+def ofx_tokens(stream, chunk_size=65536):
+    """
+    Yields (closing, tag, value) of an OFX file, reading it by chunks
+    """
+    buffer = ''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        buffer += chunk
+        cut = buffer.rfind('<')
+        if cut <= 0:
+            continue
+        complete, buffer = buffer[:cut], buffer[cut:]
+        for match in ofx_tag.finditer(complete):
+            yield match.group(1) == '/', match.group(2).upper(), match.group(3).strip()
+    for match in ofx_tag.finditer(buffer):
+        yield match.group(1) == '/', match.group(2).upper(), match.group(3).strip()
+
+
+def read_ofx(stream):
+    """
+    Yields the transactions of an OFX statement as dicts of raw strings
+    """
+    transaction = None
+    for closing, tag, value in ofx_tokens(stream):
+        if tag == 'STMTTRN':
+            if closing and transaction is not None:
+                yield {
+                    'date': transaction.get('DTPOSTED', ''),
+                    'description': transaction.get('MEMO') or transaction.get('NAME', ''),
+                    'value': transaction.get('TRNAMT', ''),
+                    'fitid': transaction.get('FITID'),
+                }
+                transaction = None
+            elif not closing:
+                transaction = {}
+        elif transaction is not None and not closing and value:
+            transaction[tag] = value
+
+
+def category_ids(user_id, names, cache):
+    """
+    Returns {normalized name: category id}, creating the missing categories
+    """
+    missing = [name for name in names if normalize_text(name) not in cache]
+    if missing:
+        save_categories(user_id, ','.join(missing))
+        normalized = [normalize_text(name) for name in missing]
+        for category_id, name in db.session.query(Category.id, Category.normalized_name) \
+                                           .filter(Category.user_id == user_id,
+                                                   Category.normalized_name.in_(normalized)):
+            cache[name] = category_id
+    return cache
+
+
+def insert_batch(user_id, rows, report, categories):
+    """
+    Inserts the new rows of a batch in a single transaction
+    """
+    with UnitOfWork(db.session):
+        keys = [row['import_key'] for row in rows]
+        existing = db.session.query(Budget.import_key) \
+                             .filter(Budget.user_id == user_id, Budget.import_key.in_(keys))
+        archived = db.session.query(BudgetArchive.import_key) \
+                             .filter(BudgetArchive.user_id == user_id, BudgetArchive.import_key.in_(keys))
+        existing = set(key for (key,) in existing.union_all(archived))
+
+        new_rows = [row for row in rows if row['import_key'] not in existing]
+        report.duplicated += len(rows) - len(new_rows)
+
+        if new_rows:
+            category_ids(user_id, set(row['category'] for row in new_rows), categories)
+            now = datetime.now()
+            entries = [ImportedEntry(user_id, categories.get(normalize_text(row['category'])),
+                                     row['description'][:120], abs(row['value']), row['date_time'],
+                                     'withdrawal' if row['negative'] else 'deposit', row['import_key'])
+                       for row in new_rows]
+            values = [dict(entry._asdict(), normalized_description=normalize_text(entry.description or ''),
+                           status='done', created_at=now, updated_at=now) for entry in entries]
+            db.session.execute(insert_ignore(Budget.__table__), values)
+
+            # The rows actually inserted, the ignored ones were imported meanwhile
+            inserted = db.session.query(Budget.id, Budget.user_id, Budget.category_id, Budget.description,
+                                        Budget.value, Budget.date_time, Budget.entry_type) \
+                                 .filter(Budget.user_id == user_id, Budget.created_at == now,
+                                         Budget.import_key.in_([entry.import_key for entry in entries])).all()
+            add_to_summaries(inserted)
+            add_to_balances(inserted)
+            if search.is_ready(db.session):
+                search.index_entries(db.session, inserted)
+            report.inserted += len(inserted)
+            report.duplicated += len(entries) - len(inserted)
+
+    report.batches += 1
+
+
+def import_statement(user_id, stream, file_format='csv', default_category='Importados', batch_size=1000):
+    """
+    Imports a CSV or OFX statement as finished entries of an user. Rows already
+    imported are skipped, so importing an overlapping statement is cheap.
+    """
+    reader = read_ofx(stream) if file_format == 'ofx' else read_csv(stream)
+    report = ImportReport()
+    categories = {}
+    occurrences = {}
+    batch = []
+
+    for raw in reader:
+        report.read += 1
+        try:
+            value = parse_amount(raw['value'])
+            row = {
+                'description': raw['description'].strip(),
+                'date_time': parse_date(raw['date']),
+                'value': value,
+                'fitid': raw.get('fitid'),
+                'category': raw.get('category', '').replace(',', ' ').strip() or default_category,
+            }
+        except (ValueError, IndexError):
+            report.invalid += 1
+            continue
+
+        entry_type = normalize_text(raw.get('entry_type', ''))
+        row['negative'] = entry_type not in deposit_types if entry_type else value < 0
+
+        # Identical rows are told apart by their order within the day, over
+        # the whole file since the statements are not always sorted by date
+        identity = (row['date_time'], row['fitid'], row['value'], normalize_text(row['description']))
+        occurrences[identity] = occurrences.get(identity, 0) + 1
+        row['import_key'] = import_key(row, occurrences[identity])
+
+        batch.append(row)
+        if len(batch) >= batch_size:
+            insert_batch(user_id, batch, report, categories)
+            batch = []
+
+    if batch:
+        insert_batch(user_id, batch, report, categories)
+    return report
@@ -0,0 +1,150 @@
+"""
+Matches the messages against the keywords of every intent in a single scan
+"""
+import json
+import os
+import threading
+import time
+
+from collections import deque
+
+from normalize import normalize_text
+
+
+class KeywordAutomaton(object):
+    """
+    Aho-Corasick automaton of the normalized keywords.
+
+    The match is the longest keyword found between word boundaries, the first
+    one in the message when they have the same size.
+    """
+    def __init__(self, keywords):
+        self.goto = [{}]
+        self.fail = [0]
+        self.outputs = [[]]
+
+        for intent, phrases in keywords.items():
+            for phrase in phrases:
+                phrase = normalize_text(phrase)
+                if phrase:
+                    self._add(phrase, intent)
+        self._link()
+
+    def _add(self, phrase, intent):
+        node = 0
+        for char in phrase:
+            next_node = self.goto[node].get(char)
+            if next_node is None:
+                next_node = len(self.goto)
+                self.goto[node][char] = next_node
+                self.goto.append({})
+                self.fail.append(0)
+                self.outputs.append([])
+            node = next_node
+        self.outputs[node].append((len(phrase), intent))
+
+    def _link(self):
+        """
+        Breadth first computation of the failure links
+        """
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                state = self.fail[node]
+                while state and char not in self.goto[state]:
+                    state = self.fail[state]
+                self.fail[child] = self.goto[state].get(char, 0)
+                self.outputs[child] = self.outputs[child] + self.outputs[self.fail[child]]
+
+    def match(self, message):
+        """
+        Returns the intent of the best keyword found in the message
+        """
+        return self.search(message)[0]
+
+    def search(self, message):
+        """
+        Returns the intent of the best keyword found in the message and the
+        normalized text after it
+        """
+        text = normalize_text(message)
+        goto = self.goto
+        fail = self.fail
+        outputs = self.outputs
+        size = len(text)
+
+        best = None
+        best_length = 0
+        best_start = size
+        node = 0
+        for position, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for length, intent in outputs[node]:
+                start = position - length + 1
+                if start > 0 and text[start - 1].isalnum():
+                    continue
+                if position + 1 < size and text[position + 1].isalnum():
+                    continue
+                if length > best_length or (length == best_length and start < best_start):
+                    best, best_length, best_start = intent, length, start
+        if best is None:
+            return None, text
+        return best, text[best_start + best_length:].strip()
+
+
+class IntentMatcher(object):
+    """
+    Keeps the automaton of the default keywords plus the ones of an optional
+    JSON file ({"intent": ["keyword", ...]}). The file is checked for changes
+    every check_interval seconds and the automaton is swapped when it changes.
+    """
+    def __init__(self, keywords, path=None, check_interval=30):
+        self.keywords = keywords
+        self.path = path
+        self.check_interval = check_interval
+
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked_at = 0
+        self.automaton = None
+        self.reload()
+
+    def load(self):
+        """
+        Returns the default keywords merged with the ones of the file
+        """
+        keywords = dict((intent, list(phrases)) for intent, phrases in self.keywords.items())
+        if self.path and os.path.isfile(self.path):
+            with open(self.path, encoding='utf-8') as keywords_file:
+                for intent, phrases in json.load(keywords_file).items():
+                    keywords.setdefault(intent, []).extend(phrases)
+        return keywords
+
+    def reload(self):
+        """
+        Builds the automaton again, the running matches keep the previous one
+        """
+        with self._lock:
+            self._mtime = os.path.getmtime(self.path) if self.path and os.path.isfile(self.path) else None
+            self._checked_at = time.time()
+            self.automaton = KeywordAutomaton(self.load())
+
+    def _check(self):
+        if not self.path or time.time() - self._checked_at < self.check_interval:
+            return
+        self._checked_at = time.time()
+        mtime = os.path.getmtime(self.path) if os.path.isfile(self.path) else None
+        if mtime != self._mtime:
+            self.reload()
+
+    def match(self, message):
+        self._check()
+        return self.automaton.match(message)
+
+    def search(self, message):
+        self._check()
+        return self.automaton.search(message)
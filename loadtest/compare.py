@@ -0,0 +1,135 @@
+"""
+Load comparison of the two serving modes of the webhook: gunicorn with sync
+workers and the event loop of asyncmode.py.
+
+Each mode gets a new SQLite database and the same fake Graph API, started
+here, then the generator replays the same conversations against it.
+
+    python loadtest/compare.py --users 2000 --concurrency 200 --latency 0.05 --workers 4
+
+Needs gunicorn and aiohttp installed.
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+sys.path.insert(0, here)
+
+from fake_graph import FakeGraphServer  # noqa: E402
+
+throughput = re.compile(r'([\d.]+) requests/s')
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_ready(url, process, timeout=30):
+    """
+    Waits until the bot answers, fails when it exits first
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('The server exited with {}'.format(process.returncode))
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError('The server did not answer in {}s'.format(timeout))
+
+
+def server_command(mode, port, args):
+    if mode == 'sync':
+        return [sys.executable, '-m', 'gunicorn', '-w', str(args.workers), '-b', '127.0.0.1:{}'.format(port),
+                '--timeout', '120', 'finbot:app']
+    return [sys.executable, 'asyncmode.py', '--host', '127.0.0.1', '--port', str(port)]
+
+
+def run_mode(mode, graph, args):
+    """
+    Runs the generator against a server of the mode, returns its report and the Graph API calls
+    """
+    directory = tempfile.mkdtemp()
+    env = dict(os.environ)
+    env.update({'DATABASE_URL': 'sqlite:///{}'.format(os.path.join(directory, 'finbot.db')),
+                'FB_GRAPH_URL': 'http://127.0.0.1:{}/v2.6'.format(graph.server_address[1]),
+                'FB_ACCESS_TOKEN': env.get('FB_ACCESS_TOKEN', 'loadtest')})
+    subprocess.check_call([sys.executable, 'manage.py', 'migrate'], cwd=root, env=env, stdout=subprocess.DEVNULL)
+
+    port = free_port()
+    target = 'http://127.0.0.1:{}'.format(port)
+    log = open(os.path.join(directory, 'server.log'), 'w')
+    server = subprocess.Popen(server_command(mode, port, args), cwd=root, env=env, stdout=log, stderr=log)
+    try:
+        wait_ready(target + '/', server)
+        before = graph.stats.as_dict()
+        output = subprocess.check_output([sys.executable, os.path.join(here, 'generator.py'), target,
+                                          '--users', str(args.users), '--concurrency', str(args.concurrency),
+                                          '--think', str(args.think), '--first-id', str(args.first_id)],
+                                         cwd=root, env=env, universal_newlines=True)
+        after = graph.stats.as_dict()
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        log.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    calls = dict((name, after[name] - before.get(name, 0)) for name in after if after[name] != before.get(name, 0))
+    return output, calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--users', type=int, default=1000, help='synthetic users, each one a whole conversation')
+    parser.add_argument('--concurrency', type=int, default=200, help='users talking at the same time')
+    parser.add_argument('--think', type=float, default=0.0, help='maximum random seconds between messages')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn sync workers')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the fake Graph API takes to answer')
+    parser.add_argument('--modes', default='sync,async')
+    parser.add_argument('--first-id', type=int, default=10 ** 14)
+    args = parser.parse_args()
+
+    graph = FakeGraphServer(('127.0.0.1', 0), latency=args.latency)
+    thread = threading.Thread(target=graph.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    rates = {}
+    for mode in args.modes.split(','):
+        output, calls = run_mode(mode, graph, args)
+        print('== {} =='.format(mode))
+        print(output.rstrip())
+        print('Graph API calls: {}'.format(json.dumps(calls, sort_keys=True)))
+        print()
+        match = throughput.search(output)
+        rates[mode] = float(match.group(1)) if match else 0.0
+
+    graph.shutdown()
+    if rates.get('sync') and rates.get('async'):
+        print('async/sync throughput: {:.2f}x'.format(rates['async'] / rates['sync']))
+
+
+if __name__ == '__main__':
+    main()
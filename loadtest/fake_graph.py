@@ -0,0 +1,160 @@
+"""
+Local stand-in of graph.facebook.com for the load test.
+
+Answers the profile lookups (GET /v2.6/<id>), the batch requests of
+profiles (POST /v2.6/) and the Send API (POST /v2.6/me/messages) after a
+configurable latency, failing a share of the calls with a 500. GET /stats
+returns the counters as JSON.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+
+profile_path = re.compile(r'^/v[\d.]+/(\d+)$')
+messages_path = re.compile(r'^/v[\d.]+/me/messages/?$')
+batch_path = re.compile(r'^/v[\d.]+/?$')
+
+
+def profile(sender):
+    return {'first_name': 'User', 'last_name': sender, 'profile_pic': '',
+            'locale': 'pt_BR', 'timezone': -3, 'gender': 'male', 'id': sender}
+
+
+class Stats(object):
+    """
+    Counters of the calls received, shared by the request threads
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+
+    def incr(self, name):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def as_dict(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+class FakeGraphServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, jitter=0.0, error_rate=0.0):
+        HTTPServer.__init__(self, address, FakeGraphHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.stats = Stats()
+
+
+class FakeGraphHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def simulate(self, name):
+        """
+        Waits the latency of the call, returns False when it must fail
+        """
+        server = self.server
+        delay = server.latency + random.uniform(0, server.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if random.random() < server.error_rate:
+            server.stats.incr('{}_errors'.format(name))
+            self.reply(500, {'error': {'message': 'Simulated error', 'code': 2}})
+            return False
+        server.stats.incr(name)
+        return True
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path.endswith('/stats'):
+            return self.reply(200, self.server.stats.as_dict())
+
+        match = profile_path.match(path)
+        if not match:
+            return self.reply(404, {'error': {'message': 'Unknown path', 'code': 803}})
+        if self.simulate('profiles'):
+            self.reply(200, profile(match.group(1)))
+
+    def batch(self, body):
+        """
+        Answers a batch request, every item has its code and a JSON encoded body
+        """
+        try:
+            requests = json.loads(parse_qs(body.decode('utf-8'))['batch'][0])
+        except (ValueError, KeyError, IndexError):
+            self.server.stats.incr('invalid_batches')
+            return self.reply(400, {'error': {'message': 'Invalid batch', 'code': 100}})
+
+        if self.simulate('batches'):
+            responses = []
+            for item in requests:
+                match = profile_path.match('/v2.6/' + item.get('relative_url', '').split('?')[0])
+                if match:
+                    self.server.stats.incr('batch_profiles')
+                    responses.append({'code': 200, 'headers': [], 'body': json.dumps(profile(match.group(1)))})
+                else:
+                    responses.append({'code': 404, 'headers': [], 'body': json.dumps({'error': {'code': 803}})})
+            self.reply(200, responses)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        if batch_path.match(self.path.split('?')[0]):
+            return self.batch(body)
+        if not messages_path.match(self.path.split('?')[0]):
+            return self.reply(404, {'error': {'message': 'Unknown path', 'code': 803}})
+
+        try:
+            payload = json.loads(body.decode('utf-8'))
+            recipient = payload['recipient']['id']
+        except (ValueError, KeyError, TypeError):
+            self.server.stats.incr('invalid_messages')
+            return self.reply(400, {'error': {'message': 'Invalid payload', 'code': 100}})
+
+        name = 'actions' if 'sender_action' in payload else 'messages'
+        if self.simulate(name):
+            self.reply(200, {'recipient_id': recipient, 'message_id': 'mid.{}'.format(random.getrandbits(48))})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in of the Graph API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds before each answer')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random seconds added to the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of the calls answered with 500')
+    args = parser.parse_args()
+
+    server = FakeGraphServer((args.host, args.port), args.latency, args.jitter, args.error_rate)
+    print('Fake Graph API on http://{}:{}/v2.6'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(server.stats.as_dict(), sort_keys=True))
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
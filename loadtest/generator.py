@@ -0,0 +1,136 @@
+"""
+Load generator of the webhook.
+
+Every synthetic user walks the whole conversation, from init to
+confirm_add_data and back to waiting, posting the same payloads Messenger
+posts. Reports the throughput and the p50/p95/p99 latency by status.
+
+    python loadtest/generator.py http://127.0.0.1:8000 --users 2000 --concurrency 50
+"""
+import argparse
+import json
+import random
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# (status the message is sent in, kind, content) of a whole conversation
+conversation = [
+    ('init', 'text', 'Oi'),
+    ('begin_add_category', 'text', 'Casa, Mercado, Lazer, Transporte'),
+    ('waiting', 'quick_reply', 'withdrawal'),
+    ('begin_add_data', 'quick_reply', 'Mercado'),
+    ('draft_add_data', 'text', 'Feira da semana, R$ 35,90, 10/12'),
+    ('confirm_add_data', 'postback', 'finalize'),
+]
+
+states = [state for state, kind, content in conversation]
+local = threading.local()
+
+
+def session():
+    if not hasattr(local, 'session'):
+        local.session = requests.Session()
+    return local.session
+
+
+def webhook_payload(sender, kind, content):
+    """
+    Returns the body Messenger posts for a message, quick reply or postback
+    """
+    timestamp = int(time.time() * 1000)
+    event = {'sender': {'id': str(sender)}, 'recipient': {'id': '1'}, 'timestamp': timestamp}
+    if kind == 'postback':
+        event['postback'] = {'payload': content}
+    else:
+        event['message'] = {'mid': 'mid.{}.{}'.format(sender, random.getrandbits(32)), 'seq': 1, 'text': content}
+        if kind == 'quick_reply':
+            event['message']['quick_reply'] = {'payload': content}
+    return {'object': 'page', 'entry': [{'id': '1', 'time': timestamp, 'messaging': [event]}]}
+
+
+class Results(object):
+    """
+    Latencies and errors by status, shared by the user threads
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = dict((state, []) for state in states)
+        self.errors = dict((state, 0) for state in states)
+
+    def add(self, state, elapsed, ok):
+        with self._lock:
+            self.latencies[state].append(elapsed)
+            if not ok:
+                self.errors[state] += 1
+
+
+def percentile(values, percent):
+    """
+    Nearest rank percentile of sorted values
+    """
+    if not values:
+        return 0.0
+    rank = max(int(round(percent / 100.0 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def run_user(url, sender, results, think, timeout):
+    for state, kind, content in conversation:
+        body = json.dumps(webhook_payload(sender, kind, content))
+        start = time.perf_counter()
+        try:
+            response = session().post(url, data=body, timeout=timeout,
+                                      headers={'Content-Type': 'application/json'})
+            ok = response.status_code == 200
+        except requests.RequestException:
+            ok = False
+        results.add(state, time.perf_counter() - start, ok)
+        if think:
+            time.sleep(random.uniform(0, think))
+
+
+def report(results, elapsed):
+    total = sum(len(values) for values in results.latencies.values())
+    print('{} requests in {:.1f}s, {:.1f} requests/s'.format(total, elapsed, total / elapsed if elapsed else 0))
+    print('{:20} {:>8} {:>7} {:>9} {:>9} {:>9}'.format('status', 'requests', 'errors', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for state in states:
+        values = sorted(results.latencies[state])
+        print('{:20} {:8} {:7} {:9.1f} {:9.1f} {:9.1f}'.format(
+            state, len(values), results.errors[state], percentile(values, 50) * 1000,
+            percentile(values, 95) * 1000, percentile(values, 99) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load generator of the webhook')
+    parser.add_argument('target', help='base URL of the bot, like http://127.0.0.1:8000')
+    parser.add_argument('--users', type=int, default=1000, help='synthetic users, each one a whole conversation')
+    parser.add_argument('--concurrency', type=int, default=20, help='users talking at the same time')
+    parser.add_argument('--think', type=float, default=0.0, help='maximum random seconds between messages')
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--first-id', type=int, default=None,
+                        help='id of the first user, random by default so each run has new users')
+    parser.add_argument('--graph-url', default=None,
+                        help='base URL of the fake Graph API, to print its counters at the end')
+    args = parser.parse_args()
+
+    url = '{}/webhook'.format(args.target.rstrip('/'))
+    first_id = args.first_id if args.first_id is not None else random.randint(10 ** 14, 10 ** 15)
+    results = Results()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for index in range(args.users):
+            executor.submit(run_user, url, first_id + index, results, args.think, args.timeout)
+    report(results, time.perf_counter() - start)
+
+    if args.graph_url:
+        stats = requests.get('{}/stats'.format(args.graph_url.rstrip('/')), timeout=args.timeout).json()
+        print('Graph API calls: {}'.format(json.dumps(stats, sort_keys=True)))
+
+
+if __name__ == '__main__':
+    main()
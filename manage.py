@@ -0,0 +1,210 @@
+"""
+Maintenance commands of the bot
+
+    python manage.py migrate [--status]
+    python manage.py copy-data sqlite:////path/to/finbot_database.db
+    python manage.py rebuild-summaries [--user USER_ID]
+    python manage.py rebuild-search [--user USER_ID]
+    python manage.py check-balances [--user USER_ID] [--repair]
+    python manage.py purge-events [--hours 48]
+    python manage.py archive [--days 365] [--draft-hours 24]
+    python manage.py scheduler [--once]
+    python manage.py import USER_ID statement.csv [--format ofx] [--category Importados]
+"""
+import argparse
+import io
+
+from datetime import datetime
+
+from sqlalchemy import create_engine, func, inspect, select, text
+
+from finbot import app, db, migrations, rebuild_summaries, purge_processed_events, check_balances, \
+                   rebuild_balances
+import search
+
+
+def migrate(args):
+    """
+    Creates the missing tables and applies the pending migrations
+    """
+    if args.status:
+        version, pending = migrations.pending(db.engine)
+        print('Schema version {}, pending migrations: {}'.format(version, pending or 'none'))
+        return
+
+    applied = migrations.upgrade(db.engine, db.metadata)
+    print('Applied migrations: {}'.format(applied or 'none'))
+
+
+def copy_data(args):
+    """
+    Copies every table from another database, like the old SQLite file, to the configured one
+    """
+    source = create_engine(args.source)
+    migrations.upgrade(source, db.metadata)
+    migrations.upgrade(db.engine, db.metadata)
+
+    for table in db.metadata.sorted_tables:
+        source_columns = [c['name'] for c in inspect(source).get_columns(table.name)]
+        columns = [column for column in table.columns if column.name in source_columns]
+        query = select([table.c[column.name] for column in columns]).order_by(*table.primary_key.columns)
+
+        copied = 0
+        with db.engine.begin() as conn:
+            if conn.execute(select([func.count()]).select_from(table)).scalar():
+                print('Skipping {}, it already has rows'.format(table.name))
+                continue
+            result = source.execute(query)
+            while True:
+                rows = result.fetchmany(args.batch_size)
+                if not rows:
+                    break
+                conn.execute(table.insert(), [dict(zip([c.name for c in columns], row)) for row in rows])
+                copied += len(rows)
+
+            if conn.dialect.name == 'postgresql' and 'id' in table.c:
+                # The copied ids were not taken from the sequence
+                conn.execute(text("SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+                                  "COALESCE((SELECT MAX(id) FROM {}), 0) + 1, false)"
+                                  .format(conn.dialect.identifier_preparer.quote(table.name))),
+                             table=conn.dialect.identifier_preparer.quote(table.name))
+        print('Copied {} rows of {}'.format(copied, table.name))
+
+    with db.engine.begin() as conn:
+        print('Indexed {} entries for search'.format(search.rebuild(conn)))
+
+
+def rebuild(args):
+    """
+    Computes the monthly summaries again from the finished entries
+    """
+    count = rebuild_summaries(args.user)
+    print('Rebuilt {} monthly summaries'.format(count))
+
+
+def rebuild_search(args):
+    """
+    Normalizes and indexes the descriptions of the finished entries again for the search
+    """
+    with db.engine.begin() as conn:
+        if not search.is_ready(conn):
+            print('The database has no search index, the search scans the normalized descriptions')
+        count = search.rebuild(conn, args.user)
+    print('Indexed {} entries'.format(count))
+
+
+def balances(args):
+    """
+    Compares the daily balances with the finished entries, --repair rebuilds the ones that differ
+    """
+    users = check_balances(args.user)
+    print('{} users with wrong balances{}'.format(len(users), ': {}'.format(users) if users else ''))
+    if args.repair:
+        count = sum(rebuild_balances(user_id) for user_id in users)
+        print('Rebuilt {} daily balances'.format(count))
+
+
+def purge_events(args):
+    """
+    Removes the keys of the webhook events older than the retention
+    """
+    removed = purge_processed_events(args.hours)
+    print('Removed {} processed events'.format(removed))
+
+
+def archive_entries(args):
+    """
+    Removes the stale drafts and moves the old finished entries to the archive table
+    """
+    import archive
+
+    report = archive.run(args.days, args.draft_hours, args.batch_size)
+    print(report)
+
+
+def run_scheduler(args):
+    """
+    Creates the recurring entries when they are due, --once only the ones due now
+    """
+    from finbot import recurring_scheduler
+
+    if args.once:
+        recurring_scheduler.load()
+        print('Created the entries of {} recurring ones'.format(recurring_scheduler.run_pending(datetime.now())))
+        return
+    print('Waiting for the recurring entries, {} scheduled'.format(len(recurring_scheduler.loader())))
+    recurring_scheduler.run_forever()
+
+
+def import_file(args):
+    """
+    Imports a CSV or OFX bank statement as finished entries of an user
+    """
+    import importer
+
+    file_format = args.format or ('ofx' if args.path.lower().endswith('.ofx') else 'csv')
+    with io.open(args.path, encoding=args.encoding, newline='') as stream:
+        report = importer.import_statement(args.user, stream, file_format,
+                                           default_category=args.category,
+                                           batch_size=args.batch_size)
+    print(report)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Finbot maintenance commands')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    command = commands.add_parser('migrate', help=migrate.__doc__.strip())
+    command.add_argument('--status', action='store_true', help='only shows the pending migrations')
+    command.set_defaults(func=migrate)
+
+    command = commands.add_parser('copy-data', help=copy_data.__doc__.strip())
+    command.add_argument('source', help='SQLAlchemy URL of the source database')
+    command.add_argument('--batch-size', type=int, default=1000)
+    command.set_defaults(func=copy_data)
+
+    command = commands.add_parser('rebuild-summaries', help=rebuild.__doc__.strip())
+    command.add_argument('--user', type=int, help='only the summaries of this user id')
+    command.set_defaults(func=rebuild)
+
+    command = commands.add_parser('rebuild-search', help=rebuild_search.__doc__.strip())
+    command.add_argument('--user', type=int, help='only the entries of this user id')
+    command.set_defaults(func=rebuild_search)
+
+    command = commands.add_parser('check-balances', help=balances.__doc__.strip())
+    command.add_argument('--user', type=int, help='only the balances of this user id')
+    command.add_argument('--repair', action='store_true', help='rebuilds the balances of the users that differ')
+    command.set_defaults(func=balances)
+
+    command = commands.add_parser('purge-events', help=purge_events.__doc__.strip())
+    command.add_argument('--hours', type=int, help='retention, FINBOT_DEDUP_RETENTION_HOURS by default')
+    command.set_defaults(func=purge_events)
+
+    command = commands.add_parser('archive', help=archive_entries.__doc__.strip())
+    command.add_argument('--days', type=int, help='age of the archived entries, FINBOT_ARCHIVE_DAYS by default')
+    command.add_argument('--draft-hours', type=int,
+                         help='age of the removed drafts, FINBOT_STALE_DRAFT_HOURS by default')
+    command.add_argument('--batch-size', type=int, default=1000)
+    command.set_defaults(func=archive_entries)
+
+    command = commands.add_parser('scheduler', help=run_scheduler.__doc__.strip())
+    command.add_argument('--once', action='store_true', help='runs the due entries and exits, to use from cron')
+    command.set_defaults(func=run_scheduler)
+
+    command = commands.add_parser('import', help=import_file.__doc__.strip())
+    command.add_argument('user', type=int, help='user id')
+    command.add_argument('path', help='CSV or OFX file')
+    command.add_argument('--format', choices=['csv', 'ofx'], help='guessed from the file extension by default')
+    command.add_argument('--category', default='Importados', help='category of the rows without one')
+    command.add_argument('--encoding', default='utf-8')
+    command.add_argument('--batch-size', type=int, default=1000)
+    command.set_defaults(func=import_file)
+
+    args = parser.parse_args()
+    with app.app_context():
+        args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,33 @@
+import json
 import os
 import random
+import time
+import traceback
+
 import requests
 
+import metrics
+from delivery import DeliveryQueue
+from intents import IntentMatcher
+from unitofwork import current_unit
+
 # Configurations
 token = os.environ.get('FB_ACCESS_TOKEN')
+graph_url = os.environ.get('FB_GRAPH_URL', 'https://graph.facebook.com/v2.6').rstrip('/')
+delivery_workers = int(os.environ.get('FINBOT_DELIVERY_WORKERS', 4))
+delivery_queue_size = int(os.environ.get('FINBOT_DELIVERY_QUEUE_SIZE', 1000))
+delivery_sync = os.environ.get('FINBOT_DELIVERY_SYNC') == '1'
+keywords_file = os.environ.get('FINBOT_KEYWORDS_FILE')
+
+# Fields of the profiles asked in the batch requests
+profile_fields = 'first_name,last_name,profile_pic,locale,timezone,gender'
+
+# Outbound messages are sent by a pool of workers, so the webhook does not wait for them
+delivery = DeliveryQueue('{}/me/messages/?access_token={}'.format(graph_url, token),
+                         workers=delivery_workers,
+                         maxsize=delivery_queue_size,
+                         synchronous=delivery_sync)
+delivery.register_shutdown()
 
 chat_responses = {}
 
@@ -24,13 +48,18 @@ chat_responses['no_answer'] = [
 ]
 
 chat_responses['begin_add_data'] = [
-    'Vamos adicionar uma {} para a categoria {}. Me diga uma descrição, um valor e uma data, separados por vírgula.',
+    'Vamos adicionar uma {} para a categoria {}. Me diga uma descrição, um valor e uma data, separados por vírgula. '
+    'Para adicionar vários de uma vez, envie um por linha.',
 ]
 
 chat_responses['confirm_add_data'] = [
     'Vou adicionar uma {} no valor de R$ {} no dia {} com descrição {}. Está correto?',
 ]
 
+chat_responses['confirm_add_batch'] = [
+    'Vou adicionar {} {} somando R$ {:.2f}:\n{}\nEstá correto?',
+]
+
 chat_responses['sorry_wrong_add'] = [
     'Desculpe se não entendi direito :( Vamos alterar isso então. Me fale a descrição, o valor e a data novamente.',
     'Oh, oh... Foi mal =/ Bora tentar de novo? Me fale a descrição, o valor e a data novamente.',
@@ -62,6 +91,38 @@ chat_responses['begin_add_category'] = [
     'Vamos adicionar algumas novas categorias? Envie as categorias que quer cadastrar, separadas por vírgula.',
 ]
 
+chat_responses['begin_search'] = [
+    'O que quer procurar? Me diga uma palavra da descrição, como "almoço" ou "uber".',
+]
+
+chat_responses['search_results'] = [
+    'Encontrei {} registros com "{}": R$ {:.2f} em saídas e R$ {:.2f} em entradas.',
+]
+
+chat_responses['search_empty'] = [
+    'Não encontrei registros com "{}".',
+]
+
+chat_responses['recurring_added'] = [
+    'Vou registrar de novo todo dia {} e te aviso quando registrar.',
+]
+
+chat_responses['recurring_reminder'] = [
+    'Lembrete: registrei {} de R$ {:.2f} no dia {}, como todo mês.',
+]
+
+chat_responses['recurring_empty'] = [
+    'Você não tem registros de todo mês. Para criar um, escolha "Sim, todo mês" ao confirmar um registro.',
+]
+
+chat_responses['recurring_cancelled'] = [
+    'Ok, parei de registrar todo mês: {}.',
+]
+
+chat_responses['recurring_not_found'] = [
+    'Não encontrei registros de todo mês com "{}".',
+]
+
 chat_responses['waiting'] = [
     'O que fazer agora?',
     'O que vamos fazer?',
@@ -91,14 +152,52 @@ chat_keywords['intro'] = [
     'por que você existe',
 ]
 
+chat_keywords['monthly_summary'] = [
+    'resumo',
+    'resumo do mês',
+    'quanto gastei este mês',
+    'quanto gastei esse mês',
+]
+
+chat_keywords['search'] = [
+    'quanto gastei com',
+    'quanto gastei em',
+    'quanto paguei com',
+    'quanto paguei de',
+    'procurar',
+    'buscar',
+]
+
+chat_keywords['recurring'] = [
+    'contas fixas',
+    'registros de todo mês',
+    'recorrentes',
+]
+
+chat_keywords['cancel_recurring'] = [
+    'cancelar recorrente',
+    'parar recorrente',
+    'cancelar conta fixa',
+    'parar de registrar',
+]
+
+# Compiled once, more keywords can be added on FINBOT_KEYWORDS_FILE without restarting
+intent_matcher = IntentMatcher(chat_keywords, path=keywords_file)
+
+
 def define_response_by_keyword(message):
     """
     Verify the keywords to return a response type
     """
-    for key in chat_keywords:
-        for value in chat_keywords[key]:
-            if value in message.lower():
-                return key
+    return intent_matcher.match(message)
+
+
+def split_keyword(message):
+    """
+    Returns the response type of the message and the text after its keyword,
+    'quanto gastei com almoço?' becomes ('search', 'almoco?')
+    """
+    return intent_matcher.search(message)
 
 
 # CREATE FACEBOOK MESSENGER STYLE RESPONSES
@@ -126,6 +225,16 @@ def get_quick_replies(options_type='default', **kwargs):
                             'content_type': 'text',
                             'title': 'Adicionar categoria',
                             'payload': 'add_category'
+                        },
+                        {
+                            'content_type': 'text',
+                            'title': 'Resumo do mês',
+                            'payload': 'monthly_summary'
+                        },
+                        {
+                            'content_type': 'text',
+                            'title': 'Buscar registros',
+                            'payload': 'search'
                         }]
     elif options_type == 'begin_add_data':
         # Returns a list of categories as quick replies
@@ -152,6 +261,11 @@ def get_button_reply(options_type='default', **kwargs):
                 'title': 'Sim, está correto',
                 'payload': 'finalize'
               },
+              {
+                'type': 'postback',
+                'title': 'Sim, todo mês',
+                'payload': 'finalize_monthly'
+              },
               {
                 'type': 'postback',
                 'title': 'Não, quero mudar',
@@ -162,19 +276,136 @@ def get_button_reply(options_type='default', **kwargs):
     return button_reply
 
 
+def encode(value):
+    """
+    Returns the compact JSON of a value as bytes, ready to be posted
+    """
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def encode_quick_replies(options_type='default', **kwargs):
+    return encode(get_quick_replies(options_type, **kwargs))
+
+
+# The templates that never change are encoded only once
+encoded_quick_replies = {'default': encode_quick_replies('default')}
+encoded_buttons = {'default': encode(get_button_reply('default'))}
+
+
+def deliver(recipient, payload):
+    """
+    Enqueues a payload, or holds it until the commit while a unit of work is
+    running, so the replies of a failed event are never sent
+    """
+    unit = current_unit()
+    if unit is None:
+        delivery.enqueue(recipient, payload)
+    else:
+        unit.after_commit(lambda: delivery.enqueue(recipient, payload))
+
+
 def send_message(payload):
     """
-    Sends a message to the user
+    Enqueues a message to the user, messages to the same user keep their order
+    """
+    deliver(payload['recipient']['id'], payload)
+
+
+def encode_payload(sender, *parts):
+    """
+    Returns a payload already encoded, the parts are joined after the recipient
+    """
+    return b''.join((b'{"recipient":{"id":', encode(sender), b'},') + parts + (b'}',))
+
+
+def send_encoded(sender, *parts):
+    """
+    Enqueues a message already encoded
     """
-    requests.post('https://graph.facebook.com/v2.6/me/messages/?access_token=' + token, json=payload)
+    deliver(sender, encode_payload(sender, *parts))
+
+
+def get_user_profile(sender):
+    """
+    Returns the Facebook profile of an user, None when it is not available
+    """
+    url = '{}/{}?access_token={}'.format(graph_url, sender, token)
+    start = time.perf_counter()
+    try:
+        r = delivery.session().get(url, timeout=delivery.timeout)
+        metrics.observe_graph('profile', r.status_code, time.perf_counter() - start)
+        response = r.json()
+    except requests.RequestException:
+        metrics.observe_graph('profile', 'error', time.perf_counter() - start)
+        print(traceback.format_exc())
+        return None
+    except ValueError:
+        print(traceback.format_exc())
+        return None
+
+    if r.status_code != 200 or 'error' in response:
+        return None
+    return response
+
+
+def get_user_profiles(senders, timeout=None):
+    """
+    Returns {sender: profile} of several users with a single Graph API batch
+    request, the users whose profile is not available are left out
+    """
+    start = time.perf_counter()
+    try:
+        r = delivery.session().post('{}/'.format(graph_url), timeout=timeout or delivery.timeout,
+                                    data=profile_batch(senders))
+        metrics.observe_graph('profile_batch', r.status_code, time.perf_counter() - start)
+        responses = r.json()
+    except requests.RequestException:
+        metrics.observe_graph('profile_batch', 'error', time.perf_counter() - start)
+        print(traceback.format_exc())
+        return {}
+    except ValueError:
+        print(traceback.format_exc())
+        return {}
+
+    if r.status_code != 200:
+        return {}
+    return read_profile_batch(senders, responses)
+
+
+def profile_batch(senders):
+    """
+    Form of the Graph API batch request of the profiles of several users
+    """
+    batch = [{'method': 'GET', 'relative_url': '{}?fields={}'.format(sender, profile_fields)} for sender in senders]
+    return {'access_token': token, 'batch': json.dumps(batch)}
+
+
+def read_profile_batch(senders, responses):
+    """
+    Returns {sender: profile} from the responses of a batch request
+    """
+    if not isinstance(responses, list):
+        return {}
+
+    profiles = {}
+    for sender, response in zip(senders, responses):
+        # Each response has its own status code and a JSON encoded body
+        if not response or response.get('code') != 200:
+            continue
+        try:
+            profile = json.loads(response.get('body') or '{}')
+        except ValueError:
+            continue
+        if 'error' not in profile:
+            profiles[sender] = profile
+    return profiles
 
 
 def send_loading_message(sender):
     """
-    Sends a signal to messenger informing is loading the data
+    Sends a signal to messenger informing is loading the data, right away
     """
-    payload = {'recipient': {'id': sender}, 'sender_action': 'typing_on'}
-    send_message(payload)
+    delivery.enqueue(sender, encode_payload(sender, b'"sender_action":"typing_on"'))
 
 
 def create_response_message(user, income_message):
@@ -188,37 +419,27 @@ def create_response_message(user, income_message):
 
 
 def send_text_message(sender, message):
-    payload = {'recipient': {'id': sender}, 'message': {'text': message}}
-    send_message(payload)
+    send_encoded(sender, b'"message":{"text":', encode(message), b'}')
 
 
-def send_quick_replies(sender, message, options_type="default", **kwargs):
+def send_quick_replies(sender, message, options_type="default", encoded_options=None, **kwargs):
     """
-    Send a quick reply style of payload
+    Send a quick reply style of payload, encoded_options are quick replies
+    already encoded by encode_quick_replies
     """
-    options = get_quick_replies(options_type, **kwargs)
-    payload = {'recipient': {'id': sender}, 'message': {'text': message, 'quick_replies': options}}
-    send_message(payload)
+    if encoded_options is None:
+        encoded_options = encoded_quick_replies.get(options_type) if not kwargs else None
+    if encoded_options is None:
+        encoded_options = encode_quick_replies(options_type, **kwargs)
+    send_encoded(sender, b'"message":{"text":', encode(message), b',"quick_replies":', encoded_options, b'}')
 
 
 def send_buttons(sender, message, options_type="default", **kwargs):
     """
     Send a button style of payload
     """
-    options = get_button_reply(options_type, **kwargs)
-    payload = {
-        'recipient': {
-            'id': sender
-        },
-        'message': {
-            'attachment': {
-                'type': 'template',
-                'payload': {
-                    'template_type': 'button',
-                    'text': message,
-                    'buttons': options
-                }
-            }
-        }
-    }
-    send_message(payload)
+    options = encoded_buttons.get(options_type) if not kwargs else None
+    if options is None:
+        options = encode(get_button_reply(options_type, **kwargs))
+    send_encoded(sender, b'"message":{"attachment":{"type":"template","payload":{"template_type":"button","text":',
+                 encode(message), b',"buttons":', options, b'}}}')
@@ -0,0 +1,248 @@
+"""
+Lightweight counters and histograms, rendered in the Prometheus text format
+"""
+import threading
+import time
+
+from bisect import bisect_left
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds, in seconds, of the latency buckets
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_local = threading.local()
+
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in pairs]
+    return '{' + ','.join('{}="{}"'.format(name, value) for name, value in escaped) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """
+    Monotonic counter, by label values
+    """
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [(self.name, format_labels(self.labels, key), value) for key, value in values]
+
+
+class Histogram(object):
+    """
+    Distribution of observed values in cumulative buckets, by label values
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=default_buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count by bucket plus +Inf, then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, list(counts)) for key, counts in self._values.items())
+
+        samples = []
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append((self.name + '_bucket',
+                                format_labels(self.labels, key, ('le', format_value(bound))), cumulative))
+            samples.append((self.name + '_sum', format_labels(self.labels, key), counts[-1]))
+            samples.append((self.name + '_count', format_labels(self.labels, key), cumulative))
+        return samples
+
+
+class Timer(object):
+    """
+    Observes the seconds spent inside the with block
+    """
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Registry(object):
+    """
+    The metrics exposed by /metrics, plus gauges read from the stats of the
+    other components when rendering
+    """
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def register_stats(self, prefix, documentation, read):
+        """
+        Exposes every number of the dict returned by read() as a gauge
+        """
+        self._collectors.append((prefix, documentation, read))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('{}{} {}'.format(name, labels, format_value(value)))
+
+        for prefix, documentation, read in self._collectors:
+            for key, value in sorted(read().items()):
+                if not isinstance(value, (int, float)):
+                    continue
+                name = '{}_{}'.format(prefix, key)
+                lines.append('# HELP {} {}, {}'.format(name, documentation, key.replace('_', ' ')))
+                lines.append('# TYPE {} gauge'.format(name))
+                lines.append('{} {}'.format(name, format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+requests_seconds = registry.register(Histogram(
+    'finbot_request_seconds', 'Duration of the HTTP requests', labels=('endpoint', 'method', 'status')))
+stage_seconds = registry.register(Histogram(
+    'finbot_stage_seconds', 'Time spent on each stage of the webhook and of the events', labels=('stage',)))
+events_total = registry.register(Counter(
+    'finbot_events_total', 'Messaging events handled by conversation status', labels=('status',)))
+event_seconds = registry.register(Histogram(
+    'finbot_event_seconds', 'Duration of the messaging events by conversation status', labels=('status',)))
+db_seconds = registry.register(Histogram(
+    'finbot_db_statement_seconds', 'Duration of the database statements', labels=('operation',)))
+graph_seconds = registry.register(Histogram(
+    'finbot_graph_request_seconds', 'Duration of the Graph API calls', labels=('call', 'status')))
+
+
+class Span(object):
+    """
+    Time of an event, split between the database, the Graph API and the rest
+    """
+    def __init__(self):
+        self.status = None
+        self.db = 0.0
+        self.graph = 0.0
+
+    def __enter__(self):
+        self._parent = getattr(_local, 'span', None)
+        _local.span = self
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        elapsed = time.perf_counter() - self.start
+        _local.span = self._parent
+
+        status = self.status or 'none'
+        if exc_type is not None:
+            status = 'error'
+        event_seconds.observe(elapsed, status=status)
+        stage_seconds.observe(self.db, stage='db')
+        stage_seconds.observe(self.graph, stage='graph')
+        stage_seconds.observe(max(elapsed - self.db - self.graph, 0.0), stage='app')
+        return False
+
+
+def current_span():
+    return getattr(_local, 'span', None)
+
+
+def record_status(status):
+    """
+    Counts an event of the conversation status, also labels its span
+    """
+    events_total.inc(status=status)
+    span = current_span()
+    if span is not None:
+        span.status = status
+
+
+def observe_graph(call, status, seconds):
+    graph_seconds.observe(seconds, call=call, status=status)
+    span = current_span()
+    if span is not None:
+        span.graph += seconds
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_statement(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('finbot_statement_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _end_statement(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('finbot_statement_start')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'OTHER'
+    db_seconds.observe(elapsed, operation=operation)
+    span = current_span()
+    if span is not None:
+        span.db += elapsed
+
+
+@event.listens_for(Engine, 'handle_error')
+def _failed_statement(context):
+    # after_cursor_execute is not called for a failed statement
+    if context.connection is not None:
+        starts = context.connection.info.get('finbot_statement_start')
+        if starts:
+            starts.pop()
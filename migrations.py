@@ -0,0 +1,144 @@
+from sqlalchemy import inspect, text
+
+import search
+from normalize import normalize_text
+
+
+def has_column(conn, table, column):
+    return column in [c['name'] for c in inspect(conn).get_columns(table)]
+
+
+def has_index(conn, table, index):
+    return index in [i['name'] for i in inspect(conn).get_indexes(table)]
+
+
+def category_normalized_name(conn):
+    """
+    Adds Category.normalized_name, merges the duplicated categories and makes
+    (user_id, normalized_name) unique
+    """
+    if not has_column(conn, 'category', 'normalized_name'):
+        conn.execute(text('ALTER TABLE category ADD COLUMN normalized_name VARCHAR(120)'))
+
+    rows = conn.execute(text('SELECT id, user_id, name FROM category ORDER BY id')).fetchall()
+    kept = {}
+    for category_id, user_id, name in rows:
+        normalized = normalize_text(name or '')
+        key = (user_id, normalized)
+        if key not in kept:
+            kept[key] = category_id
+            conn.execute(text('UPDATE category SET normalized_name = :name WHERE id = :id'),
+                         name=normalized, id=category_id)
+            continue
+
+        # Duplicated category, moves everything to the first one
+        params = {'target': kept[key], 'source': category_id}
+        conn.execute(text('UPDATE budget SET category_id = :target WHERE category_id = :source'), **params)
+        conn.execute(text('UPDATE category SET parent_id = :target WHERE parent_id = :source'), **params)
+        conn.execute(text('DELETE FROM category WHERE id = :source'), source=category_id)
+
+    if not has_index(conn, 'category', 'uq_category_user_name'):
+        conn.execute(text('CREATE UNIQUE INDEX uq_category_user_name ON category (user_id, normalized_name)'))
+
+
+def budget_composite_indexes(conn):
+    """
+    Adds the indexes of the draft/revision lookups and of the reports
+    """
+    if not has_index(conn, 'budget', 'ix_budget_user_status'):
+        conn.execute(text('CREATE INDEX ix_budget_user_status ON budget (user_id, status)'))
+
+    if not has_index(conn, 'budget', 'ix_budget_user_done_date'):
+        where = " WHERE status = 'done'" if conn.dialect.name in ('sqlite', 'postgresql') else ''
+        conn.execute(text('CREATE INDEX ix_budget_user_done_date ON budget (user_id, date_time)' + where))
+
+    # Refreshes the statistics used by the query planner
+    if conn.dialect.name in ('sqlite', 'postgresql'):
+        conn.execute(text('ANALYZE budget'))
+
+
+def budget_import_key(conn):
+    """
+    Adds Budget.import_key, unique by user, to skip rows already imported
+    """
+    if not has_column(conn, 'budget', 'import_key'):
+        conn.execute(text('ALTER TABLE budget ADD COLUMN import_key VARCHAR(40)'))
+
+    if not has_index(conn, 'budget', 'uq_budget_user_import_key'):
+        conn.execute(text('CREATE UNIQUE INDEX uq_budget_user_import_key ON budget (user_id, import_key)'))
+
+
+def budget_search_index(conn):
+    """
+    Creates the full-text index of the descriptions, only on SQLite. The
+    entries are indexed by budget_normalized_description.
+    """
+    search.create_index(conn)
+
+
+def budget_normalized_description(conn):
+    """
+    Adds the normalized descriptions searched on every database, then
+    normalizes and indexes the finished entries
+    """
+    for table in ['budget', 'budget_archive']:
+        if not has_column(conn, table, 'normalized_description'):
+            conn.execute(text('ALTER TABLE {} ADD COLUMN normalized_description VARCHAR(120)'.format(table)))
+    search.rebuild(conn)
+
+
+# Ordered list of (version, migration), never change the version of a released one
+migrations = [
+    (1, category_normalized_name),
+    (2, budget_composite_indexes),
+    (3, budget_import_key),
+    (4, budget_search_index),
+    (5, budget_normalized_description),
+]
+
+
+def current_version(conn):
+    conn.execute(text('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)'))
+    version = conn.execute(text('SELECT MAX(version) FROM schema_version')).scalar()
+    return version or 0
+
+
+def pending(engine):
+    """
+    Returns the current version and the versions not applied yet
+    """
+    with engine.begin() as conn:
+        version = current_version(conn)
+    return version, [migration_version for migration_version, _ in migrations if migration_version > version]
+
+
+def upgrade(engine, metadata=None):
+    """
+    Applies the pending migrations, each one in its own transaction.
+
+    With the metadata of the models, the missing tables are created first. An
+    empty database gets the whole schema that way and is only stamped with the
+    latest version.
+    """
+    with engine.begin() as conn:
+        version = current_version(conn)
+        empty = not [table for table in inspect(conn).get_table_names() if table != 'schema_version']
+
+    if metadata is not None:
+        metadata.create_all(engine)
+        if empty and version == 0:
+            latest = [migration_version for migration_version, _ in migrations]
+            with engine.begin() as conn:
+                conn.execute(text('INSERT INTO schema_version (version) VALUES (:version)'), version=latest[-1])
+            return latest
+
+    applied = []
+    for migration_version, migration in migrations:
+        if migration_version <= version:
+            continue
+        with engine.begin() as conn:
+            migration(conn)
+            conn.execute(text('INSERT INTO schema_version (version) VALUES (:version)'),
+                         version=migration_version)
+        applied.append(migration_version)
+    return applied
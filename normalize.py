@@ -0,0 +1,19 @@
+import re
+import unicodedata
+
+spaces = re.compile(r'\s+')
+
+
+def strip_accents(text):
+    """
+    Removes the accents of a string, 'Alimentação' becomes 'Alimentacao'
+    """
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def normalize_text(text):
+    """
+    Returns the text without accents, in lower case and with single spaces
+    """
+    return spaces.sub(' ', strip_accents(text).lower()).strip()
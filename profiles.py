@@ -0,0 +1,92 @@
+"""
+Collects the profile lookups of the users arriving at the same time, so they
+are resolved together
+"""
+import threading
+import traceback
+
+
+class _Batch(object):
+    """
+    Keys waiting for the same load
+    """
+    def __init__(self):
+        self.keys = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.results = {}
+
+
+class ProfileCoalescer(object):
+    """
+    Groups the keys asked within window seconds, up to max_batch, and loads
+    them with a single call of loader(keys), which returns {key: value}.
+
+    The first thread of a batch waits for the window and runs the load, the
+    others wait for it up to timeout seconds and get None after that.
+    """
+    def __init__(self, loader, window=0.05, max_batch=50, timeout=5):
+        self.loader = loader
+        self.window = window
+        self.max_batch = max_batch
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._batch = None
+
+        self.batches = 0
+        self.keys = 0
+        self.largest = 0
+        self.failures = 0
+        self.timeouts = 0
+
+    def get(self, key):
+        """
+        Returns the value of a key, loaded along with the keys asked meanwhile
+        """
+        with self._lock:
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = _Batch()
+            if key not in batch.keys:
+                batch.keys.append(key)
+            if len(batch.keys) >= self.max_batch:
+                # The next keys start another batch
+                self._batch = None
+                batch.full.set()
+
+        if not leader:
+            if not batch.done.wait(self.timeout):
+                with self._lock:
+                    self.timeouts += 1
+                return None
+            return batch.results.get(key)
+
+        batch.full.wait(self.window)
+        with self._lock:
+            if self._batch is batch:
+                self._batch = None
+            self.batches += 1
+            self.keys += len(batch.keys)
+            self.largest = max(self.largest, len(batch.keys))
+
+        try:
+            batch.results = self.loader(list(batch.keys)) or {}
+        except Exception:
+            with self._lock:
+                self.failures += 1
+            print(traceback.format_exc())
+        finally:
+            batch.done.set()
+        return batch.results.get(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'batches': self.batches,
+                'keys': self.keys,
+                'largest': self.largest,
+                'failures': self.failures,
+                'timeouts': self.timeouts,
+            }
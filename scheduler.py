@@ -0,0 +1,162 @@
+"""
+Runs keys at their due times, sleeping until the earliest one is due
+"""
+import heapq
+import os
+import threading
+import time
+import traceback
+
+from datetime import datetime
+
+
+class DueScheduler(object):
+    """
+    Min-heap of (due datetime, key) served by a single thread.
+
+    The thread sleeps until the earliest key is due, then pops every due key
+    and runs them with a single call of runner(keys), which returns
+    {key: next due time} of the keys to schedule again. The loader returns
+    the (due time, key) pairs stored elsewhere, it is read on start and every
+    refresh_interval seconds so the keys added by other processes are seen.
+    """
+    def __init__(self, runner, loader, refresh_interval=300, clock=datetime.now):
+        self.runner = runner
+        self.loader = loader
+        self.refresh_interval = refresh_interval
+        self.clock = clock
+
+        self._condition = threading.Condition()
+        self._heap = []
+        self._due = {}
+        self._loaded_at = None
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+
+        self.runs = 0
+        self.keys_run = 0
+        self.failures = 0
+
+    def schedule(self, key, due):
+        """
+        Sets the due time of a key, waking the thread if it is the earliest
+        """
+        with self._condition:
+            self._push(key, due)
+            if self._heap[0][1] == key:
+                self._condition.notify()
+
+    def _push(self, key, due):
+        # Older entries of the key stay in the heap and are skipped when popped
+        self._due[key] = due
+        heapq.heappush(self._heap, (due, key))
+
+    def cancel(self, key):
+        with self._condition:
+            self._due.pop(key, None)
+
+    def load(self):
+        """
+        Replaces the heap with the due times of the loader
+        """
+        pairs = list(self.loader())
+        with self._condition:
+            self._due = dict((key, due) for due, key in pairs)
+            self._heap = [(due, key) for key, due in self._due.items()]
+            heapq.heapify(self._heap)
+            self._loaded_at = time.time()
+            self._condition.notify()
+
+    def _pop_due(self, now):
+        """
+        Returns the keys due at now, must be called holding the lock
+        """
+        keys = []
+        while self._heap and self._heap[0][0] <= now:
+            due, key = heapq.heappop(self._heap)
+            if self._due.get(key) == due:
+                del self._due[key]
+                keys.append(key)
+        return keys
+
+    def next_due(self):
+        """
+        Returns the earliest due time, skipping the outdated entries
+        """
+        with self._condition:
+            while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+            return self._heap[0][0] if self._heap else None
+
+    def run_pending(self, now):
+        """
+        Runs the keys due at now, returns how many were run
+        """
+        with self._condition:
+            keys = self._pop_due(now)
+        if not keys:
+            return 0
+
+        try:
+            schedule = self.runner(keys) or {}
+        except Exception:
+            self.failures += 1
+            print(traceback.format_exc())
+            # Tried again on the next refresh
+            schedule = {}
+        with self._condition:
+            for key, due in schedule.items():
+                if due is not None:
+                    self._push(key, due)
+            self.runs += 1
+            self.keys_run += len(keys)
+        return len(keys)
+
+    def run_forever(self):
+        """
+        Loop of the thread
+        """
+        while not self._stopping:
+            if self._loaded_at is None or time.time() - self._loaded_at >= self.refresh_interval:
+                try:
+                    self.load()
+                except Exception:
+                    self.failures += 1
+                    self._loaded_at = time.time()
+                    print(traceback.format_exc())
+
+            self.run_pending(self.clock())
+
+            with self._condition:
+                # Computed holding the lock, so a key scheduled meanwhile wakes the wait
+                next_due = self.next_due()
+                timeout = self.refresh_interval - (time.time() - self._loaded_at)
+                if next_due is not None:
+                    timeout = min(timeout, (next_due - self.clock()).total_seconds())
+                if not self._stopping:
+                    self._condition.wait(max(timeout, 0))
+
+    def start(self):
+        """
+        Starts the thread once per process, forked workers start their own
+        """
+        with self._condition:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._loaded_at = None
+            self._stopping = False
+            self._thread = threading.Thread(target=self.run_forever, name='due-scheduler')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+
+    def stats(self):
+        with self._condition:
+            return {'scheduled': len(self._due), 'runs': self.runs, 'keys_run': self.keys_run,
+                    'failures': self.failures}
@@ -0,0 +1,196 @@
+"""
+Full-text search over the descriptions of the finished entries, archived ones
+included.
+
+The normalized description of an entry, lower case and without accents, is
+stored in normalized_description when the entry becomes done. On SQLite it
+also goes to an FTS5 table. The other databases, or a SQLite built without
+FTS5, scan the normalized descriptions of the user with LIKE.
+"""
+import re
+
+from collections import namedtuple
+
+from sqlalchemy import DateTime, Float, Integer, String, text
+from sqlalchemy.exc import OperationalError
+
+from normalize import normalize_text
+
+index_table = 'budget_search'
+
+# The hot and the archived entries, the archive keeps the ids
+entries = '(SELECT id, user_id, description, normalized_description, value, date_time, entry_type, status ' \
+          'FROM budget UNION ALL SELECT id, user_id, description, normalized_description, value, date_time, ' \
+          'entry_type, status FROM budget_archive)'
+
+# Words of the questions that do not tell the entries apart
+stopwords = set(['a', 'o', 'as', 'os', 'de', 'do', 'da', 'dos', 'das', 'com', 'em', 'no', 'na', 'nos',
+                 'nas', 'e', 'um', 'uma', 'para', 'pra', 'por', 'meu', 'minha', 'meus', 'minhas'])
+words = re.compile(r'[a-z0-9]+')
+
+SearchResult = namedtuple('SearchResult', ['terms', 'matches', 'count', 'totals'])
+Match = namedtuple('Match', ['id', 'date_time', 'description', 'value', 'entry_type'])
+
+match_columns = {'id': Integer, 'date_time': DateTime, 'description': String,
+                 'value': Float, 'entry_type': String}
+
+# Engines known to have the index, by URL
+_ready = {}
+
+
+def search_terms(query):
+    """
+    Returns the normalized words of a query, without the stopwords
+    """
+    return [word for word in words.findall(normalize_text(query or '')) if word not in stopwords]
+
+
+def owner_token(user_id):
+    return 'u{}'.format(user_id)
+
+
+def match_expression(user_id, terms):
+    """
+    FTS5 query of the entries of an user having every term as a prefix, so
+    'almoco' also finds 'almocos'
+    """
+    prefixes = ' AND '.join('"{}"*'.format(term) for term in terms)
+    return 'owner:"{}" AND description:({})'.format(owner_token(user_id), prefixes)
+
+
+def _bind(conn):
+    """
+    Engine of a connection or of a session
+    """
+    return conn.get_bind() if hasattr(conn, 'get_bind') else conn.engine
+
+
+def is_ready(conn):
+    """
+    Tells if the database has the FTS5 table
+    """
+    bind = _bind(conn)
+    if bind.dialect.name != 'sqlite':
+        return False
+    key = str(bind.url)
+    if key not in _ready:
+        count = conn.execute(text("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                             {'name': index_table}).scalar()
+        _ready[key] = bool(count)
+    return _ready[key]
+
+
+def create_index(conn):
+    """
+    Creates the FTS5 table, returns False when it is not available
+    """
+    if conn.dialect.name != 'sqlite':
+        return False
+    try:
+        conn.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5(owner, description, "
+                          "tokenize = 'unicode61 remove_diacritics 1')".format(index_table)))
+    except OperationalError:
+        # SQLite built without FTS5, "no such module: fts5"
+        return False
+    _ready.pop(str(conn.engine.url), None)
+    return True
+
+
+def index_entries(conn, entries, tables=('budget',)):
+    """
+    Stores the normalized descriptions of finished entries, anything with id,
+    user_id and description, and adds them to the index
+    """
+    if not entries:
+        return
+    rows = [{'id': entry.id, 'owner': owner_token(entry.user_id),
+             'description': normalize_text(entry.description or '')} for entry in entries]
+    for table in tables:
+        conn.execute(text('UPDATE {} SET normalized_description = :description WHERE id = :id'.format(table)), rows)
+    if is_ready(conn):
+        conn.execute(text('INSERT OR REPLACE INTO {} (rowid, owner, description) '
+                          'VALUES (:id, :owner, :description)'.format(index_table)), rows)
+
+
+def remove_entries(conn, ids):
+    """
+    Removes entries from the index
+    """
+    if not ids or not is_ready(conn):
+        return
+    conn.execute(text('DELETE FROM {} WHERE rowid = :id'.format(index_table)), [{'id': id} for id in ids])
+
+
+def rebuild(conn, user_id=None, batch_size=1000):
+    """
+    Normalizes and indexes the finished entries again, archived ones included,
+    returns how many were indexed
+    """
+    query = "SELECT id, user_id, description FROM {} AS entries WHERE status = 'done'".format(entries)
+    params = {}
+    if user_id is not None:
+        query += ' AND user_id = :user_id'
+        params['user_id'] = user_id
+    if is_ready(conn):
+        if user_id is None:
+            conn.execute(text('DELETE FROM {}'.format(index_table)))
+        else:
+            conn.execute(text('DELETE FROM {} WHERE owner = :owner'.format(index_table)),
+                         {'owner': owner_token(user_id)})
+
+    rows = conn.execute(text(query + ' ORDER BY id'), params).fetchall()
+    for start in range(0, len(rows), batch_size):
+        index_entries(conn, rows[start:start + batch_size], tables=('budget', 'budget_archive'))
+    return len(rows)
+
+
+def search(conn, user_id, query, limit=10, use_index=None):
+    """
+    Returns the best matches of a query among the finished entries of an user,
+    plus the count and the totals by entry type of every match. The index is
+    used when the database has it, unless use_index is False.
+    """
+    terms = search_terms(query)
+    if not terms:
+        return SearchResult(terms, [], 0, {})
+
+    if use_index is None:
+        use_index = is_ready(conn)
+    if use_index:
+        params = {'user_id': user_id, 'match': match_expression(user_id, terms), 'limit': limit}
+        order = 'score, date_time DESC'
+
+        def matched(columns):
+            # The index is read first, then each table by id
+            return ' UNION ALL '.join(
+                'SELECT {columns} FROM {index} CROSS JOIN {table} AS b ON b.id = {index}.rowid '
+                "WHERE {index} MATCH :match AND b.user_id = :user_id AND b.status = 'done'"
+                .format(columns=columns, index=index_table, table=table) for table in ['budget', 'budget_archive'])
+        score = ', bm25({}, 0.0, 1.0) AS score'.format(index_table)
+    else:
+        # The entries finished before the normalized descriptions only ignore the case
+        params = {'user_id': user_id, 'limit': limit}
+        order = 'date_time DESC'
+        conditions = []
+        for number, term in enumerate(terms):
+            conditions.append('coalesce(b.normalized_description, lower(b.description)) LIKE :term{}'.format(number))
+            params['term{}'.format(number)] = '%{}%'.format(term)
+
+        def matched(columns):
+            return "SELECT {} FROM {} AS b WHERE b.user_id = :user_id AND b.status = 'done' AND {}".format(
+                columns, entries, ' AND '.join(conditions))
+        score = ''
+
+    columns = 'b.id, b.date_time, b.description, b.value, b.entry_type' + score
+    best = 'SELECT id, date_time, description, value, entry_type FROM ({}) AS matched ' \
+           'ORDER BY {} LIMIT :limit'.format(matched(columns), order)
+    matches = [Match(*row) for row in conn.execute(text(best).columns(**match_columns), params)]
+
+    totals = {}
+    count = 0
+    summary = 'SELECT entry_type, COUNT(*), SUM(value) FROM ({}) AS matched GROUP BY entry_type'.format(
+        matched('b.entry_type, b.value'))
+    for entry_type, entry_count, total in conn.execute(text(summary), params):
+        totals[entry_type] = total or 0.0
+        count += entry_count
+    return SearchResult(terms, matches, count, totals)
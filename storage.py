@@ -0,0 +1,61 @@
+"""
+Database backend settings: the URL, the pool of the server databases and the
+pragmas of SQLite
+"""
+import os
+import sqlite3
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Configurations
+db_file = os.path.realpath('finbot_database.db')
+database_url = os.environ.get('DATABASE_URL') or 'sqlite:///{}'.format(db_file)
+pool_size = int(os.environ.get('FINBOT_DB_POOL_SIZE', 5))
+max_overflow = int(os.environ.get('FINBOT_DB_MAX_OVERFLOW', 10))
+pool_timeout = int(os.environ.get('FINBOT_DB_POOL_TIMEOUT', 10))
+pool_recycle = int(os.environ.get('FINBOT_DB_POOL_RECYCLE', 1800))
+sqlite_journal_mode = os.environ.get('FINBOT_SQLITE_JOURNAL_MODE', 'WAL').upper()
+sqlite_busy_timeout = int(os.environ.get('FINBOT_SQLITE_BUSY_TIMEOUT', 5000))
+
+if database_url.startswith('postgres://'):
+    # Heroku still sets the old scheme, newer SQLAlchemy versions reject it
+    database_url = 'postgresql://' + database_url[len('postgres://'):]
+
+
+def is_sqlite(url):
+    return url.startswith('sqlite:')
+
+
+def configure(app, url=None):
+    """
+    Sets the database URL of the app and, for server databases, the size of
+    the connection pool of each process
+    """
+    url = url or database_url
+    app.config['SQLALCHEMY_DATABASE_URI'] = url
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    if not is_sqlite(url):
+        app.config['SQLALCHEMY_POOL_SIZE'] = pool_size
+        app.config['SQLALCHEMY_MAX_OVERFLOW'] = max_overflow
+        app.config['SQLALCHEMY_POOL_TIMEOUT'] = pool_timeout
+        app.config['SQLALCHEMY_POOL_RECYCLE'] = pool_recycle
+
+
+@event.listens_for(Engine, 'connect')
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Lets the readers work while a worker writes (WAL) and makes the writers
+    wait for the lock instead of failing with "database is locked"
+    """
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA busy_timeout = {:d}'.format(sqlite_busy_timeout))
+    if sqlite_journal_mode in ('WAL', 'DELETE', 'TRUNCATE', 'PERSIST'):
+        cursor.execute('PRAGMA journal_mode = {}'.format(sqlite_journal_mode))
+    if sqlite_journal_mode == 'WAL':
+        # Safe with WAL, only the last commits can be lost on a power failure
+        cursor.execute('PRAGMA synchronous = NORMAL')
+    cursor.execute('PRAGMA temp_store = MEMORY')
+    cursor.close()
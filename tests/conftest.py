@@ -0,0 +1,17 @@
+"""
+The tests run against a SQLite database of their own, with the replies sent
+from the calling thread
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['DATABASE_URL'] = 'sqlite:///{}'.format(os.path.join(tempfile.mkdtemp(), 'finbot_test.db'))
+os.environ.setdefault('FB_GRAPH_URL', 'http://127.0.0.1:9/v2.6')
+os.environ.setdefault('FINBOT_DELIVERY_SYNC', '1')
+
+import finbot  # noqa: E402
+
+finbot.migrations.upgrade(finbot.db.engine, finbot.db.metadata)
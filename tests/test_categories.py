@@ -0,0 +1,32 @@
+import json
+from datetime import datetime
+
+import finbot
+from finbot import db, Category
+
+
+def category_titles(user_id):
+    with finbot.app.app_context():
+        return [reply['title'] for reply in json.loads(finbot.get_category_replies(user_id).decode('utf-8'))]
+
+
+def test_replies_see_categories_added_by_another_worker():
+    with finbot.app.app_context():
+        finbot.save_categories(701, 'Casa, Lazer')
+    assert category_titles(701) == ['Casa', 'Lazer']
+
+    # Another worker adds a category, this one keeps the replies cached
+    with db.engine.begin() as conn:
+        conn.execute(Category.__table__.insert(), {'user_id': 701, 'name': 'Mercado', 'normalized_name': 'mercado',
+                                                   'created_at': datetime.now(), 'updated_at': datetime.now()})
+    assert category_titles(701) == ['Casa', 'Lazer', 'Mercado']
+
+
+def test_replies_see_categories_merged_by_another_worker():
+    with finbot.app.app_context():
+        finbot.save_categories(702, 'Casa, Moradia')
+    assert category_titles(702) == ['Casa', 'Moradia']
+
+    with db.engine.begin() as conn:
+        conn.execute(Category.__table__.delete().where(Category.normalized_name == 'moradia'))
+    assert category_titles(702) == ['Casa']
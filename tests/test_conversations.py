@@ -0,0 +1,30 @@
+from datetime import datetime
+
+import finbot
+from finbot import db, Conversation, User
+
+
+def create_user(facebook_id, status):
+    with db.engine.begin() as conn:
+        user_id = conn.execute(User.__table__.insert(), {'facebook_id': facebook_id, 'first_name': 'Teste',
+                                                         'created_at': datetime.now()}).inserted_primary_key[0]
+        conn.execute(Conversation.__table__.insert(), {'user_id': user_id, 'status': status})
+    return user_id
+
+
+def test_ttl_defaults_to_zero():
+    assert finbot.conversation_ttl == 0
+    assert finbot.conversation_store.ttl == 0
+
+
+def test_ttl_zero_reads_the_row_every_time():
+    user_id = create_user(10 ** 12 + 1, 'confirm_add_data')
+    with finbot.app.app_context():
+        assert finbot.get_conversation_status(user_id) == 'confirm_add_data'
+
+    # Another process, like manage.py archive, changes the row
+    with db.engine.begin() as conn:
+        conn.execute(Conversation.__table__.update().where(Conversation.user_id == user_id).values(status='waiting'))
+
+    with finbot.app.app_context():
+        assert finbot.get_conversation_status(user_id) == 'waiting'
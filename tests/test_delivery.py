@@ -0,0 +1,34 @@
+import threading
+import time
+
+from delivery import DeliveryQueue
+
+
+def test_full_queue_drops_without_blocking_or_reordering():
+    sent = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def transport(payload):
+        started.set()
+        release.wait(5)
+        sent.append(payload)
+        return 200
+
+    delivery = DeliveryQueue('http://graph', workers=1, maxsize=2, timeout=10, transport=transport)
+    delivery.enqueue('1', 0)
+    assert started.wait(5)
+
+    # The worker holds 0, the queue takes 1 and 2 and the rest do not fit
+    start = time.perf_counter()
+    for number in range(1, 6):
+        delivery.enqueue('1', number)
+    assert time.perf_counter() - start < 1
+    assert delivery.depth() == 2
+
+    release.set()
+    assert delivery.join(5)
+    assert sent == [0, 1, 2]
+    stats = delivery.stats.as_dict()
+    assert stats['dropped'] == 3
+    assert stats['sent'] == 3
@@ -0,0 +1,48 @@
+import pytest
+
+from sqlalchemy.exc import OperationalError
+
+import finbot
+
+
+def locked(key):
+    raise OperationalError('INSERT', {}, Exception('database is locked'))
+
+
+def test_failed_claim_lets_the_redelivery_in(monkeypatch):
+    event = {'sender': {'id': '2000000000001'}, 'recipient': {'id': '1'}, 'timestamp': 1,
+             'message': {'mid': 'mid.locked', 'text': 'Oi'}}
+    monkeypatch.setattr(finbot, 'get_or_create_user', lambda sender: finbot.CachedUser(
+        1, int(sender), 'Teste', None, None, None, None, None))
+    monkeypatch.setattr(finbot, 'claim_event', locked)
+
+    with finbot.app.app_context():
+        with pytest.raises(OperationalError):
+            finbot.handle_event(event)
+
+    # The key was forgotten, so the redelivery is not skipped as a repeat
+    assert finbot.recent_events.add(finbot.event_key(event))
+
+
+def test_interrupted_event_leaves_the_key_unclaimed(monkeypatch):
+    event = {'sender': {'id': '2000000000002'}, 'recipient': {'id': '1'}, 'timestamp': 1,
+             'message': {'mid': 'mid.interrupted', 'text': 'Oi'}}
+    key = finbot.event_key(event)
+    monkeypatch.setattr(finbot, 'get_or_create_user', lambda sender: finbot.CachedUser(
+        2, int(sender), 'Teste', None, None, None, None, None))
+    handled = []
+    monkeypatch.setattr(finbot, 'respond_event', lambda event, user: handled.append(event))
+
+    with finbot.app.app_context():
+        # A worker killed during the event never commits its claim
+        assert finbot.claim_event(key)
+        finbot.db.session.rollback()
+        finbot.db.session.remove()
+
+        finbot.handle_event(event)
+        assert handled == [event]
+
+        # Once committed, the next redelivery is a repeat, even for another worker
+        finbot.recent_events.discard(key)
+        finbot.handle_event(event)
+        assert handled == [event]
@@ -0,0 +1,63 @@
+from datetime import datetime
+
+import pytest
+
+import finbot
+from finbot import db, Budget, Category
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(finbot, 'export_token', 'secret')
+    return finbot.app.test_client()
+
+
+def get(client, user_id, query='', **headers):
+    headers['Authorization'] = 'Bearer secret'
+    return client.get('/export/{}{}'.format(user_id, query), headers=headers)
+
+
+def add_entry(user_id, category, status='done'):
+    with finbot.app.app_context():
+        finbot.save_categories(user_id, category)
+        category_id = Category.query.filter_by(user_id=user_id, name=category).one().id
+    with db.engine.begin() as conn:
+        conn.execute(Budget.__table__.insert(), {
+            'user_id': user_id, 'category_id': category_id, 'description': 'Aluguel', 'value': 900.0,
+            'date_time': datetime(2016, 12, 10), 'entry_type': 'withdrawal', 'status': status,
+            'created_at': datetime.now(), 'updated_at': datetime(2016, 12, 10)})
+
+
+def test_unchanged_export_is_not_modified(client):
+    add_entry(501, 'Casa')
+    etag = get(client, 501).headers['ETag']
+    assert get(client, 501, **{'If-None-Match': etag}).status_code == 304
+
+
+def test_merged_categories_change_the_etag(client):
+    add_entry(502, 'Casa')
+    first = get(client, 502)
+    assert b'Casa' in first.data
+
+    with finbot.app.app_context():
+        finbot.merge_categories(502, 'Casa', 'Moradia')
+
+    response = get(client, 502, **{'If-None-Match': first.headers['ETag']})
+    assert response.status_code == 200
+    assert b'Moradia' in response.data and b'Casa' not in response.data
+
+    # A resume with the old ETag sends the whole export again
+    resumed = get(client, 502, **{'Range': 'id=1-', 'If-Range': first.headers['ETag']})
+    assert resumed.status_code == 200
+
+
+def test_edited_revision_changes_the_etag(client, monkeypatch):
+    monkeypatch.setattr(finbot, 'send_text_message', lambda *args: None)
+    add_entry(503, 'Casa', status='revision')
+    etag = get(client, 503, '?status=all').headers['ETag']
+
+    with finbot.app.app_context():
+        finbot.verify_new_entry(503, '503', 'Aluguel, R$ 950,00, 10/12/2016', 'confirm_add_data')
+        db.session.commit()
+
+    assert get(client, 503, '?status=all', **{'If-None-Match': etag}).status_code == 200
@@ -0,0 +1,61 @@
+import io
+
+import pytest
+
+import finbot
+from finbot import db, Budget, MonthlySummary
+from importer import import_statement, parse_amount
+
+
+@pytest.mark.parametrize('raw, value', [
+    ('R$ -20,00', -20.0),
+    ('-20,00', -20.0),
+    ('20,00-', -20.0),
+    ('(15,00)', -15.0),
+    ('R$ 1.500', 1500.0),
+    ('1.234.567', 1234567.0),
+    ('-1.234,56', -1234.56),
+    ('-1,234.56', -1234.56),
+    ('1,234,567.89', 1234567.89),
+    ('20.90', 20.9),
+    ('20,90', 20.9),
+    ('0.5', 0.5),
+    ('R$ 35', 35.0),
+])
+def test_parse_amount(raw, value):
+    assert parse_amount(raw) == pytest.approx(value)
+
+
+def test_parse_amount_without_a_number():
+    with pytest.raises(ValueError):
+        parse_amount('R$')
+
+
+unsorted_statement = '''data,descricao,valor
+2016-12-10,Uber,-10
+2016-12-11,Padaria,-5
+2016-12-10,Uber,-10
+'''
+
+
+def imported(user_id):
+    with finbot.app.app_context():
+        entries = Budget.query.filter_by(user_id=user_id).count()
+        summary = db.session.query(db.func.sum(MonthlySummary.count), db.func.sum(MonthlySummary.total)) \
+                            .filter(MonthlySummary.user_id == user_id).one()
+        return entries, tuple(summary), finbot.check_balances(user_id)
+
+
+def test_unsorted_statement_keeps_the_repeated_rows():
+    with finbot.app.app_context():
+        report = import_statement(601, io.StringIO(unsorted_statement))
+    assert (report.inserted, report.duplicated) == (3, 0)
+    assert imported(601) == (3, (3, 25.0), [])
+
+
+def test_imported_again_counts_what_was_inserted():
+    with finbot.app.app_context():
+        import_statement(602, io.StringIO(unsorted_statement))
+        report = import_statement(602, io.StringIO(unsorted_statement))
+    assert (report.inserted, report.duplicated) == (0, 3)
+    assert imported(602) == (3, (3, 25.0), [])
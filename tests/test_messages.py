@@ -0,0 +1,36 @@
+import pytest
+
+import finbot
+import messages
+from unitofwork import UnitOfWork
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    payloads = []
+    monkeypatch.setattr(messages.delivery, 'enqueue', lambda recipient, payload: payloads.append(payload))
+    return payloads
+
+
+def test_replies_wait_for_the_commit(sent):
+    with finbot.app.app_context():
+        with UnitOfWork(finbot.db.session):
+            messages.send_text_message('1', 'Ok :)')
+            assert sent == []
+    assert sent == [b'{"recipient":{"id":"1"},"message":{"text":"Ok :)"}}']
+
+
+def test_failed_unit_sends_no_reply(sent):
+    with finbot.app.app_context():
+        with pytest.raises(RuntimeError):
+            with UnitOfWork(finbot.db.session):
+                messages.send_loading_message('1')
+                messages.send_text_message('1', 'Ok :)')
+                raise RuntimeError('status not saved')
+    # Only the typing signal, it is not held
+    assert sent == [b'{"recipient":{"id":"1"},"sender_action":"typing_on"}']
+
+
+def test_replies_outside_of_an_unit_are_sent_right_away(sent):
+    messages.send_text_message('1', 'Oi')
+    assert len(sent) == 1
@@ -0,0 +1,43 @@
+from datetime import datetime
+
+import finbot
+from finbot import db, Category, RecurringEntry
+
+
+def add_template(user_id, category_id, description, day):
+    with db.engine.begin() as conn:
+        conn.execute(RecurringEntry.__table__.insert(), {
+            'user_id': user_id, 'category_id': category_id, 'description': description, 'value': 10.0,
+            'entry_type': 'withdrawal', 'day': day, 'next_due': datetime(2030, 1, day), 'active': True})
+
+
+def active_descriptions(user_id):
+    with finbot.app.app_context():
+        return sorted(template.description for template in
+                      RecurringEntry.query.filter_by(user_id=user_id, active=True))
+
+
+def test_cancel_by_day_or_description():
+    add_template(801, None, 'Conta de luz', 5)
+    add_template(801, None, 'Aluguel 5', 10)
+    add_template(801, None, 'Academia', 20)
+
+    with finbot.app.app_context():
+        assert [template.day for template in finbot.cancel_recurring(801, '5')] == [5]
+    assert active_descriptions(801) == ['Academia', 'Aluguel 5']
+
+    with finbot.app.app_context():
+        assert [template.day for template in finbot.cancel_recurring(801, 'dia 20')] == [20]
+        assert [template.day for template in finbot.cancel_recurring(801, 'aluguel')] == [10]
+    assert active_descriptions(801) == []
+
+
+def test_merge_moves_the_templates():
+    with finbot.app.app_context():
+        finbot.save_categories(802, 'Casa, Moradia')
+        source = Category.query.filter_by(user_id=802, normalized_name='moradia').one().id
+    add_template(802, source, 'Aluguel', 10)
+
+    with finbot.app.app_context():
+        target = finbot.merge_categories(802, 'Moradia', 'Casa').id
+        assert RecurringEntry.query.filter_by(user_id=802).one().category_id == target
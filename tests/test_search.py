@@ -0,0 +1,32 @@
+from datetime import datetime
+
+import search
+from finbot import db, Budget
+
+
+def add_done_entries(user_id, descriptions):
+    rows = [{'user_id': user_id, 'description': description, 'value': 20.0, 'date_time': datetime(2016, 12, 10),
+             'entry_type': 'withdrawal', 'status': 'done'} for description in descriptions]
+    with db.engine.begin() as conn:
+        conn.execute(Budget.__table__.insert(), rows)
+        entries = conn.execute(Budget.__table__.select().where(Budget.user_id == user_id)).fetchall()
+        search.index_entries(conn, entries)
+
+
+def test_scan_ignores_the_accents():
+    add_done_entries(901, ['Almoço no centro', 'ALMOÇO', 'Jantar'])
+    with db.engine.connect() as conn:
+        for use_index in [False, None]:
+            result = search.search(conn, 901, 'almoço', use_index=use_index)
+            assert result.count == 2
+            assert result.totals == {'withdrawal': 40.0}
+            assert sorted(match.description for match in result.matches) == ['ALMOÇO', 'Almoço no centro']
+
+
+def test_rebuild_normalizes_the_descriptions():
+    with db.engine.begin() as conn:
+        conn.execute(Budget.__table__.insert(), {'user_id': 902, 'description': 'Café', 'value': 5.0,
+                                                 'entry_type': 'withdrawal', 'status': 'done',
+                                                 'date_time': datetime(2016, 12, 10)})
+        assert search.rebuild(conn, 902) == 1
+        assert search.search(conn, 902, 'cafe', use_index=False).count == 1
@@ -0,0 +1,50 @@
+import time
+
+from datetime import timedelta
+
+from usercache import CachedUser, UserCache
+
+# Created without a profile, updated_at was never set
+no_profile = CachedUser(1, 1, None, None, None, None, None, None)
+
+
+def wait_failures(cache, count):
+    deadline = time.time() + 5
+    while cache.stats()['refresh_failures'] < count and time.time() < deadline:
+        time.sleep(0.01)
+    assert cache.stats()['refresh_failures'] == count
+
+
+def test_failed_refresh_backs_off():
+    calls = []
+
+    def refresher(key):
+        calls.append(key)
+        return None
+
+    cache = UserCache(lambda key: no_profile, refresher=refresher, refresh_after=timedelta(days=30), retry_after=60)
+    cache.get('1')  # Miss, loaded
+    cache.get('1')  # Hit, refreshes
+    wait_failures(cache, 1)
+    for _ in range(3):
+        cache.get('1')
+    time.sleep(0.05)
+
+    assert calls == ['1']
+    assert cache.stats()['refresh_failures'] == 1
+
+
+def test_refresh_retries_after_the_backoff():
+    calls = []
+
+    def refresher(key):
+        calls.append(key)
+        return None
+
+    cache = UserCache(lambda key: no_profile, refresher=refresher, refresh_after=timedelta(days=30), retry_after=0)
+    cache.get('1')
+    cache.get('1')
+    wait_failures(cache, 1)
+    cache.get('1')
+    wait_failures(cache, 2)
+    assert calls == ['1', '1']
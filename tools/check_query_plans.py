@@ -0,0 +1,116 @@
+"""
+Checks that the hot queries of the bot use the expected indexes.
+
+Builds an in-memory SQLite database with a heavy user, runs EXPLAIN QUERY PLAN
+on the same queries the webhook runs and exits with an error when one of them
+scans the table or picks another index.
+
+    python tools/check_query_plans.py [--entries 5000]
+"""
+import argparse
+import os
+import sys
+
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import finbot  # noqa: E402
+from finbot import app, db, Budget, Category, Conversation, User  # noqa: E402
+
+
+def populate(entries):
+    """
+    Creates an user with many finished entries, a draft and a revision
+    """
+    user = User()
+    user.facebook_id = 1
+    db.session.add(user)
+    db.session.flush()
+
+    finbot.save_categories(user.id, 'Alimentação, Casa, Lazer')
+    category = Category.query.filter_by(user_id=user.id).first()
+
+    start = datetime(2015, 1, 1)
+    rows = [{'user_id': user.id, 'category_id': category.id, 'description': 'Entry {}'.format(i),
+             'value': float(i % 100), 'date_time': start + timedelta(hours=i), 'status': 'done',
+             'entry_type': 'withdrawal'} for i in range(entries)]
+    rows.append(dict(rows[0], status='draft'))
+    rows.append(dict(rows[0], status='revision'))
+    db.session.execute(Budget.__table__.insert(), rows)
+
+    # Other users, so the indexes are selective
+    others = range(user.id + 1, user.id + 500)
+    db.session.execute(User.__table__.insert(), [{'id': i, 'facebook_id': i} for i in others])
+    db.session.execute(Conversation.__table__.insert(), [{'user_id': i, 'status': 'waiting'} for i in others])
+    db.session.execute(Category.__table__.insert(), [{'user_id': i, 'name': 'Casa', 'normalized_name': 'casa'}
+                                                     for i in others])
+    db.session.execute(Budget.__table__.insert(), [dict(rows[0], user_id=i) for i in others])
+
+    conversation = Conversation()
+    conversation.user_id = user.id
+    conversation.status = 'waiting'
+    db.session.add(conversation)
+    db.session.commit()
+    db.session.execute('ANALYZE')
+    return user.id
+
+
+def hot_queries(user_id):
+    """
+    Returns (name, query, expected index) of the queries to check
+    """
+    month = datetime(2015, 3, 1)
+    return [
+        ('draft entry', finbot.get_entry_query(user_id, 'draft'), 'ix_budget_user_status'),
+        ('revision entry', finbot.get_entry_query(user_id, 'revision'), 'ix_budget_user_status'),
+        ('monthly report', finbot.done_entries_query(user_id, month, month + timedelta(days=31)),
+         'ix_budget_user_done_date'),
+        ('archived report', finbot.done_entries_query(user_id, month, month + timedelta(days=31)),
+         'ix_budget_archive_user_date'),
+        ('category by name', Category.query.filter_by(user_id=user_id, normalized_name='casa'),
+         'uq_category_user_name'),
+        ('conversation', Conversation.query.filter_by(user_id=user_id), 'ix_conversation_user_id'),
+        ('user', User.query.filter_by(facebook_id=1), 'ix_user_facebook_id'),
+    ]
+
+
+def explain(query):
+    """
+    Returns the lines of the SQLite query plan of a query
+    """
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    params = [compiled.params[name] for name in compiled.positiontup]
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + str(compiled), params)
+        return [row[-1] for row in cursor.fetchall()]
+    finally:
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--entries', type=int, default=5000, help='finished entries of the heavy user')
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    failures = 0
+    with app.app_context():
+        db.create_all()
+        user_id = populate(args.entries)
+
+        for name, query, index in hot_queries(user_id):
+            plan = explain(query)
+            ok = any('INDEX {}'.format(index) in line for line in plan)
+            failures += not ok
+            print('{:5} {:20} {}'.format('ok' if ok else 'FAIL', name, ' | '.join(plan)))
+
+    if failures:
+        print('{} queries do not use the expected index'.format(failures))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
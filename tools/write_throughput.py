@@ -0,0 +1,125 @@
+"""
+Write throughput of the database with several worker processes, like
+gunicorn workers finishing entries at the same time.
+
+    python tools/write_throughput.py --workers 1,2,4,8 --seconds 5
+    python tools/write_throughput.py --journal-mode DELETE     # SQLite without WAL
+    python tools/write_throughput.py --url postgresql://localhost/finbot_test
+
+Uses a temporary SQLite file unless --url is given, the tables of a server
+database receive test users and entries.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import traceback
+import warnings
+
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def finish_entry(finbot, user_id, category_id, index):
+    """
+    The writes of a confirmed entry: the entry, its summary, its balance and
+    the status
+    """
+    with finbot.UnitOfWork(finbot.db.session):
+        entry = finbot.Budget()
+        entry.user_id = user_id
+        entry.category_id = category_id
+        entry.entry_type = 'withdrawal'
+        entry.description = 'Entrada {}'.format(index)
+        entry.value = 10.0
+        entry.date_time = datetime.now()
+        finbot.db.session.add(entry)
+        finbot.db.session.flush()
+
+        entry.status = 'done'
+        finbot.add_to_summaries([entry])
+        finbot.add_to_balances([entry])
+        finbot.change_conversation_status(user_id, 'waiting')
+
+
+def run_worker(number, seconds, start_at, results):
+    import finbot
+
+    warnings.simplefilter('ignore')
+    finbot.db.engine.dispose()  # The connections of the parent are not shared
+    done = errors = 0
+    try:
+        with finbot.app.app_context():
+            user = finbot.User()
+            user.facebook_id = 10 ** 12 + os.getpid()
+            finbot.db.session.add(user)
+            finbot.db.session.commit()
+            finbot.save_categories(user.id, 'Teste')
+            category_id = finbot.Category.query.filter_by(user_id=user.id).first().id
+
+            while time.time() < start_at:
+                time.sleep(0.001)
+            deadline = start_at + seconds
+            while time.time() < deadline:
+                try:
+                    finish_entry(finbot, user.id, category_id, done)
+                    done += 1
+                except Exception:
+                    errors += 1
+                    if errors == 1:
+                        print(traceback.format_exc().strip().splitlines()[-1])
+    except Exception:
+        errors += 1
+        print(traceback.format_exc())
+    finally:
+        results.put((number, done, errors))
+
+
+def measure(workers, seconds):
+    results = multiprocessing.Queue()
+    start_at = time.time() + 0.5
+    processes = [multiprocessing.Process(target=run_worker, args=(number, seconds, start_at, results))
+                 for number in range(workers)]
+    for process in processes:
+        process.start()
+    rows = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return sum(done for _, done, _ in rows), sum(errors for _, _, errors in rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write throughput with several worker processes')
+    parser.add_argument('--workers', default='1,2,4,8', help='comma separated numbers of processes')
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--url', help='database URL, a temporary SQLite file by default')
+    parser.add_argument('--journal-mode', help='SQLite journal mode, WAL by default')
+    args = parser.parse_args()
+
+    if args.url:
+        os.environ['DATABASE_URL'] = args.url
+    else:
+        path = os.path.join(tempfile.mkdtemp(), 'throughput.db')
+        os.environ['DATABASE_URL'] = 'sqlite:///{}'.format(path)
+    if args.journal_mode:
+        os.environ['FINBOT_SQLITE_JOURNAL_MODE'] = args.journal_mode
+    os.environ['FINBOT_DELIVERY_SYNC'] = '1'
+
+    import finbot
+
+    warnings.simplefilter('ignore')
+    with finbot.app.app_context():
+        finbot.migrations.upgrade(finbot.db.engine, finbot.db.metadata)
+        finbot.db.engine.dispose()
+
+    print('{:>8} {:>10} {:>8} {:>12}'.format('workers', 'commits', 'errors', 'commits/s'))
+    for workers in [int(value) for value in args.workers.split(',')]:
+        done, errors = measure(workers, args.seconds)
+        print('{:8} {:10} {:8} {:12.1f}'.format(workers, done, errors, done / args.seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_local = threading.local()
+
+
+class UnitOfWorkStats(object):
+    """
+    Statements and commits done by the units of work
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.units = 0
+        self.rollbacks = 0
+        self.statements = 0
+        self.commits = 0
+        self.max_statements = 0
+        self.max_commits = 0
+
+    def add(self, unit):
+        with self._lock:
+            self.units += 1
+            self.statements += unit.statements
+            self.commits += unit.commits
+            self.max_statements = max(self.max_statements, unit.statements)
+            self.max_commits = max(self.max_commits, unit.commits)
+            if unit.rolled_back:
+                self.rollbacks += 1
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'units': self.units,
+                'rollbacks': self.rollbacks,
+                'statements': self.statements,
+                'commits': self.commits,
+                'statements_avg': self.statements / self.units if self.units else 0.0,
+                'max_statements': self.max_statements,
+                'max_commits': self.max_commits,
+            }
+
+
+stats = UnitOfWorkStats()
+
+
+class UnitOfWork(object):
+    """
+    Transaction scope of an event: commits once at the end, or rolls back
+    everything when an exception is raised.
+
+    Callbacks registered with after_commit and on_rollback keep the in-memory
+    caches consistent with the outcome of the transaction.
+    """
+    def __init__(self, session):
+        self.session = session
+        self.statements = 0
+        self.commits = 0
+        self.rolled_back = False
+        self._after_commit = []
+        self._on_rollback = []
+        self._parent = None
+
+    def after_commit(self, callback):
+        self._after_commit.append(callback)
+
+    def on_rollback(self, callback):
+        self._on_rollback.append(callback)
+
+    def __enter__(self):
+        self._parent = getattr(_local, 'unit', None)
+        _local.unit = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            if exc_type is None:
+                try:
+                    self.session.commit()
+                except Exception:
+                    self._rollback()
+                    raise
+            else:
+                self._rollback()
+        finally:
+            _local.unit = self._parent
+            stats.add(self)
+
+        # Run outside of the unit, what they do is not held for it anymore
+        if exc_type is None:
+            for callback in self._after_commit:
+                callback()
+        return False
+
+    def _rollback(self):
+        self.rolled_back = True
+        self.session.rollback()
+        for callback in self._on_rollback:
+            callback()
+
+
+def current_unit():
+    """
+    Returns the unit of work running on this thread, if any
+    """
+    return getattr(_local, 'unit', None)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    unit = current_unit()
+    if unit is not None:
+        unit.statements += 1
+
+
+@event.listens_for(Engine, 'commit')
+def _count_commit(conn):
+    unit = current_unit()
+    if unit is not None:
+        unit.commits += 1
@@ -0,0 +1,182 @@
+import os
+import threading
+import time
+import traceback
+
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+# The user fields needed while handling a message
+CachedUser = namedtuple('CachedUser', ['id', 'facebook_id', 'first_name', 'last_name',
+                                       'locale', 'timezone', 'gender', 'updated_at'])
+
+
+class _Flight(object):
+    """
+    A load in progress, shared by every thread asking for the same key
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+
+
+class UserCache(object):
+    """
+    Bounded LRU cache of users by facebook id, with expiration.
+
+    The loader is called on a miss and concurrent misses of the same key wait
+    for a single load. When the profile of a cached user is older than
+    refresh_after, the refresher is called on a background thread. When it
+    returns None the key is not refreshed again for retry_after seconds.
+    """
+    def __init__(self, loader, maxsize=10000, ttl=3600, refresher=None, refresh_after=None, retry_after=3600):
+        self.loader = loader
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.refresher = refresher
+        self.refresh_after = refresh_after
+        self.retry_after = retry_after
+
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self._inflight = {}
+        self._refreshing = set()
+        self._retry_at = {}
+        self._executor = None
+        self._pid = None
+
+        self.hits = 0
+        self.misses = 0
+        self.collapsed = 0
+        self.evictions = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+
+    def get(self, key):
+        """
+        Returns the cached value of a key, loading it when needed
+        """
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and (self.ttl is None or item[1] > now):
+                self._data.move_to_end(key)
+                self.hits += 1
+                value = item[0]
+            else:
+                value = None
+                self.misses += 1
+                flight = self._inflight.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._inflight[key] = _Flight()
+                else:
+                    self.collapsed += 1
+
+        if value is not None:
+            self._maybe_refresh(key, value)
+            return value
+
+        if not leader:
+            flight.event.wait()
+            return flight.value
+
+        try:
+            flight.value = self.loader(key)
+        finally:
+            with self._lock:
+                del self._inflight[key]
+                if flight.value is not None:
+                    self._store(key, flight.value)
+            flight.event.set()
+        return flight.value
+
+    def _store(self, key, value):
+        """
+        Stores a value, must be called holding the lock
+        """
+        expires_at = time.time() + self.ttl if self.ttl is not None else None
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            evicted, _ = self._data.popitem(last=False)
+            self._retry_at.pop(evicted, None)
+            self.evictions += 1
+
+    def peek(self, key):
+        """
+        Returns the cached value of a key, None when it is not cached, without loading it
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and (self.ttl is None or item[1] > time.time()):
+                return item[0]
+        return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._store(key, value)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def _maybe_refresh(self, key, value):
+        """
+        Schedules a profile refresh when the cached profile is too old
+        """
+        if self.refresher is None or self.refresh_after is None:
+            return
+        updated_at = getattr(value, 'updated_at', None)
+        if updated_at is not None and datetime.now() - updated_at < self.refresh_after:
+            return
+
+        with self._lock:
+            if key in self._refreshing or self._retry_at.get(key, 0) > time.time():
+                return
+            self._refreshing.add(key)
+            if self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=1)
+                self._pid = os.getpid()
+            executor = self._executor
+        executor.submit(self._refresh, key)
+
+    def _refresh(self, key):
+        try:
+            value = self.refresher(key)
+        except Exception:
+            value = None
+            print(traceback.format_exc())
+        try:
+            if value is not None:
+                self.set(key, value)
+                with self._lock:
+                    self._retry_at.pop(key, None)
+                    self.refreshes += 1
+            else:
+                # Profile not available, the next hits do not ask for it again right away
+                with self._lock:
+                    self._retry_at[key] = time.time() + self.retry_after
+                    self.refresh_failures += 1
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'collapsed': self.collapsed,
+                'evictions': self.evictions,
+                'refreshes': self.refreshes,
+                'refresh_failures': self.refresh_failures,
+            }
+